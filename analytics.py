@@ -0,0 +1,593 @@
+# analytics.py
+"""
+Server-side purchase analytics for get_purchase_data(admin_analysis=true).
+
+Two engines:
+- compute_purchase_analytics(): MongoDB aggregation pipelines over purchasedtable;
+  only the small result documents (totals, rankings, user ids) travel to Python.
+- rollups: the `analytics_rollups` collection, kept up to date with $inc by
+  record_purchase_change() whenever a purchase is written, so the unfiltered admin
+  dashboard is a single document read. Rebuild it (and see any drift) with:
+
+    python analytics.py reconcile [--dry-run]
+
+  The reconcile scan is not a snapshot, so pause purchase writes while it runs.
+  Every rollup write bumps a `writes` counter on the global document; a reconcile
+  that sees it move, or whose conditional writes lose a race, reports a conflict
+  instead of overwriting those increments. Rerun it until it reports none.
+
+`python analytics.py benchmark` times the pipelines against the old in-Python
+computation on the configured database and checks both agree. With
+`--generate N` it runs on N synthetic purchases in a scratch database
+(<MONGO_DB>_analytics_benchmark, dropped afterwards) instead. Both report the
+Python heap peak (tracemalloc) of each engine and the process's peak RSS.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+from db import purchased_collection, analytics_rollups_collection
+
+logger = logging.getLogger('MutationsLogger')
+
+# Id of the global rollup document; per-user rollups use "user:<user_id>"
+PURCHASE_ROLLUP_ID = "purchases"
+_ROLLUP_TOTALS = ("total_purchases", "total_courses", "completed_courses", "certificate_sent_true")
+_USER_ROLLUP_FIELDS = ("purchases", "cert_true", "cert_false")
+# Every per-user rollup document
+USER_ROLLUPS_FILTER = {"kind": "user"}
+_RECONCILE_CHUNK_SIZE = 1000
+
+# A course counts as completed from this view percentage on
+COMPLETION_THRESHOLD_PERCENT = 97.0
+
+# course_view_percent is only ever written as a float (GraphQL Float / pydantic float);
+# anything else (missing, null) counts as 0, exactly like _view_percent() below
+_VIEW_PERCENT = {
+    "$cond": [{"$isNumber": "$courses.course_view_percent"}, "$courses.course_view_percent", 0]
+}
+
+
+def _summary_pipeline(query: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"$match": query},
+        {"$facet": {
+            "purchases": [
+                {"$count": "count"},
+            ],
+            "users": [
+                {"$group": {"_id": "$user_id"}},
+                {"$count": "count"},
+            ],
+            "courses": [
+                {"$unwind": "$courses"},
+                {"$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "completed": {"$sum": {
+                        "$cond": [{"$gte": [_VIEW_PERCENT, COMPLETION_THRESHOLD_PERCENT]}, 1, 0]
+                    }},
+                    "certificate_sent_true": {"$sum": {"$cond": ["$courses.certificate_sent", 1, 0]}},
+                }},
+            ],
+            "course_ranking": [
+                {"$unwind": "$courses"},
+                {"$match": {"courses.course_id": {"$nin": [None, "", 0]}}},
+                {"$group": {"_id": {"$toString": "$courses.course_id"}, "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+            ],
+            "package_ranking": [
+                {"$match": {"package_id": {"$nin": [None, "", 0]}}},
+                {"$group": {"_id": {"$toString": "$package_id"}, "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+            ],
+        }},
+    ]
+
+
+def _certificate_users_pipeline(query: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One row per user that has at least one course with (or without) a certificate."""
+    courses = {"$ifNull": ["$courses", []]}
+    return [
+        {"$match": query},
+        {"$project": {
+            "user_id": 1,
+            "has_true": {"$in": [True, {"$map": {
+                "input": courses, "as": "c", "in": {"$cond": ["$$c.certificate_sent", True, False]}
+            }}]},
+            "has_false": {"$in": [False, {"$map": {
+                "input": courses, "as": "c", "in": {"$cond": ["$$c.certificate_sent", True, False]}
+            }}]},
+        }},
+        {"$match": {"$or": [{"has_true": True}, {"has_false": True}]}},
+        {"$group": {
+            "_id": {"$toString": "$user_id"},
+            "has_true": {"$max": "$has_true"},
+            "has_false": {"$max": "$has_false"},
+        }},
+    ]
+
+
+async def compute_purchase_analytics(query: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the raw admin analytics for the purchases matching `query`:
+    totals, certificate splits, user ids with/without certificates and the
+    course/package rankings as (id, count) tuples sorted by count desc, id asc.
+    """
+
+    async def summary() -> Dict[str, Any]:
+        docs = await purchased_collection.aggregate(_summary_pipeline(query), allowDiskUse=True).to_list(length=1)
+        return docs[0] if docs else {}
+
+    async def certificate_users() -> Tuple[List[str], List[str]]:
+        users_with_true: List[str] = []
+        users_with_false: List[str] = []
+        # Streamed through a cursor: this list grows with the user base, unlike the summary
+        async for row in purchased_collection.aggregate(_certificate_users_pipeline(query), allowDiskUse=True):
+            if not row["_id"]:
+                continue
+            if row.get("has_true"):
+                users_with_true.append(row["_id"])
+            if row.get("has_false"):
+                users_with_false.append(row["_id"])
+        return users_with_true, users_with_false
+
+    facets, (users_with_true, users_with_false) = await asyncio.gather(summary(), certificate_users())
+
+    def first_value(facet: str, field: str) -> int:
+        rows = facets.get(facet) or []
+        return int(rows[0].get(field, 0)) if rows else 0
+
+    total_courses = first_value("courses", "total")
+    certificate_sent_true = first_value("courses", "certificate_sent_true")
+    return {
+        "total_users": first_value("users", "count"),
+        "total_purchases": first_value("purchases", "count"),
+        "total_courses": total_courses,
+        "completed_courses": first_value("courses", "completed"),
+        "certificate_sent_true": certificate_sent_true,
+        "certificate_sent_false": total_courses - certificate_sent_true,
+        "users_with_true": users_with_true,
+        "users_with_false": users_with_false,
+        "course_ranking": [(row["_id"], row["count"]) for row in facets.get("course_ranking") or []],
+        "package_ranking": [(row["_id"], row["count"]) for row in facets.get("package_ranking") or []],
+    }
+
+
+def _python_purchase_analytics(purchases: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    The in-Python computation compute_purchase_analytics() replaced, kept as the
+    reference for the parity test and `python analytics.py benchmark`.
+
+    Completion uses the old coercion, float(course_view_percent or 0). The
+    pipelines count only numeric values (see _VIEW_PERCENT), so the one
+    intended difference is a numeric string such as "98": the old code
+    counted it as completed, and the pipelines and rollups treat it as 0.
+    """
+    courses = [c for p in purchases for c in (p.get("courses") or [])]
+    certificate_sent_true = sum(1 for c in courses if bool(c.get("certificate_sent")) is True)
+    users_with_true, users_with_false = set(), set()
+    for p in purchases:
+        cs = p.get("courses") or []
+        if any(bool(c.get("certificate_sent")) is True for c in cs):
+            users_with_true.add(str(p.get("user_id")))
+        if any(not bool(c.get("certificate_sent", False)) for c in cs):
+            users_with_false.add(str(p.get("user_id")))
+    course_counter = Counter(str(c["course_id"]) for c in courses if c.get("course_id"))
+    package_counter = Counter(str(p["package_id"]) for p in purchases if p.get("package_id"))
+    return {
+        "total_users": len({p.get("user_id") for p in purchases}),
+        "total_purchases": len(purchases),
+        "total_courses": len(courses),
+        "completed_courses": sum(
+            1 for c in courses if float(c.get("course_view_percent", 0) or 0) >= COMPLETION_THRESHOLD_PERCENT
+        ),
+        "certificate_sent_true": certificate_sent_true,
+        "certificate_sent_false": len(courses) - certificate_sent_true,
+        "users_with_true": sorted(users_with_true),
+        "users_with_false": sorted(users_with_false),
+        "course_ranking": sorted(course_counter.items(), key=lambda t: (-t[1], t[0])),
+        "package_ranking": sorted(package_counter.items(), key=lambda t: (-t[1], t[0])),
+    }
+
+
+def generate_purchases(count: int, seed: int = 1):
+    """
+    Yields `count` synthetic purchase documents shaped like purchasedtable: about
+    three purchases per user, 1-4 courses each out of 200, 50 packages, and a mix
+    of view percentages (some missing or null) and certificate flags.
+    """
+    rng = random.Random(seed)
+    users = max(1, count // 3)
+    for _ in range(count):
+        courses = []
+        for _ in range(rng.randint(1, 4)):
+            course = {"course_id": f"course{rng.randrange(200)}", "certificate_sent": rng.random() < 0.3}
+            roll = rng.random()
+            if roll < 0.05:
+                course["course_view_percent"] = None
+            elif roll < 0.95:
+                course["course_view_percent"] = round(rng.uniform(0, 100), 2)
+            courses.append(course)
+        purchase = {"user_id": f"user{rng.randrange(users)}", "courses": courses}
+        if rng.random() < 0.7:
+            purchase["package_id"] = f"package{rng.randrange(50)}"
+        yield purchase
+
+
+async def benchmark_purchase_analytics(query: Dict[str, Any], repeat: int = 3) -> Dict[str, Any]:
+    """
+    Times compute_purchase_analytics() against loading the matching purchases and
+    running _python_purchase_analytics() on them. Best of `repeat` runs, in seconds.
+    One more run per engine under tracemalloc gives its Python heap peak in MB; the
+    timed runs go without it, since tracing slows allocation-heavy code a lot.
+    """
+
+    async def python_path() -> Dict[str, Any]:
+        return _python_purchase_analytics(await purchased_collection.find(query).to_list(None))
+
+    timings: Dict[str, float] = {}
+    results: Dict[str, Dict[str, Any]] = {}
+    for name, run in (("pipeline", lambda: compute_purchase_analytics(query)), ("python", python_path)):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            results[name] = await run()
+            best = min(best, time.perf_counter() - started)
+        timings[name] = best
+        tracemalloc.start()
+        try:
+            await run()
+            timings[f"{name}_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    pipeline, python = results["pipeline"], results["python"]
+    matches = all(
+        sorted(pipeline[key]) == sorted(python[key]) if key.startswith("users_with") else pipeline[key] == python[key]
+        for key in python
+    )
+    # ru_maxrss is in KB on Linux
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"purchases": python["total_purchases"], "matches": matches, "max_rss_mb": max_rss_mb, **timings}
+
+
+async def _insert_generated_purchases(count: int, chunk_size: int = 10000):
+    chunk = []
+    for purchase in generate_purchases(count):
+        chunk.append(purchase)
+        if len(chunk) == chunk_size:
+            await purchased_collection.insert_many(chunk, ordered=False)
+            chunk = []
+    if chunk:
+        await purchased_collection.insert_many(chunk, ordered=False)
+
+
+# --- Incremental rollups ---
+
+def _view_percent(course: Dict[str, Any]) -> float:
+    value = course.get("course_view_percent")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return 0.0
+
+
+def _rollup_key(value: Any) -> Optional[str]:
+    """Ids become field names inside the rollup document, so skip anything Mongo can't store as a key."""
+    key = str(value)
+    if not value or "." in key or key.startswith("$"):
+        return None
+    return key
+
+
+def _purchase_contribution(purchase: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """What a single purchase document adds to the rollups."""
+    contribution = {"totals": Counter(), "courses": Counter(), "packages": Counter(), "user": Counter()}
+    if not purchase:
+        return contribution
+    courses = [c for c in (purchase.get("courses") or []) if isinstance(c, dict)]
+    certificate_true = sum(1 for c in courses if c.get("certificate_sent"))
+
+    contribution["totals"].update({
+        "total_purchases": 1,
+        "total_courses": len(courses),
+        "completed_courses": sum(1 for c in courses if _view_percent(c) >= COMPLETION_THRESHOLD_PERCENT),
+        "certificate_sent_true": certificate_true,
+    })
+    for c in courses:
+        key = _rollup_key(c.get("course_id"))
+        if key:
+            contribution["courses"][key] += 1
+    package_key = _rollup_key(purchase.get("package_id"))
+    if package_key:
+        contribution["packages"][package_key] += 1
+    contribution["user"].update({
+        "purchases": 1,
+        "cert_true": certificate_true,
+        "cert_false": len(courses) - certificate_true,
+    })
+    return contribution
+
+
+def _diff(after: Counter, before: Counter, prefix: str = "") -> Dict[str, int]:
+    return {
+        f"{prefix}{key}": after.get(key, 0) - before.get(key, 0)
+        for key in set(after) | set(before)
+        if after.get(key, 0) != before.get(key, 0)
+    }
+
+
+async def record_purchase_change(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+    """
+    Applies the difference between two versions of a purchase document to the
+    rollups with $inc. Pass before=None for an insert. Never raises: a failed
+    rollup update is logged and fixed by the next reconcile.
+
+    The global document (and its `writes` counter) is updated before the user
+    document, so a reconcile running meanwhile always notices the change.
+    """
+    try:
+        old, new = _purchase_contribution(before), _purchase_contribution(after)
+        inc = {}
+        inc.update(_diff(new["totals"], old["totals"]))
+        inc.update(_diff(new["courses"], old["courses"], "course_counts."))
+        inc.update(_diff(new["packages"], old["packages"], "package_counts."))
+
+        user_inc = _diff(new["user"], old["user"])
+        user_id = str((after or before or {}).get("user_id"))
+        if inc or user_inc:
+            await _inc_global_rollup(inc)
+        if user_inc:
+            previous = await analytics_rollups_collection.find_one_and_update(
+                {"_id": f"user:{user_id}"},
+                {"$inc": user_inc, "$set": {"kind": "user", "user_id": user_id}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+            purchases_before = (previous or {}).get("purchases", 0)
+            purchases_after = purchases_before + user_inc.get("purchases", 0)
+            if purchases_before <= 0 < purchases_after:
+                await _inc_global_rollup({"total_users": 1})
+            elif purchases_after <= 0 < purchases_before:
+                await _inc_global_rollup({"total_users": -1})
+    except Exception as e:
+        logger.error(f"record_purchase_change: Failed to update analytics rollups: {e}")
+
+
+async def _inc_global_rollup(inc: Dict[str, int]):
+    await analytics_rollups_collection.update_one(
+        {"_id": PURCHASE_ROLLUP_ID},
+        {"$inc": {**inc, "writes": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def certificate_users_filter(field: str) -> Dict[str, Any]:
+    """Per-user rollups with any course whose certificate was (field="cert_true") or was not ("cert_false") sent."""
+    return {**USER_ROLLUPS_FILTER, field: {"$gt": 0}}
+
+
+def _ranking(counts: Dict[str, int]) -> List[Tuple[str, int]]:
+    return sorted(((k, v) for k, v in (counts or {}).items() if v > 0), key=lambda t: (-t[1], t[0]))
+
+
+async def read_purchase_rollups() -> Optional[Dict[str, Any]]:
+    """
+    Same shape as compute_purchase_analytics({}), read from the rollups.
+    Returns None until a reconcile has built them once.
+    """
+    rollup = await analytics_rollups_collection.find_one({"_id": PURCHASE_ROLLUP_ID})
+    if not rollup or not rollup.get("reconciled_at"):
+        return None
+
+    async def user_ids(field: str) -> List[str]:
+        cursor = analytics_rollups_collection.find(certificate_users_filter(field), projection={"user_id": 1})
+        return [doc["user_id"] async for doc in cursor]
+
+    users_with_true, users_with_false = await asyncio.gather(user_ids("cert_true"), user_ids("cert_false"))
+    total_courses = int(rollup.get("total_courses", 0))
+    certificate_sent_true = int(rollup.get("certificate_sent_true", 0))
+    return {
+        "total_users": int(rollup.get("total_users", 0)),
+        "total_purchases": int(rollup.get("total_purchases", 0)),
+        "total_courses": total_courses,
+        "completed_courses": int(rollup.get("completed_courses", 0)),
+        "certificate_sent_true": certificate_sent_true,
+        "certificate_sent_false": total_courses - certificate_sent_true,
+        "users_with_true": users_with_true,
+        "users_with_false": users_with_false,
+        "course_ranking": _ranking(rollup.get("course_counts")),
+        "package_ranking": _ranking(rollup.get("package_counts")),
+    }
+
+
+async def _fresh_rollups() -> Tuple[Dict[str, Any], Dict[str, Dict[str, int]]]:
+    """
+    Recomputes the global and per-user rollups from purchasedtable. Uses the same
+    _purchase_contribution() as the incremental path, so any difference is real drift.
+    """
+    totals: Counter = Counter()
+    course_counts: Counter = Counter()
+    package_counts: Counter = Counter()
+    users: Dict[str, Counter] = {}
+    async for purchase in purchased_collection.find({}, projection={"user_id": 1, "package_id": 1, "courses": 1}):
+        contribution = _purchase_contribution(purchase)
+        totals.update(contribution["totals"])
+        course_counts.update(contribution["courses"])
+        package_counts.update(contribution["packages"])
+        users.setdefault(str(purchase.get("user_id")), Counter()).update(contribution["user"])
+
+    global_rollup = {key: totals.get(key, 0) for key in _ROLLUP_TOTALS}
+    global_rollup["total_users"] = len(users)
+    global_rollup["course_counts"] = dict(course_counts)
+    global_rollup["package_counts"] = dict(package_counts)
+    return global_rollup, {uid: dict(c) for uid, c in users.items()}
+
+
+async def reconcile_purchase_rollups(dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Rebuilds the rollups from scratch and reports how far the stored values had drifted.
+    With dry_run=True only the drift report is produced.
+
+    Meant to run while purchase writes are paused: the scan of purchasedtable is
+    not a snapshot. Rollup writes made during the run are detected rather than
+    overwritten. If the global `writes` counter moved during the scan, nothing is
+    applied. Otherwise every write is conditional on the values read: users are
+    replaced only if they still hold the stored counts, and the global document
+    only if `writes` is unchanged. Writes that lose a race are reported as
+    `conflicts`. When there are conflicts, the rollups need another reconcile.
+    """
+    stored = await analytics_rollups_collection.find_one({"_id": PURCHASE_ROLLUP_ID}) or {}
+    writes_before = stored.get("writes")
+    global_rollup, user_rollups = await _fresh_rollups()
+
+    drift: Dict[str, Tuple[Any, Any]] = {}
+    for key in _ROLLUP_TOTALS + ("total_users",):
+        if stored.get(key, 0) != global_rollup[key]:
+            drift[key] = (stored.get(key, 0), global_rollup[key])
+    for field in ("course_counts", "package_counts"):
+        stored_counts = {k: v for k, v in (stored.get(field) or {}).items() if v}
+        for key in set(stored_counts) | set(global_rollup[field]):
+            if stored_counts.get(key, 0) != global_rollup[field].get(key, 0):
+                drift[f"{field}.{key}"] = (stored_counts.get(key, 0), global_rollup[field].get(key, 0))
+
+    # user id -> stored counts, exactly as read (None for a missing field)
+    stored_users: Dict[str, Dict[str, Any]] = {}
+    users_drifted = 0
+    async for doc in analytics_rollups_collection.find(USER_ROLLUPS_FILTER):
+        stored_users[doc["user_id"]] = {k: doc.get(k) for k in _USER_ROLLUP_FIELDS}
+        fresh = user_rollups.get(doc["user_id"], {})
+        if any(doc.get(k, 0) != fresh.get(k, 0) for k in _USER_ROLLUP_FIELDS):
+            users_drifted += 1
+
+    report = {
+        "drift": drift, "users_drifted": users_drifted, "users": len(user_rollups),
+        "applied": False, "conflicts": 0,
+    }
+    if dry_run:
+        return report
+
+    current = await analytics_rollups_collection.find_one({"_id": PURCHASE_ROLLUP_ID}, projection={"writes": 1}) or {}
+    if current.get("writes") != writes_before:
+        report["conflicts"] = (current.get("writes") or 0) - (writes_before or 0)
+        logger.warning(
+            f"reconcile_purchase_rollups: {report['conflicts']} rollup write(s) during the scan; nothing applied"
+        )
+        return report
+
+    replaces, inserts, deletes = [], [], []
+    for uid, counts in user_rollups.items():
+        fresh = {k: counts.get(k, 0) for k in _USER_ROLLUP_FIELDS}
+        if uid not in stored_users:
+            # Only if no purchase write has created the user meanwhile
+            inserts.append(UpdateOne(
+                {"_id": f"user:{uid}"},
+                {"$setOnInsert": {"kind": "user", "user_id": uid, **fresh}},
+                upsert=True,
+            ))
+        elif stored_users[uid] != fresh:
+            replaces.append(ReplaceOne(
+                {"_id": f"user:{uid}", **stored_users[uid]},
+                {"kind": "user", "user_id": uid, **fresh},
+            ))
+    # Users whose purchases are all gone, unless a purchase write touched them meanwhile
+    for uid, counts in stored_users.items():
+        if uid not in user_rollups:
+            deletes.append(DeleteOne({"_id": f"user:{uid}", **counts}))
+
+    conflicts = 0
+    for requests, applied in (
+        (replaces, lambda result: result.matched_count),
+        (inserts, lambda result: result.upserted_count),
+        (deletes, lambda result: result.deleted_count),
+    ):
+        for start in range(0, len(requests), _RECONCILE_CHUNK_SIZE):
+            chunk = requests[start:start + _RECONCILE_CHUNK_SIZE]
+            result = await analytics_rollups_collection.bulk_write(chunk, ordered=False)
+            conflicts += len(chunk) - applied(result)
+
+    now = datetime.utcnow()
+    try:
+        result = await analytics_rollups_collection.replace_one(
+            {"_id": PURCHASE_ROLLUP_ID, "writes": writes_before},
+            {**global_rollup, "writes": writes_before or 0, "reconciled_at": now, "updated_at": now},
+            upsert=not stored,
+        )
+        if not result.matched_count and not result.upserted_id:
+            conflicts += 1
+    except DuplicateKeyError:
+        # The global document was created by a purchase write meanwhile
+        conflicts += 1
+
+    report["applied"] = True
+    report["conflicts"] = conflicts
+    if conflicts:
+        logger.warning(f"reconcile_purchase_rollups: {conflicts} conflicting write(s); run the reconcile again")
+    logger.info(f"reconcile_purchase_rollups: Rebuilt rollups for {len(user_rollups)} users, drift: {drift}")
+    return report
+
+
+async def _main(args: argparse.Namespace) -> int:
+    if args.command == "benchmark":
+        if args.generate:
+            # Never touch the real purchasedtable: switch to a scratch database
+            database = db.get_database()
+            scratch = f"{database.name}_analytics_benchmark"
+            db._database = db.client[scratch]
+            await db.client.drop_database(scratch)
+            started = time.perf_counter()
+            await _insert_generated_purchases(args.generate)
+            print(f"generated {args.generate} purchases in {scratch} in {time.perf_counter() - started:.1f} s")
+        try:
+            report = await benchmark_purchase_analytics({}, repeat=args.repeat)
+        finally:
+            if args.generate:
+                await db.client.drop_database(scratch)
+        print(
+            f"purchases: {report['purchases']} | pipeline: {report['pipeline'] * 1000:.1f} ms"
+            f" | python: {report['python'] * 1000:.1f} ms | results match: {report['matches']}"
+        )
+        print(
+            f"heap peak: pipeline {report['pipeline_peak_mb']:.1f} MB | python {report['python_peak_mb']:.1f} MB"
+            f" | process peak RSS: {report['max_rss_mb']:.0f} MB"
+        )
+        return 0 if report["matches"] else 1
+    report = await reconcile_purchase_rollups(dry_run=args.dry_run)
+    for key, (stored, actual) in sorted(report["drift"].items()):
+        print(f"drift {key}: stored={stored} actual={actual}")
+    print(
+        f"users: {report['users']} | users drifted: {report['users_drifted']} | applied: {report['applied']}"
+        f" | conflicts: {report['conflicts']}"
+    )
+    if report["conflicts"]:
+        print("purchases were written during the reconcile; pause purchase writes and run it again")
+        return 2
+    return 1 if report["drift"] or report["users_drifted"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the admin analytics rollups.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    reconcile_parser = subparsers.add_parser("reconcile", help="rebuild the rollups and report drift")
+    reconcile_parser.add_argument("--dry-run", action="store_true", help="only report drift")
+    benchmark_parser = subparsers.add_parser("benchmark", help="time the admin analytics pipeline against the old Python path")
+    benchmark_parser.add_argument("--repeat", type=int, default=3, help="runs per engine, the best is reported")
+    benchmark_parser.add_argument(
+        "--generate", type=int, metavar="N",
+        help="benchmark N synthetic purchases (e.g. 1000000) in a scratch database instead of purchasedtable",
+    )
+    parsed = parser.parse_args()
+    try:
+        sys.exit(asyncio.run(_main(parsed)))
+    finally:
+        db.close()
@@ -1,14 +1,25 @@
 import os
+import time
+import hashlib
+from collections import OrderedDict
 from dotenv import load_dotenv
 import jwt
 from bson import ObjectId
-from typing import Optional
+from typing import Optional, Dict, Set, Tuple
 import strawberry
 from fastapi import Request
 
 load_dotenv()
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+# How long a verified token is trusted without going back to Mongo, and how many
+# tokens are kept in memory at once (least recently used entries are dropped first).
+# The cache is per process: revoke_user_tokens only clears the calling worker, so
+# other workers keep accepting a replaced token for up to AUTH_CACHE_TTL_SECONDS.
+# Keep it short; 0 disables the cache and checks `logins` on every request.
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
 # Import your database collections here
 from db import logins_collection
 
@@ -21,14 +32,111 @@ class AuthenticatedUser:
     phone: Optional[str] = None
     usertype: Optional[str] = None
 
+
+# --- Verified token cache ---
+class TokenCache:
+    """
+    In-process TTL + LRU cache of verified tokens.
+
+    Keys are SHA-256 hashes of the raw token (the token itself is never kept),
+    values are the decoded AuthenticatedUser. A per-user index lets `login`
+    evict every cached token of a user when it rotates their token.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[AuthenticatedUser, float]]" = OrderedDict()
+        self._by_user: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_token(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token_hash: str) -> Optional[AuthenticatedUser]:
+        entry = self._entries.get(token_hash)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._discard(token_hash)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token_hash)
+        self.hits += 1
+        return user
+
+    def set(self, token_hash: str, user: AuthenticatedUser, token_exp: Optional[float] = None):
+        if self.ttl_seconds <= 0 or self.max_entries <= 0:
+            return
+        ttl = self.ttl_seconds
+        if token_exp is not None:
+            # Never trust a cached token beyond its own JWT expiry
+            ttl = min(ttl, token_exp - time.time())
+            if ttl <= 0:
+                return
+        self._discard(token_hash)
+        self._entries[token_hash] = (user, time.monotonic() + ttl)
+        self._by_user.setdefault(user.id, set()).add(token_hash)
+        while len(self._entries) > self.max_entries:
+            oldest_hash = next(iter(self._entries))
+            self._discard(oldest_hash)
+
+    def evict_user(self, user_id: str) -> int:
+        """Drops every cached token of a user. Returns the number of entries removed."""
+        token_hashes = self._by_user.pop(str(user_id), set())
+        for token_hash in token_hashes:
+            self._entries.pop(token_hash, None)
+        return len(token_hashes)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+
+    def _discard(self, token_hash: str):
+        entry = self._entries.pop(token_hash, None)
+        if entry is None:
+            return
+        user_hashes = self._by_user.get(entry[0].id)
+        if user_hashes is not None:
+            user_hashes.discard(token_hash)
+            if not user_hashes:
+                del self._by_user[entry[0].id]
+
+    def stats(self) -> Dict[str, float]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl_seconds}
+
+
+token_cache = TokenCache(AUTH_CACHE_TTL_SECONDS, AUTH_CACHE_MAX_ENTRIES)
+
+
+def revoke_user_tokens(user_id: str) -> int:
+    """
+    Evicts all cached tokens of a user. Call this whenever the stored token
+    in `logins` is replaced or removed so the old token stops being accepted.
+    Only this process's cache is cleared; other workers drop their copies when
+    the entries expire, after at most AUTH_CACHE_TTL_SECONDS.
+    """
+    return token_cache.evict_user(user_id)
+
+
 # This is the dependency resolver function. It takes a FastAPI Request.
-def get_current_user(request: Request) -> AuthenticatedUser:
+async def get_current_user(request: Request) -> AuthenticatedUser:
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise Exception("Authentication required: Authorization header is missing or malformed.")
-    
+
     token = auth_header.split(" ")[1]
 
+    # Fast path: token already verified recently, no jwt.decode and no Mongo round trip
+    token_hash = TokenCache.hash_token(token)
+    cached_user = token_cache.get(token_hash)
+    if cached_user is not None:
+        return cached_user
+
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
     except jwt.ExpiredSignatureError:
@@ -41,26 +149,25 @@ def get_current_user(request: Request) -> AuthenticatedUser:
     user_id_from_token = payload.get("id")
     if not user_id_from_token:
         raise Exception("Invalid token payload: User ID is missing.")
-    
+
     # Database check to ensure the token is not revoked
     try:
-        db_token_doc = logins_collection.find_one({"user_id": ObjectId(user_id_from_token), "token": token})
-        
-        if not db_token_doc:
-            raise Exception("Invalid or revoked token. Please log in again.")
+        db_token_doc = await logins_collection.find_one(
+            {"user_id": ObjectId(user_id_from_token), "token": token},
+            projection={"_id": 1}
+        )
     except Exception as e:
         raise Exception(f"Database check failed during authentication: {e}")
 
-    return AuthenticatedUser(
+    if not db_token_doc:
+        raise Exception("Invalid or revoked token. Please log in again.")
+
+    user = AuthenticatedUser(
         id=payload["id"],
         name=payload["name"],
         email=payload["email"],
         phone=payload.get("phone"),
         usertype=payload.get("usertype")
     )
-
-
-
-
-
-
+    token_cache.set(token_hash, user, payload.get("exp"))
+    return user
@@ -1,7 +1,9 @@
 # database.py
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
 from dotenv import load_dotenv
+import asyncio
 import os
+from typing import Optional
 from urllib.parse import quote_plus
 
 # --- Load Environment Variables ---
@@ -14,6 +16,16 @@ MONGO_HOST = os.getenv("MONGO_HOST")
 MONGO_PORT = os.getenv("MONGO_PORT")
 MONGO_DB = os.getenv("MONGO_DB")
 
+# --- Connection pool tuning ---
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# Comma-separated wire compressors, e.g. "zstd,snappy,zlib" (zstd/snappy need their extra packages)
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+# How many connections to open up-front at startup so the first requests don't pay for handshakes
+MONGO_WARM_CONNECTIONS = int(os.getenv("MONGO_WARM_CONNECTIONS", str(MONGO_MIN_POOL_SIZE)))
+
 # --- Properly encode username and password ---
 # This is the key change to handle special characters.
 encoded_user = quote_plus(MONGO_USER)
@@ -26,26 +38,105 @@ MONGO_DETAILS = (
 )
 
 # --- Database Setup ---
-client = AsyncIOMotorClient(MONGO_DETAILS)
-database = client[MONGO_DB]
+# The client is created per process by connect() (called from the FastAPI lifespan),
+# never at import time, so forked workers each get their own pool.
+client: Optional[AsyncIOMotorClient] = None
+_database: Optional[AsyncIOMotorDatabase] = None
+
+
+def _create_client() -> AsyncIOMotorClient:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return AsyncIOMotorClient(MONGO_DETAILS, **options)
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    """Returns the database handle, creating the client on first use (e.g. from CLI scripts)."""
+    global client, _database
+    if _database is None:
+        client = _create_client()
+        _database = client[MONGO_DB]
+    return _database
+
+
+async def connect() -> AsyncIOMotorDatabase:
+    """Creates the client, verifies the server is reachable and pre-warms the pool."""
+    database = get_database()
+    await client.admin.command("ping")
+    if MONGO_WARM_CONNECTIONS > 1:
+        # Concurrent pings force the driver to open that many sockets right away
+        await asyncio.gather(*[client.admin.command("ping") for _ in range(MONGO_WARM_CONNECTIONS)])
+    print("MongoDB connection successful!")
+    return database
+
+
+def close():
+    """Closes the client and all pooled connections."""
+    global client, _database
+    if client is not None:
+        client.close()
+    client = None
+    _database = None
+
+
+class _LazyCollection:
+    """
+    Module-level stand-in for a Motor collection. Resolves to the collection of the
+    current client on use, so modules can keep importing collections at import time.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._collection: Optional[AsyncIOMotorCollection] = None
+        self._database: Optional[AsyncIOMotorDatabase] = None
+
+    def _resolve(self) -> AsyncIOMotorCollection:
+        database = get_database()
+        if self._database is not database:
+            self._collection = database.get_collection(self._name)
+            self._database = database
+        return self._collection
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"<collection {self._name}>"
+
 
 # Collections
-users_collection = database.get_collection("users")
-logins_collection = database.get_collection("logins")
-usertypes_collection = database.get_collection("usertypes")
-packages_collection = database.get_collection("packages")
+users_collection = _LazyCollection("users")
+logins_collection = _LazyCollection("logins")
+usertypes_collection = _LazyCollection("usertypes")
+packages_collection = _LazyCollection("packages")
 # Courses Collection (Assuming this exists from your previous prompt)
-courses_collection = database.get_collection("courses")
+courses_collection = _LazyCollection("courses")
 # --- NEW: Collection for managing package-course bundles ---
-package_bundle_collection = database.get_collection("package_bundles")
+package_bundle_collection = _LazyCollection("package_bundles")
 
 # --- New Purchased Table ---
-purchased_collection = database.get_collection("purchasedtable")
+purchased_collection = _LazyCollection("purchasedtable")
+
+courseprice_collection = _LazyCollection("courseprice")
+
+courselession_table = _LazyCollection("coursemodulelessons")
+
+progress_collection = _LazyCollection("courseprogress")
 
-courseprice_collection = database.get_collection("courseprice")
+# Incrementally maintained admin analytics (see analytics.py)
+analytics_rollups_collection = _LazyCollection("analytics_rollups")
 
-courselession_table = database.get_collection("coursemodulelessons")
+# Versioned per-course lesson lists shared by all progress documents (see manifests.py)
+lesson_manifests_collection = _LazyCollection("lesson_manifests")
 
-progress_collection = database.get_collection("courseprogress")
+# Background job status (see jobs.py)
+jobs_collection = _LazyCollection("jobs")
 
-print("MongoDB connection successful!")
+# Reference counts of content-addressed uploads (see images.py)
+upload_refs_collection = _LazyCollection("upload_refs")
@@ -0,0 +1,165 @@
+# hashing.py
+"""
+bcrypt password hashing off the event loop. Compare the thread pool against
+calling bcrypt inline with:
+
+    python hashing.py benchmark [--requests 40] [--concurrency 8]
+"""
+import argparse
+import os
+import asyncio
+import statistics
+import threading
+import time
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from typing import Callable, Dict, Any
+
+load_dotenv()
+
+# Max number of bcrypt operations running at the same time. Everything above
+# this waits in the executor queue instead of blocking the event loop.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing/checking on a dedicated, bounded thread pool.
+
+    bcrypt releases the GIL while it works, so threads give real parallelism
+    and the event loop stays free for other requests (e.g. watch-time heartbeats).
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._started = 0
+        self._completed = 0
+        self._max_queue_depth = 0
+
+    def _track(self, fn: Callable, *args):
+        with self._lock:
+            self._started += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._completed += 1
+
+    async def _run(self, fn: Callable, *args):
+        with self._lock:
+            self._submitted += 1
+            # Anything beyond the worker count has to wait for a free thread
+            queue_depth = self._submitted - self._completed - self.max_workers
+            if queue_depth > self._max_queue_depth:
+                self._max_queue_depth = queue_depth
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._track, fn, *args)
+
+    async def hash_password(self, password: str) -> str:
+        hashed = await self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+        return hashed.decode('utf-8')
+
+    async def check_password(self, password: str, hashed_password: str) -> bool:
+        return await self._run(bcrypt.checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = self._started - self._completed
+            queued = self._submitted - self._started
+            return {
+                "workers": self.max_workers,
+                "running": running,
+                "queue_depth": queued,
+                "max_queue_depth": self._max_queue_depth,
+                "completed": self._completed,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash_password(password)
+
+
+async def check_password(password: str, hashed_password: str) -> bool:
+    return await password_hasher.check_password(password, hashed_password)
+
+
+# --- Benchmark ---
+
+async def _event_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> list:
+    """How late a timer that should fire every `interval` seconds actually fires, in seconds."""
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+    return lags
+
+
+async def benchmark(requests: int, concurrency: int) -> Dict[str, Dict[str, float]]:
+    """
+    Runs `requests` password checks, `concurrency` at a time, once inline on the
+    event loop and once on password_hasher, and reports throughput and how long
+    other coroutines (e.g. watch-time heartbeats) had to wait for the loop.
+    """
+    hashed = bcrypt.hashpw(b"benchmark-password", bcrypt.gensalt()).decode("utf-8")
+
+    async def inline_check() -> bool:
+        return bcrypt.checkpw(b"benchmark-password", hashed.encode("utf-8"))
+
+    async def pooled_check() -> bool:
+        return await password_hasher.check_password("benchmark-password", hashed)
+
+    report = {}
+    for name, check in (("inline", inline_check), ("thread_pool", pooled_check)):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await check()
+
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(_event_loop_lag(stop))
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(requests)])
+        elapsed = time.perf_counter() - started
+        stop.set()
+        lags = sorted(await lag_task) or [0.0]
+        report[name] = {
+            "seconds": elapsed,
+            "checks_per_second": requests / elapsed,
+            "loop_lag_p50_ms": statistics.median(lags) * 1000,
+            "loop_lag_p99_ms": lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000,
+            "loop_lag_max_ms": lags[-1] * 1000,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Password hashing tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser("benchmark", help="compare the thread pool with inline bcrypt")
+    benchmark_parser.add_argument("--requests", type=int, default=40, help="password checks per run")
+    benchmark_parser.add_argument("--concurrency", type=int, default=8, help="checks in flight at once")
+    parsed = parser.parse_args()
+    try:
+        results = asyncio.run(benchmark(parsed.requests, parsed.concurrency))
+    finally:
+        password_hasher.shutdown()
+    print(f"workers: {password_hasher.max_workers} | cpus: {os.cpu_count()}")
+    for engine, numbers in results.items():
+        print(
+            f"{engine}: {numbers['checks_per_second']:.1f} checks/s | event loop lag"
+            f" p50 {numbers['loop_lag_p50_ms']:.1f} ms, p99 {numbers['loop_lag_p99_ms']:.1f} ms,"
+            f" max {numbers['loop_lag_max_ms']:.1f} ms"
+        )
@@ -0,0 +1,429 @@
+# images.py
+"""
+Upload image pipeline for package banners and themes.
+
+The upload is streamed to a temporary file next to its destination (never held
+in memory as a whole), then decoded, downscaled and re-encoded on a bounded
+thread pool so the event loop keeps serving other requests. Byte and pixel
+limits are checked before anything is decoded, and JPEG decoding uses Pillow's
+draft mode so an oversized photo is decoded at reduced scale.
+
+Besides the stored original (bannerUrl / themeUrl, kept for older clients),
+every upload gets a set of renditions: one file per IMAGE_RENDITIONS size and
+IMAGE_RENDITION_FORMATS format, named `<name>-<size>.<ext>` next to it. Their
+URLs are recorded on the package and picked with `bannerUrl(size:, format:)`.
+
+Storage is content-addressed: `<name>` is the SHA-256 of the uploaded bytes, so
+re-uploading the same image reuses the stored files instead of processing and
+writing them again. The `upload_refs` collection counts how many packages use
+each stored image; release_upload only unlinks the files with the last
+reference. Files from before content addressing have no count and are unlinked
+right away, as before.
+
+To see what the renditions save for a given image (bytes and dimensions of the
+upload, the stored original and every rendition), run:
+
+    python images.py compare photo.jpg [more images...]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from PIL import Image, features
+from pymongo import ReturnDocument
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from db import upload_refs_collection
+from upload_cache import UPLOADS_DIR, upload_path
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40_000_000)))
+# Longest side of the stored image; larger uploads are scaled down
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2560"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "60"))
+
+# Rendition name -> maximum width, e.g. "thumb:320,card:800,full:1600"
+IMAGE_RENDITIONS = os.getenv("IMAGE_RENDITIONS", "thumb:320,card:800,full:1600")
+# Encoded in this order of preference; "avif" needs a Pillow build with AVIF support
+IMAGE_RENDITION_FORMATS = os.getenv("IMAGE_RENDITION_FORMATS", "webp,jpeg")
+
+_UPLOAD_CHUNK_BYTES = 1024 * 1024
+_FORMAT_EXTENSIONS = {"webp": "webp", "jpeg": "jpg", "avif": "avif"}
+_FORMAT_FEATURES = {"webp": "webp", "jpeg": "jpg", "avif": "avif"}
+# Formats accepted for uploads and the extension the stored original gets. The client's
+# file name is never used: /uploads serves these extensions only (see static_files.py)
+_ORIGINAL_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "AVIF": "avif"}
+# image.info keys that affect how the image renders; everything else (comments, EXIF, XMP,
+# ICC profiles, PNG text chunks) is dropped so no client-supplied bytes reach the stored files
+_RENDERING_INFO = ("transparency", "duration", "loop", "background")
+
+# {size: {format: url}}, as stored on the package document
+Renditions = Dict[str, Dict[str, str]]
+
+
+def _parse_renditions(spec: str) -> List[Tuple[str, int]]:
+    sizes = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, width = item.partition(":")
+        sizes.append((name.strip(), int(width)))
+    return sizes
+
+
+def _supported_formats(spec: str) -> List[str]:
+    formats = []
+    for image_format in filter(None, (part.strip().lower() for part in spec.split(","))):
+        if image_format not in _FORMAT_EXTENSIONS:
+            logger.warning(f"images: Unknown rendition format {image_format!r} ignored")
+        elif not features.check(_FORMAT_FEATURES[image_format]):
+            logger.warning(f"images: Pillow was built without {image_format} support; no {image_format} renditions")
+        else:
+            formats.append(image_format)
+    return formats
+
+
+RENDITION_SIZES = _parse_renditions(IMAGE_RENDITIONS)
+RENDITION_FORMATS = _supported_formats(IMAGE_RENDITION_FORMATS)
+
+# Pillow's own decompression-bomb guard, in case an image reaches Image.open elsewhere
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+class ImageRejected(Exception):
+    """The upload is not an acceptable image (too large, too many pixels, or not decodable)."""
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    # JPEG has no alpha channel; composite transparent images onto white
+    if image.mode in ("RGB", "L"):
+        return image
+    rgba = image.convert("RGBA")
+    background = Image.new("RGB", rgba.size, (255, 255, 255))
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+
+def _save_atomically(image: Image.Image, path: str, **params):
+    # Concurrent uploads of the same content write the same names; never expose a half-written file
+    temp_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        image.save(temp_path, **params)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def _compress(source_path: str, folder_path: str, stem: str) -> Tuple[str, Dict[str, Dict[str, str]]]:
+    """
+    Writes the compressed original to `folder_path` as `<stem>.<ext>`, with the
+    extension of the format Pillow detected, and the renditions next to it.
+    Returns the original's filename and {size: {format: filename}}.
+    """
+    with Image.open(source_path) as image:
+        # Only the header has been read so far
+        width, height = image.size
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ImageRejected(f"Image is {width}x{height}; at most {IMAGE_MAX_PIXELS} pixels are allowed.")
+        image_format = image.format
+        if image_format not in _ORIGINAL_EXTENSIONS:
+            raise ImageRejected(f"Unsupported image format {image_format}; upload a JPEG, PNG, WebP, GIF or AVIF file.")
+        bounds = (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION)
+        # JPEG only: decode directly at a power-of-two reduced scale
+        image.draft("RGB", bounds)
+        image.thumbnail(bounds)
+        # Metadata stored after the pixel data (e.g. PNG text chunks) is only read by load()
+        image.load()
+        image.info = {key: value for key, value in image.info.items() if key in _RENDERING_INFO}
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        original = f"{stem}.{_ORIGINAL_EXTENSIONS[image_format]}"
+        _save_atomically(image, os.path.join(folder_path, original), format=image_format, optimize=True, quality=IMAGE_QUALITY)
+
+        written: Dict[str, Dict[str, str]] = {}
+        # Largest first, so each rendition is resampled from the previous, smaller source
+        source = image
+        for size, max_width in sorted(RENDITION_SIZES, key=lambda item: -item[1]):
+            if source.width > max_width:
+                source = source.copy()
+                source.thumbnail((max_width, IMAGE_MAX_DIMENSION))
+            for rendition_format in RENDITION_FORMATS:
+                filename = f"{stem}-{size}.{_FORMAT_EXTENSIONS[rendition_format]}"
+                encoded = _flatten(source) if rendition_format == "jpeg" else source
+                _save_atomically(encoded, os.path.join(folder_path, filename), format=rendition_format.upper(), quality=IMAGE_QUALITY, optimize=True)
+                written.setdefault(size, {})[rendition_format] = filename
+        return original, written
+
+
+def rendition_url(url: Optional[str], renditions: Optional[Renditions], size: Optional[str], image_format: Optional[str]) -> Optional[str]:
+    """
+    Picks a rendition URL. Without a size the largest rendition is used, without a
+    format the first configured one that exists.
+
+    A size that is not one of IMAGE_RENDITIONS, or a format this server cannot
+    encode, raises (a GraphQL error for the field). A valid size/format that this
+    particular image has no file for falls back to the original `url`, e.g. for
+    images uploaded before renditions existed or before a size/format was added.
+    """
+    if size is not None and size not in {name for name, _ in RENDITION_SIZES}:
+        known = ", ".join(name for name, _ in RENDITION_SIZES)
+        raise Exception(f"Unknown image size {size!r}; use one of: {known}.")
+    if image_format is not None:
+        image_format = image_format.lower()
+        image_format = {"jpg": "jpeg"}.get(image_format, image_format)
+        if image_format not in _FORMAT_EXTENSIONS:
+            raise Exception(f"Unknown image format {image_format!r}; use one of: {', '.join(_FORMAT_EXTENSIONS)}.")
+    if not renditions or (size is None and image_format is None):
+        return url
+    if size is None:
+        size = next((name for name, _ in sorted(RENDITION_SIZES, key=lambda item: -item[1]) if name in renditions), None)
+    by_format = renditions.get(size) or {}
+    if image_format is None:
+        return next((by_format[f] for f in RENDITION_FORMATS if f in by_format), next(iter(by_format.values()), url))
+    return by_format.get(image_format, url)
+
+
+def rendition_paths(renditions: Optional[Renditions]) -> List[str]:
+    """All rendition URLs of an image, e.g. for deletion."""
+    return [url for by_format in (renditions or {}).values() for url in by_format.values()]
+
+
+class ImageProcessor:
+    """Runs image decoding/encoding on a dedicated, bounded thread pool (Pillow releases the GIL while it works)."""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="images")
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._deduplicated = 0
+
+    async def _run(self, fn: Callable, *args):
+        with self._lock:
+            self._submitted += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            with self._lock:
+                self._completed += 1
+
+    async def _spool(self, upload, folder_path: str) -> Tuple[str, str]:
+        """
+        Streams the upload into a temporary file in `folder_path`, enforcing
+        IMAGE_MAX_UPLOAD_BYTES. Returns the file's path and SHA-256.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=folder_path, suffix=".part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = await upload.read(_UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > IMAGE_MAX_UPLOAD_BYTES:
+                        raise ImageRejected(f"Upload exceeds {IMAGE_MAX_UPLOAD_BYTES} bytes.")
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path, digest.hexdigest()
+
+    async def _reuse(self, key: str) -> Optional[Tuple[str, Renditions]]:
+        """
+        Takes a reference on an already stored image with this content. Holding the
+        reference keeps release_upload from deleting it, so the caller can safely
+        check its files afterwards.
+        """
+        ref = await upload_refs_collection.find_one_and_update(
+            {"_id": key, "url": {"$type": "string"}}, {"$inc": {"refs": 1}}, return_document=ReturnDocument.AFTER
+        )
+        if ref is None or upload_path(ref["url"]) is None:
+            return None
+        return ref["url"], ref.get("renditions") or {}
+
+    async def save_upload(self, upload, subfolder: str) -> Tuple[str, Renditions]:
+        """
+        Stores an uploaded image under uploads/<subfolder>/ and returns its /uploads
+        URL together with the URLs of its renditions. Identical content is stored
+        once; every call takes one reference (see release_upload).
+        """
+        folder_path = os.path.join(UPLOADS_DIR, subfolder)
+        os.makedirs(folder_path, exist_ok=True)
+
+        temp_path, stem = await self._spool(upload, folder_path)
+        key = f"{subfolder}/{stem}"
+        try:
+            reused = await self._reuse(key)
+            if reused is not None:
+                with self._lock:
+                    self._deduplicated += 1
+                url, renditions = reused
+                if await asyncio.to_thread(_all_exist, [url, *rendition_paths(renditions)]):
+                    logger.info(f"ImageProcessor: {upload.filename} is already stored as {url}")
+                    return reused
+                # Files lost (e.g. deleted by hand, or a release racing with this upload): write them again
+                logger.warning(f"ImageProcessor: Files of {url} are missing, storing them again")
+                try:
+                    return await self._restore(key, temp_path, url, upload.filename)
+                except BaseException:
+                    await release_upload(url, renditions)
+                    raise
+
+            try:
+                filename, written = await self._run(_compress, temp_path, folder_path, stem)
+            except Exception as e:
+                with self._lock:
+                    self._rejected += 1
+                if isinstance(e, ImageRejected):
+                    raise
+                # Pillow raises OSError, SyntaxError, ValueError or DecompressionBombError for unusable files
+                logger.info(f"ImageProcessor: Could not decode {upload.filename}: {e}")
+                raise ImageRejected(f"Could not read image {upload.filename}; upload a JPEG, PNG, WebP, GIF or AVIF file.")
+        finally:
+            os.unlink(temp_path)
+
+        base_url = f"/{UPLOADS_DIR}/{subfolder}"
+        url = f"{base_url}/{filename}"
+        renditions = {
+            size: {rendition_format: f"{base_url}/{name}" for rendition_format, name in by_format.items()}
+            for size, by_format in written.items()
+        }
+        await upload_refs_collection.update_one(
+            {"_id": key},
+            {
+                "$inc": {"refs": 1},
+                "$set": {"url": url, "renditions": renditions},
+                "$setOnInsert": {"created_at": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+        return url, renditions
+
+    async def _restore(self, key: str, temp_path: str, url: str, filename: Optional[str]) -> Tuple[str, Renditions]:
+        """Re-creates the files of a referenced image from a fresh upload of the same content."""
+        folder_path, original = os.path.split(upload_path(url))
+        stem = os.path.splitext(original)[0]
+        try:
+            original, written = await self._run(_compress, temp_path, folder_path, stem)
+        except Exception as e:
+            logger.info(f"ImageProcessor: Could not decode {filename}: {e}")
+            if isinstance(e, ImageRejected):
+                raise
+            raise ImageRejected(f"Could not read image {filename}; upload a JPEG, PNG, WebP, GIF or AVIF file.")
+        base_url = url.rsplit("/", 1)[0]
+        # Entries from before names were derived from the format may carry the client's extension
+        url = f"{base_url}/{original}"
+        renditions = {
+            size: {rendition_format: f"{base_url}/{name}" for rendition_format, name in by_format.items()}
+            for size, by_format in written.items()
+        }
+        await upload_refs_collection.update_one({"_id": key}, {"$set": {"url": url, "renditions": renditions}})
+        return url, renditions
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "in_flight": self._submitted - self._completed,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "deduplicated": self._deduplicated,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+image_processor = ImageProcessor(IMAGE_WORKERS)
+
+
+def _all_exist(urls: List[str]) -> bool:
+    return all(upload_path(url) and os.path.exists(upload_path(url)) for url in urls)
+
+
+def _unlink(urls: List[str]):
+    for url in urls:
+        path = upload_path(url)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+async def release_upload(url: Optional[str], renditions: Optional[Renditions] = None) -> bool:
+    """
+    Drops one reference to a stored image. Returns True if this was the last one
+    and the image and its renditions were deleted. Images without a reference
+    count (stored before content addressing) are deleted right away, together
+    with the given `renditions`.
+    """
+    path = upload_path(url)
+    if path is None:
+        return False
+    subfolder = os.path.basename(os.path.dirname(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    key = f"{subfolder}/{stem}"
+
+    ref = await upload_refs_collection.find_one_and_update(
+        {"_id": key}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER
+    )
+    if ref is None:
+        await asyncio.to_thread(_unlink, [url, *rendition_paths(renditions)])
+        return True
+    if ref.get("refs", 0) > 0:
+        logger.info(f"release_upload: {url} is still used {ref['refs']} time(s)")
+        return False
+    # Only the caller that removes the entry deletes the files; a concurrent upload of the same
+    # content either incremented first (entry kept) or finds no entry and stores the files again
+    result = await upload_refs_collection.delete_one({"_id": key, "refs": 0})
+    if result.deleted_count != 1:
+        return False
+    await asyncio.to_thread(_unlink, [ref.get("url") or url, *rendition_paths(ref.get("renditions"))])
+    return True
+
+
+def compare_renditions(source_path: str) -> List[Tuple[str, int, Tuple[int, int]]]:
+    """
+    Runs an image through _compress in a scratch folder and returns
+    (name, bytes, (width, height)) for the upload, the stored original and each rendition.
+    """
+    with Image.open(source_path) as image:
+        rows = [("upload", os.path.getsize(source_path), image.size)]
+    with tempfile.TemporaryDirectory() as folder_path:
+        original, written = _compress(source_path, folder_path, "image")
+        for name in [original, *(name for by_format in written.values() for name in by_format.values())]:
+            path = os.path.join(folder_path, name)
+            with Image.open(path) as image:
+                rows.append((name, os.path.getsize(path), image.size))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload image tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subparsers.add_parser("compare", help="bytes of the renditions of an image vs the original")
+    compare_parser.add_argument("paths", nargs="+", help="image files")
+    parsed = parser.parse_args()
+    print(f"renditions: {IMAGE_RENDITIONS} | formats: {', '.join(RENDITION_FORMATS)} | quality: {IMAGE_QUALITY}")
+    for source in parsed.paths:
+        rows = compare_renditions(source)
+        upload_bytes = rows[0][1]
+        print(source)
+        for name, size_bytes, (width, height) in rows:
+            print(f"  {name:<20} {width:>5}x{height:<5} {size_bytes:>10} bytes  {size_bytes / upload_bytes:7.1%}")
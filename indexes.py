@@ -0,0 +1,314 @@
+# indexes.py
+"""
+Declares the MongoDB indexes the resolvers rely on and keeps the database in sync.
+
+Runs automatically at startup (see main.py) and can be used from the command line:
+
+    python indexes.py --apply     # create any missing index (idempotent)
+    python indexes.py --report    # list missing, undeclared and unused indexes
+    python indexes.py --explain   # fail if a resolver query needs a COLLSCAN or an in-memory SORT
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from bson import ObjectId
+from datetime import datetime, timezone
+from itertools import product
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+from analytics import PURCHASE_ROLLUP_ID, USER_ROLLUPS_FILTER, certificate_users_filter
+from jobs import JOB_RETENTION_SECONDS, REFRESH_CHUNK_SORT, stale_progress_filter
+from progress import V1_FILTER, V2_FILTER, V3_FILTER
+from user_queries import (
+    ACTIVE_USERS_FILTER,
+    DELETED_USERS_FILTER,
+    USERS_LIST_SORT,
+    and_filter,
+    encode_cursor,
+    keyset_after_filter,
+    users_list_filters,
+)
+
+logger = logging.getLogger('MutationsLogger')
+
+# --- Index declarations, keyed by collection name ---
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        # signup duplicate checks + login lookup
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("phone", ASCENDING)], name="phone_unique", unique=True),
+        # allUsers keyset pagination (createdAt desc, _id desc), with and without the isDeleted filter
+        IndexModel([("createdAt", DESCENDING), ("_id", DESCENDING)], name="createdAt_id"),
+        IndexModel(
+            [("isDeleted", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+            name="isDeleted_createdAt_id",
+        ),
+        # allUsers active_count
+        IndexModel([("isActive", ASCENDING), ("isDeleted", ASCENDING)], name="isActive_isDeleted"),
+    ],
+    "logins": [
+        # token revocation check in authenticate.get_current_user and token rotation in login
+        IndexModel([("user_id", ASCENDING), ("token", ASCENDING)], name="user_id_token"),
+    ],
+    "usertypes": [
+        IndexModel([("usertype", ASCENDING)], name="usertype"),
+    ],
+    "packages": [
+        # duplicate title check in create_package, only live packages matter
+        IndexModel(
+            [("title", ASCENDING)],
+            name="title_live",
+            partialFilterExpression={"isDeleted": False},
+        ),
+        # default get_packages listing
+        IndexModel([("isDeleted", ASCENDING), ("createdAt", DESCENDING)], name="isDeleted_createdAt"),
+        # get_packages(created_by=...)
+        IndexModel([("createdBy", ASCENDING)], name="createdBy"),
+    ],
+    "purchasedtable": [
+        # create_purchase lookups (package purchase and single-course purchase) + user purchase listing
+        IndexModel(
+            [("user_id", ASCENDING), ("package_id", ASCENDING), ("courses.course_id", ASCENDING)],
+            name="user_id_package_id_course_id",
+        ),
+        # get_purchase_data date range filter
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+    "analytics_rollups": [
+        # admin dashboard certificate user lists, only users that have any
+        IndexModel(
+            [("kind", ASCENDING), ("cert_true", ASCENDING)],
+            name="kind_cert_true",
+            partialFilterExpression={"cert_true": {"$gt": 0}},
+        ),
+        IndexModel(
+            [("kind", ASCENDING), ("cert_false", ASCENDING)],
+            name="kind_cert_false",
+            partialFilterExpression={"cert_false": {"$gt": 0}},
+        ),
+        # reconcile: every per-user rollup (the old kind_reconcile_id index is no longer used and can be dropped)
+        IndexModel([("kind", ASCENDING)], name="kind"),
+    ],
+    "coursemodulelessons": [
+        # fetch_video_lessons_data
+        IndexModel([("courseId", ASCENDING), ("lessonType", ASCENDING)], name="courseId_lessonType"),
+    ],
+    "courseprogress": [
+        # update_lesson_watch_time + get_course_progress; unique so enrollment upserts stay single-document.
+        # Existing deployments: run `python migrations.py progress_unique_user_course` first.
+        IndexModel([("user_id", ASCENDING), ("course_id", ASCENDING)], name="user_id_course_id_unique", unique=True),
+        # refresh_course_progress job: stale documents of a course
+        IndexModel([("course_id", ASCENDING), ("manifest_hash", ASCENDING)], name="course_id_manifest_hash"),
+        # refresh_course_progress job chunks: a course's documents in _id order, without an in-memory sort
+        IndexModel([("course_id", ASCENDING), ("_id", ASCENDING)], name="course_id_id"),
+    ],
+    "jobs": [
+        # Finished jobs are purged automatically after JOB_RETENTION_SECONDS
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=JOB_RETENTION_SECONDS),
+    ],
+    "lesson_manifests": [
+        # manifests.get_manifest / get_current_manifest; unique so concurrent publishers can't share a version
+        IndexModel([("course_id", ASCENDING), ("version", DESCENDING)], name="course_id_version", unique=True),
+    ],
+}
+
+
+# (collection, filter, sort or None, limit or 0)
+ResolverQuery = Tuple[str, Dict[str, Any], Optional[List[Tuple[str, int]]], int]
+
+
+def _resolver_queries() -> List[ResolverQuery]:
+    """
+    The hot resolver queries with their sort and limit, used by the explain check.
+    Filters come from the same builders the resolvers use wherever those exist.
+    """
+    sample_oid = ObjectId()
+    sample_id = str(sample_oid)
+    cursor = encode_cursor(datetime(2024, 1, 1, tzinfo=timezone.utc), sample_oid)
+    users_page = 51  # allUsers default page size plus the look-ahead document
+
+    queries: List[ResolverQuery] = [
+        # signup duplicate checks, login
+        ("users", {"email": "someone@example.com"}, None, 1),
+        ("users", {"phone": "9999999999"}, None, 1),
+        ("users", {"email": "someone@example.com", "isDeleted": False}, None, 1),
+        # enroll_cohort existence check
+        ("users", {"_id": {"$in": [sample_oid]}}, None, 0),
+        # allUsers counts
+        ("users", DELETED_USERS_FILTER, None, 0),
+        ("users", ACTIVE_USERS_FILTER, None, 0),
+        # allUsers deleted_users page, first and next
+        ("users", DELETED_USERS_FILTER, USERS_LIST_SORT, users_page),
+        ("users", and_filter([DELETED_USERS_FILTER, keyset_after_filter(cursor)]), USERS_LIST_SORT, users_page),
+    ]
+    # allUsers list for every active / is_deleted combination, first and next page
+    for active, is_deleted in product((None, True, False), repeat=2):
+        filters = users_list_filters(active, is_deleted)
+        queries.append(("users", and_filter(filters), USERS_LIST_SORT, users_page))
+        queries.append(("users", and_filter(filters + [keyset_after_filter(cursor)]), USERS_LIST_SORT, users_page))
+        if filters:
+            # matching_count
+            queries.append(("users", and_filter(filters), None, 0))
+
+    queries += [
+        ("logins", {"user_id": sample_oid, "token": "token"}, None, 1),
+        ("usertypes", {"usertype": "user"}, None, 1),
+        ("packages", {"title": "title", "isDeleted": False}, None, 1),
+        ("packages", {"isDeleted": False}, None, 0),
+        ("packages", {"$or": [{"createdBy": sample_id}, {"createdBy": sample_oid}]}, None, 0),
+        ("purchasedtable", {"user_id": sample_id, "package_id": sample_id}, None, 1),
+        ("purchasedtable", {"user_id": sample_id, "package_id": None,
+                            "courses": {"$elemMatch": {"course_id": sample_id}}}, None, 1),
+        ("purchasedtable", {"user_id": sample_id}, None, 0),
+        ("coursemodulelessons", {"courseId": sample_oid, "lessonType": "video"}, None, 0),
+        ("courseprogress", {"user_id": sample_id, "course_id": sample_id}, None, 1),
+        ("courseprogress", {"user_id": sample_id, "course_id": {"$in": [sample_id]}}, None, 0),
+        # refresh_course_progress job: count, then chunks in _id order
+        ("courseprogress", stale_progress_filter(sample_id, "hash"), None, 0),
+        ("courseprogress", stale_progress_filter(sample_id, "hash", sample_oid), REFRESH_CHUNK_SORT, 500),
+        ("courseprogress", {**stale_progress_filter(sample_id, "hash"), **V3_FILTER, "manifest_version": 1}, None, 0),
+        ("lesson_manifests", {"course_id": sample_id, "version": 1}, None, 1),
+        # ensure_current_manifests: newest manifest per course ($match + $sort of its pipeline)
+        ("lesson_manifests", {"course_id": {"$in": [sample_id]}}, [("course_id", ASCENDING), ("version", DESCENDING)], 0),
+        ("analytics_rollups", {"_id": PURCHASE_ROLLUP_ID}, None, 1),
+        ("analytics_rollups", certificate_users_filter("cert_true"), None, 0),
+        ("analytics_rollups", certificate_users_filter("cert_false"), None, 0),
+        ("analytics_rollups", USER_ROLLUPS_FILTER, None, 0),
+        ("upload_refs", {"_id": "images/0123abcd", "url": {"$type": "string"}}, None, 1),
+        ("jobs", {"_id": sample_id}, None, 1),
+    ]
+    # update_lesson_watch_time: one write per progress schema version
+    for version_filter in (V1_FILTER, V2_FILTER, V3_FILTER):
+        queries.append(("courseprogress", {"user_id": sample_id, "course_id": sample_id, **version_filter}, None, 1))
+    return queries
+
+
+def _key_of(spec) -> Tuple[Tuple[str, Any], ...]:
+    pairs = spec.items() if hasattr(spec, "items") else spec
+    # index_information() may report directions as floats (1.0), declarations use ints
+    return tuple((k, int(v) if isinstance(v, float) else v) for k, v in pairs)
+
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    """
+    Creates every declared index. Safe to run repeatedly: existing indexes with
+    the same definition are left alone. Failures (e.g. duplicates blocking a
+    unique index) are logged per index and do not stop the others.
+    """
+    created: Dict[str, List[str]] = {}
+    for collection_name, models in INDEXES.items():
+        collection = db.get_database().get_collection(collection_name)
+        for model in models:
+            try:
+                name = await collection.create_indexes([model])
+                created.setdefault(collection_name, []).extend(name)
+            except (OperationFailure, PyMongoError) as e:
+                logger.error(f"ensure_indexes: Could not create index {model.document['name']} on {collection_name}: {e}")
+    logger.info(f"ensure_indexes: Indexes in place: {created}")
+    return created
+
+
+async def index_report() -> Dict[str, Dict[str, List[str]]]:
+    """
+    Compares the declared indexes with what exists in the database.
+
+    - missing:    declared but not present
+    - undeclared: present but not declared here (besides _id_)
+    - unused:     present with zero accesses since the last mongod restart ($indexStats)
+    """
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for collection_name, models in INDEXES.items():
+        collection = db.get_database().get_collection(collection_name)
+        existing = await collection.index_information()
+        existing_keys = {_key_of(info["key"]): name for name, info in existing.items()}
+        declared_keys = {_key_of(m.document["key"]): m.document["name"] for m in models}
+
+        missing = [name for key, name in declared_keys.items() if key not in existing_keys]
+        undeclared = [
+            name for key, name in existing_keys.items()
+            if key not in declared_keys and name != "_id_"
+        ]
+
+        unused: List[str] = []
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                if stat["name"] != "_id_" and int(stat.get("accesses", {}).get("ops", 0)) == 0:
+                    unused.append(stat["name"])
+        except PyMongoError as e:
+            logger.warning(f"index_report: $indexStats unavailable for {collection_name}: {e}")
+
+        report[collection_name] = {"missing": missing, "undeclared": undeclared, "unused": unused}
+    return report
+
+
+def _find_stages(plan: Dict[str, Any]) -> List[str]:
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages += _find_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _find_stages(child)
+    return stages
+
+
+# Winning-plan stages the explain check rejects: a full scan, or a sort done in memory
+_REJECTED_STAGES = ("COLLSCAN", "SORT")
+
+
+async def explain_resolver_queries() -> List[Tuple[str, Dict[str, Any], List[str]]]:
+    """
+    Runs explain() on every resolver query, with its sort and limit, and returns
+    the ones whose winning plan has a COLLSCAN or a blocking (in-memory) SORT.
+    """
+    rejected = []
+    for collection_name, query, sort, limit in _resolver_queries():
+        collection = db.get_database().get_collection(collection_name)
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        explanation = await cursor.explain()
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        # Newer servers wrap the classic plan in "queryPlan"
+        stages = _find_stages(winning_plan.get("queryPlan", winning_plan))
+        if any(stage in _REJECTED_STAGES for stage in stages):
+            rejected.append((collection_name, query, stages))
+    return rejected
+
+
+async def _main(args: argparse.Namespace) -> int:
+    exit_code = 0
+    if args.apply:
+        await ensure_indexes()
+    if args.report:
+        for collection_name, entry in (await index_report()).items():
+            print(f"{collection_name}: missing={entry['missing']} undeclared={entry['undeclared']} unused={entry['unused']}")
+            if entry["missing"]:
+                exit_code = 1
+    if args.explain:
+        rejected = await explain_resolver_queries()
+        for collection_name, query, stages in rejected:
+            print(f"{collection_name} {query}: {' -> '.join(stages)}")
+        if rejected:
+            exit_code = 1
+        else:
+            print("All resolver queries use an index, with no in-memory sort.")
+    return exit_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the MongoDB indexes used by the GraphQL resolvers.")
+    parser.add_argument("--apply", action="store_true", help="create missing indexes")
+    parser.add_argument("--report", action="store_true", help="report missing, undeclared and unused indexes")
+    parser.add_argument("--explain", action="store_true", help="fail if a resolver query does a COLLSCAN or an in-memory SORT")
+    parsed = parser.parse_args()
+    if not (parsed.apply or parsed.report or parsed.explain):
+        parsed.apply = parsed.report = True
+    try:
+        sys.exit(asyncio.run(_main(parsed)))
+    finally:
+        db.close()
@@ -0,0 +1,312 @@
+# jobs.py
+"""
+Background jobs for long-running maintenance work (e.g. refreshing every
+progress document of a large course).
+
+Mutations submit a job and return its id right away; the work runs as an
+asyncio task in the submitting worker. Status and progress counters are kept
+in the `jobs` collection, so the `jobStatus` query can be answered by any
+worker. Finished jobs expire after JOB_RETENTION_SECONDS (TTL index).
+
+While a job is queued or running, its worker touches `updated_at` every
+JOB_HEARTBEAT_SECONDS. A job whose heartbeat is older than JOB_STALE_SECONDS
+belonged to a worker that died; get_job marks it as failed.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from pymongo import ASCENDING, UpdateMany
+from pymongo.errors import BulkWriteError
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from db import jobs_collection, progress_collection
+from manifests import get_manifest, only_appends, publish_manifest
+from progress import (
+    V1_FILTER,
+    V2_FILTER,
+    V3_FILTER,
+    append_lessons_update,
+    progress_upsert_request,
+    refresh_array_watch_times_pipeline,
+    refresh_keyed_watch_times_pipeline,
+    refresh_manifest_watch_times_pipeline,
+)
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+# How many jobs may run at once per worker; the rest wait in "queued"
+JOB_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", "2"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Queued and running jobs refresh updated_at this often; without a refresh for JOB_STALE_SECONDS they count as lost
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+# Progress documents per refresh chunk, and the pause between chunks to keep load on mongod low
+REFRESH_JOB_CHUNK_SIZE = int(os.getenv("REFRESH_JOB_CHUNK_SIZE", "500"))
+REFRESH_JOB_PAUSE_SECONDS = float(os.getenv("REFRESH_JOB_PAUSE_SECONDS", "0.1"))
+# Progress documents written per bulk_write by the enroll_cohort job
+COHORT_ENROLLMENT_CHUNK_SIZE = int(os.getenv("COHORT_ENROLLMENT_CHUNK_SIZE", "1000"))
+# Failed users listed by name in the enroll_cohort job message; the rest are only counted
+_COHORT_FAILURES_LISTED = 20
+
+
+class Job:
+    """Handle passed to a running job for reporting progress."""
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+
+    async def set_total(self, total: int):
+        await jobs_collection.update_one({"_id": self.id}, {"$set": {"total": total}})
+
+    async def advance(self, processed: int, modified: int = 0):
+        await jobs_collection.update_one(
+            {"_id": self.id},
+            {"$inc": {"processed": processed, "modified": modified}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        )
+
+
+JobFunction = Callable[..., Awaitable[str]]
+
+# Order in which refresh_course_progress_job walks the stale documents of a course
+REFRESH_CHUNK_SORT = [("_id", ASCENDING)]
+
+
+class JobRunner:
+    def __init__(self, max_concurrency: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, job_type: str, fn: JobFunction, **params) -> str:
+        """Records a queued job, starts it in the background and returns its id."""
+        job_id = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        await jobs_collection.insert_one({
+            "_id": job_id,
+            "type": job_type,
+            "params": params,
+            "status": "queued",
+            "total": None,
+            "processed": 0,
+            "modified": 0,
+            "message": None,
+            "created_at": now,
+            "updated_at": now,
+        })
+        task = asyncio.create_task(self._run(job_id, job_type, fn, params))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        logger.info(f"JobRunner: Queued {job_type} job {job_id} with {params}")
+        return job_id
+
+    async def _finish(self, job_id: str, status: str, message: str):
+        now = datetime.now(timezone.utc)
+        await jobs_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": status, "message": message, "updated_at": now, "finished_at": now}},
+        )
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                await jobs_collection.update_one(
+                    {"_id": job_id}, {"$set": {"updated_at": datetime.now(timezone.utc)}}
+                )
+            except Exception as e:
+                logger.error(f"JobRunner: Heartbeat of job {job_id} failed: {e}")
+
+    async def _run(self, job_id: str, job_type: str, fn: JobFunction, params: Dict[str, Any]):
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            # Waiting for a slot is inside the try, so jobs cancelled while still queued are marked as failed too
+            async with self._semaphore:
+                await jobs_collection.update_one(
+                    {"_id": job_id},
+                    {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}},
+                )
+                message = await fn(Job(job_id), **params)
+        except asyncio.CancelledError:
+            await self._finish(job_id, "failed", "Interrupted by server shutdown.")
+            raise
+        except Exception as e:
+            logger.error(f"JobRunner: {job_type} job {job_id} failed: {e}")
+            await self._finish(job_id, "failed", str(e))
+            return
+        finally:
+            heartbeat.cancel()
+        logger.info(f"JobRunner: {job_type} job {job_id} completed: {message}")
+        await self._finish(job_id, "completed", message)
+
+    async def shutdown(self):
+        """Cancels jobs still queued or running in this worker; they are marked as failed."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": len(self._tasks)}
+
+
+job_runner = JobRunner(JOB_MAX_CONCURRENCY)
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """The job document; an unfinished job without a recent heartbeat is marked as failed first."""
+    doc = await jobs_collection.find_one({"_id": job_id})
+    if not doc or doc.get("status") not in ("queued", "running"):
+        return doc
+    updated_at = doc.get("updated_at")
+    if updated_at is not None and not updated_at.tzinfo:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    now = datetime.now(timezone.utc)
+    if updated_at is None or now - updated_at < timedelta(seconds=JOB_STALE_SECONDS):
+        return doc
+    logger.warning(f"JobRunner: Job {job_id} has had no heartbeat since {updated_at}; marking it as failed")
+    # Only if the heartbeat still hasn't moved, so a job that is just slow to report is left alone
+    await jobs_collection.update_one(
+        {"_id": job_id, "status": doc["status"], "updated_at": doc.get("updated_at")},
+        {"$set": {"status": "failed", "message": "The worker running this job stopped.", "updated_at": now, "finished_at": now}},
+    )
+    return await jobs_collection.find_one({"_id": job_id})
+
+
+# --- Jobs ---
+
+def stale_progress_filter(course_id: str, current_hash: str, after_id: Any = None) -> Dict[str, Any]:
+    """Progress documents of a course built from another manifest, optionally only those after `after_id`."""
+    query: Dict[str, Any] = {"course_id": course_id, "manifest_hash": {"$ne": current_hash}}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    return query
+
+
+async def refresh_course_progress_job(job: Job, course_id: str) -> str:
+    """
+    Re-syncs the progress documents of a course with its current lessons,
+    preserving watch times. Only documents whose `manifest_hash` differs from the
+    current manifest are touched, so a refresh with no lesson changes costs a
+    single indexed count. Documents built from the previous manifest get a plain
+    `$set` when lessons were only appended; v3 documents otherwise only unset
+    the watch times of lessons removed since their own manifest, and v1/v2
+    documents go through the rebuild pipelines. Work is done in `_id`-range chunks of
+    REFRESH_JOB_CHUNK_SIZE with a pause in between.
+    """
+    # Reads the lessons from MongoDB, not from the lesson cache
+    manifest = await publish_manifest(course_id)
+    current_hash = manifest.content_hash
+    previous = await get_manifest(course_id, manifest.version - 1) if manifest.version > 1 else None
+    appended = only_appends(previous, manifest)
+
+    stale = stale_progress_filter(course_id, current_hash)
+    total = await progress_collection.count_documents(stale)
+    await job.set_total(total)
+    if total == 0:
+        return f"Progress for course {course_id} is already up to date."
+
+    refreshed_at = datetime.now(timezone.utc)
+    v1_pipeline = refresh_array_watch_times_pipeline(
+        manifest.lesson_ids, manifest.lesson_duration, manifest.course_duration, refreshed_at, current_hash
+    )
+    v2_pipeline = refresh_keyed_watch_times_pipeline(
+        manifest.lesson_ids, manifest.lesson_duration, manifest.course_duration, refreshed_at, current_hash
+    )
+    # v3 documents only drop the keys of lessons that left since their own manifest
+    current_lessons = set(manifest.lesson_ids)
+    v3_pipelines = []
+    for version in await progress_collection.distinct("manifest_version", {**stale, **V3_FILTER}):
+        built_from = await get_manifest(course_id, version) if isinstance(version, int) else None
+        if built_from is not None:
+            removed = [lid for lid in built_from.lesson_ids if lid not in current_lessons]
+            v3_pipelines.append((version, refresh_manifest_watch_times_pipeline(manifest, refreshed_at, removed)))
+    known_versions = [version for version, _ in v3_pipelines]
+    v3_pipeline = refresh_manifest_watch_times_pipeline(manifest, refreshed_at)
+
+    modified_count = 0
+    last_id = None
+    while True:
+        query = stale_progress_filter(course_id, current_hash, last_id)
+        ids = [
+            doc["_id"]
+            async for doc in progress_collection.find(query, projection={"_id": 1}).sort(REFRESH_CHUNK_SORT).limit(REFRESH_JOB_CHUNK_SIZE)
+        ]
+        if not ids:
+            break
+        last_id = ids[-1]
+
+        chunk = {**stale, "_id": {"$gte": ids[0], "$lte": ids[-1]}}
+        requests = []
+        if appended:
+            # Ordered: documents fixed up here carry the current hash and no longer match the pipelines below
+            requests += [
+                UpdateMany({**chunk, **V3_FILTER, "manifest_hash": previous.content_hash}, append_lessons_update(manifest, 3, refreshed_at)),
+                UpdateMany({**chunk, **V2_FILTER, "manifest_hash": previous.content_hash}, append_lessons_update(manifest, 2, refreshed_at)),
+            ]
+        # One update per progress schema version
+        requests += [
+            UpdateMany({**chunk, **V1_FILTER}, v1_pipeline),
+            UpdateMany({**chunk, **V2_FILTER}, v2_pipeline),
+            *[
+                UpdateMany({**chunk, **V3_FILTER, "manifest_version": version}, pipeline)
+                for version, pipeline in v3_pipelines
+            ],
+            # Manifest unknown (or enrolled on another version meanwhile): rebuild the map
+            UpdateMany({**chunk, **V3_FILTER, "manifest_version": {"$nin": known_versions}}, v3_pipeline),
+        ]
+        result = await progress_collection.bulk_write(requests, ordered=True)
+        modified_count += result.modified_count
+        await job.advance(len(ids), result.modified_count)
+        if REFRESH_JOB_PAUSE_SECONDS > 0:
+            await asyncio.sleep(REFRESH_JOB_PAUSE_SECONDS)
+
+    return f"Successfully refreshed progress for {modified_count} users."
+
+
+async def enroll_cohort_job(job: Job, user_ids: List[str], templates: List[Dict[str, Any]]) -> str:
+    """
+    Enrolls `user_ids` for enroll_cohort: one progress upsert per (user, course),
+    built from `templates` (one progress document per course, without user). Writes
+    go out in unordered bulk writes of COHORT_ENROLLMENT_CHUNK_SIZE; a duplicate key
+    means a concurrent enrollment already created the document, so re-running a
+    cohort is safe. Users with failed writes are listed in the job message.
+    """
+    requests = []
+    owners = []
+    for uid in user_ids:
+        for template in templates:
+            requests.append(progress_upsert_request({**template, "user_id": uid}))
+            owners.append(uid)
+    total = len(requests)
+    await job.set_total(total)
+
+    failed: Dict[str, str] = {}
+    for start in range(0, total, COHORT_ENROLLMENT_CHUNK_SIZE):
+        chunk = requests[start:start + COHORT_ENROLLMENT_CHUNK_SIZE]
+        created = 0
+        try:
+            created = (await progress_collection.bulk_write(chunk, ordered=False)).upserted_count
+        except BulkWriteError as e:
+            created = e.details.get("nUpserted", 0)
+            for write_error in e.details.get("writeErrors", []):
+                if write_error.get("code") != 11000:
+                    failed.setdefault(owners[start + write_error["index"]], write_error.get("errmsg", "Write failed"))
+        except Exception as e:
+            logger.error(f"enroll_cohort_job: Chunk at {start}/{total} failed: {e}")
+            for index in range(start, start + len(chunk)):
+                failed.setdefault(owners[index], str(e))
+        await job.advance(len(chunk), created)
+
+    enrolled = len(user_ids) - len(failed)
+    message = f"Enrolled {enrolled} of {len(user_ids)} user(s) in {len(templates)} course(s)."
+    if failed:
+        listed = "; ".join(f"{uid}: {error}" for uid, error in list(failed.items())[:_COHORT_FAILURES_LISTED])
+        more = len(failed) - _COHORT_FAILURES_LISTED
+        message += f" Failed: {listed}" + (f" (and {more} more)" if more > 0 else "")
+        # Reported as a failed job, so the failures are not mistaken for a clean run
+        raise Exception(message)
+    return message
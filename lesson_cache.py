@@ -0,0 +1,140 @@
+# lesson_cache.py
+"""
+In-process cache of each course's video lessons (lesson_ids, durations, total).
+
+Lesson lists change rarely but are read on every enrollment. Entries expire
+after LESSON_CACHE_TTL_SECONDS and are replaced with fresh data whenever this
+worker publishes a manifest. Because each worker has its own copy, cached lists
+are only used to decide whether a course needs publishing
+(manifests.ensure_current_manifests); manifests are always built from MongoDB.
+
+With LESSON_CACHE_CHANGE_STREAM enabled (needs a replica set), a change stream
+on coursemodulelessons also invalidates the affected course as soon as one of
+its lessons changes.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import courselession_table
+from loaders import LessonData, load_lessons_by_course
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+LESSON_CACHE_TTL_SECONDS = float(os.getenv("LESSON_CACHE_TTL_SECONDS", "300"))
+LESSON_CACHE_MAX_ENTRIES = int(os.getenv("LESSON_CACHE_MAX_ENTRIES", "5000"))
+LESSON_CACHE_CHANGE_STREAM = os.getenv("LESSON_CACHE_CHANGE_STREAM", "false").lower() in {"true", "1", "yes"}
+
+
+class LessonCatalogCache:
+    """TTL + LRU cache of LessonData keyed by course id."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[LessonData, float]]" = OrderedDict()
+        self._watch_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get(self, course_id: str) -> Optional[LessonData]:
+        entry = self._entries.get(course_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self._entries.pop(course_id, None)
+            return None
+        self._entries.move_to_end(course_id)
+        return entry[0]
+
+    def _set(self, course_id: str, lessons: LessonData):
+        if self.ttl_seconds <= 0 or self.max_entries <= 0:
+            return
+        self._entries[course_id] = (lessons, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(course_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_many(self, course_ids: List[str]) -> List[LessonData]:
+        """Lessons for each course id; all cache misses are loaded in one query."""
+        found: Dict[str, LessonData] = {}
+        missing = []
+        for course_id in dict.fromkeys(str(c) for c in course_ids):
+            lessons = self._get(course_id)
+            if lessons is None:
+                missing.append(course_id)
+            else:
+                found[course_id] = lessons
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            for course_id, lessons in zip(missing, await load_lessons_by_course(missing)):
+                self._set(course_id, lessons)
+                found[course_id] = lessons
+        return [found[str(c)] for c in course_ids]
+
+    async def get(self, course_id: str) -> LessonData:
+        return (await self.get_many([course_id]))[0]
+
+    def put(self, course_id: str, lessons: LessonData):
+        """Stores a freshly read lesson list."""
+        self._set(str(course_id), lessons)
+
+    def invalidate(self, course_id: str):
+        if self._entries.pop(str(course_id), None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    # --- Optional change stream invalidation ---
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        try:
+            async with courselession_table.watch(pipeline, full_document="updateLookup") as stream:
+                logger.info("LessonCatalogCache: Watching coursemodulelessons for changes")
+                async for change in stream:
+                    course_id = (change.get("fullDocument") or {}).get("courseId")
+                    if course_id is not None:
+                        self.invalidate(str(course_id))
+                    else:
+                        # Deletes don't carry the lesson's courseId; drop everything to stay correct
+                        self.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # e.g. a standalone server without change stream support; TTL expiry still applies
+            logger.error(f"LessonCatalogCache: Change stream stopped: {e}")
+
+    def start_watching(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "change_stream": self._watch_task is not None and not self._watch_task.done(),
+        }
+
+
+lesson_cache = LessonCatalogCache(LESSON_CACHE_TTL_SECONDS, LESSON_CACHE_MAX_ENTRIES)
@@ -0,0 +1,98 @@
+# loaders.py
+"""
+Request-scoped DataLoaders. A new Loaders instance is created for every GraphQL
+request (see main.GraphQLContext), so all `load`/`load_many` calls made while
+resolving one request collapse into a single `$in` query per entity type.
+"""
+from bson import ObjectId
+from typing import Any, Dict, List, Optional, Tuple
+from strawberry.dataloader import DataLoader
+
+from db import (
+    users_collection,
+    courses_collection,
+    packages_collection,
+    courselession_table,
+)
+
+LessonData = Tuple[List[str], List[float], float]
+
+
+def _object_ids(keys: List[str]) -> List[ObjectId]:
+    return list({ObjectId(k) for k in keys if ObjectId.is_valid(k)})
+
+
+async def _load_by_id(collection, keys: List[str], projection: Optional[Dict[str, Any]] = None) -> List[Optional[dict]]:
+    docs_by_id: Dict[str, dict] = {}
+    object_ids = _object_ids(keys)
+    if object_ids:
+        async for doc in collection.find({"_id": {"$in": object_ids}}, projection=projection):
+            docs_by_id[str(doc["_id"])] = doc
+    return [docs_by_id.get(str(k)) for k in keys]
+
+
+async def load_users(keys: List[str]) -> List[Optional[dict]]:
+    # Never pull password hashes into resolvers
+    return await _load_by_id(users_collection, keys, projection={"password": 0})
+
+
+async def load_courses(keys: List[str]) -> List[Optional[dict]]:
+    return await _load_by_id(courses_collection, keys)
+
+
+async def load_packages(keys: List[str]) -> List[Optional[dict]]:
+    return await _load_by_id(packages_collection, keys)
+
+
+async def load_lessons_by_course(keys: List[str]) -> List[LessonData]:
+    """
+    Video lesson ids, durations and total duration for each course id, fetched
+    for all courses in one `$match courseId $in` + `$group` aggregation.
+    """
+    lessons: Dict[str, LessonData] = {str(k): ([], [], 0.0) for k in keys}
+    object_ids = _object_ids(keys)
+    if object_ids:
+        pipeline = [
+            {"$match": {"courseId": {"$in": object_ids}, "lessonType": "video"}},
+            # $push keeps input order; without a sort the lesson order could change between calls
+            {"$sort": {"courseId": 1, "_id": 1}},
+            {"$group": {
+                "_id": "$courseId",
+                "lesson_ids": {"$push": {"$toString": "$_id"}},
+                "durations": {"$push": {"$ifNull": ["$duration", 0]}},
+            }},
+        ]
+        async for group in courselession_table.aggregate(pipeline):
+            # Durations are converted here, not with $toDouble, so malformed values still count as 0
+            durations = []
+            for duration in group["durations"]:
+                try:
+                    durations.append(float(duration or 0))
+                except (TypeError, ValueError):
+                    durations.append(0.0)
+            lessons[str(group["_id"])] = (group["lesson_ids"], durations, sum(durations))
+    return [lessons[str(k)] for k in keys]
+
+
+class Loaders:
+    """One set of DataLoaders per request; never share across requests."""
+
+    def __init__(self):
+        self.user_by_id = DataLoader(load_fn=load_users)
+        self.course_by_id = DataLoader(load_fn=load_courses)
+        self.package_by_id = DataLoader(load_fn=load_packages)
+        self.lessons_by_course = DataLoader(load_fn=load_lessons_by_course)
+
+
+def get_loaders(info) -> Loaders:
+    """Returns the request's loaders, creating them if the context has none (e.g. direct calls)."""
+    context = info.context if info is not None else None
+    loaders = getattr(context, "loaders", None)
+    if loaders is None:
+        loaders = Loaders()
+        if context is not None:
+            try:
+                context.loaders = loaders
+            except AttributeError:
+                pass
+    return loaders
@@ -2,31 +2,91 @@
 # pip install "fastapi[all]" uvicorn
 # pip install "strawberry-graphql[fastapi]"
 
+import asyncio
+import os
 import uvicorn
-from fastapi import FastAPI, Request
-from strawberry.fastapi import GraphQLRouter
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from strawberry.fastapi import BaseContext, GraphQLRouter
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
 
 # Import the GraphQL schema
 from mutationss import schema
+import db
+from hashing import password_hasher
+from indexes import ensure_indexes
+from watch_buffer import WATCH_TIME_BUFFER_ENABLED, watch_time_buffer
+from manifests import manifest_cache
+from lesson_cache import LESSON_CACHE_CHANGE_STREAM, lesson_cache
+from jobs import job_runner
+from upload_cache import UPLOADS_DIR, upload_base64_cache
+from static_files import UploadFiles
+from images import image_processor
+
+# Create/verify MongoDB indexes on startup (idempotent). Disable for read-only replicas.
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "true").lower() in {"true", "1", "yes"}
 
 # ----------------- AUTHENTICATION CODE (COMMENTED FOR DEVELOPMENT) -----------------
-from authenticate import AuthenticatedUser, get_current_user
+from authenticate import AuthenticatedUser, get_current_user, token_cache
+from loaders import Loaders
 
-async def get_context(request: Request) -> dict:
-    current_user: Optional[AuthenticatedUser] = None
-    try:
-        current_user = get_current_user(request)
-    except Exception as e:
-        print(f"Authentication failed: {e}")
-    return {
-        "current_user": current_user,
-    }
+class GraphQLContext(BaseContext):
+    """
+    Per-request GraphQL context. The current user is resolved lazily the first
+    time a resolver awaits `get_current_user()`, so public resolvers never pay
+    for token verification. The result is memoized for the rest of the request.
+    Also carries the request-scoped DataLoaders.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._current_user_task: Optional[asyncio.Task] = None
+        self.loaders = Loaders()
+
+    async def _resolve_current_user(self) -> Optional[AuthenticatedUser]:
+        try:
+            return await get_current_user(self.request)
+        except Exception as e:
+            print(f"Authentication failed: {e}")
+            return None
+
+    async def get_current_user(self) -> Optional[AuthenticatedUser]:
+        if self._current_user_task is None:
+            self._current_user_task = asyncio.ensure_future(self._resolve_current_user())
+        return await self._current_user_task
+
+async def get_context() -> GraphQLContext:
+    return GraphQLContext()
 # -----------------------------------------------------------------------------------
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Each worker process opens its own MongoDB pool here, after any fork
+    await db.connect()
+    if ENSURE_INDEXES_ON_STARTUP:
+        try:
+            await ensure_indexes()
+        except Exception as e:
+            print(f"Index bootstrap failed: {e}")
+    if WATCH_TIME_BUFFER_ENABLED:
+        watch_time_buffer.start()
+    if LESSON_CACHE_CHANGE_STREAM:
+        lesson_cache.start_watching()
+    try:
+        yield
+    finally:
+        # Running jobs are marked failed so pollers don't wait forever
+        await job_runner.shutdown()
+        await lesson_cache.stop_watching()
+        # Write buffered heartbeats before the pool goes away
+        await watch_time_buffer.stop()
+        password_hasher.shutdown()
+        image_processor.shutdown()
+        db.close()
+
 # Create the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Allow only local React development server
 origins = [
@@ -63,11 +123,28 @@ graphql_app = GraphQLRouter(
 # Include the GraphQL router in the main app
 app.include_router(graphql_app, prefix="/graphql")
 
+# Uploaded images (bannerUrl / themeUrl point here); the folder is created on first upload
+app.mount("/uploads", UploadFiles(directory=UPLOADS_DIR, check_dir=False), name="uploads")
+
 # A basic root endpoint to confirm the app is running
 @app.get("/")
 async def root():
     return {"message": "Welcome to the FastAPI GraphQL Server!"}
 
+# In-process runtime metrics (worker pools, caches) for dashboards and load tests
+@app.get("/metrics")
+async def metrics():
+    return {
+        "auth_token_cache": token_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "watch_time_buffer": watch_time_buffer.stats(),
+        "lesson_manifests": manifest_cache.stats(),
+        "lesson_catalog": lesson_cache.stats(),
+        "jobs": job_runner.stats(),
+        "upload_base64": upload_base64_cache.stats(),
+        "image_processor": image_processor.stats(),
+    }
+
 if __name__ == "__main__":
     # Run the server using Uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,242 @@
+# manifests.py
+"""
+Versioned, shared lesson manifests.
+
+A manifest is one immutable version of a course's video lesson list
+(`lesson_ids`, `lesson_duration`, `course_duration`). Schema v3 progress
+documents only store `manifest_version` plus their watch times; readers join
+the manifest in memory. Because a (course_id, version) pair never changes,
+manifests can be cached indefinitely; only "which version is current" expires.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from pymongo.errors import DuplicateKeyError
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import lesson_manifests_collection
+from lesson_cache import lesson_cache
+from loaders import LessonData, load_lessons_by_course
+from models import LessonManifestModel
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+# How many (course, version) manifests are kept in memory, and how long the
+# "current version" of a course is trusted before asking MongoDB again.
+MANIFEST_CACHE_MAX_ENTRIES = int(os.getenv("MANIFEST_CACHE_MAX_ENTRIES", "2000"))
+MANIFEST_CURRENT_TTL_SECONDS = float(os.getenv("MANIFEST_CURRENT_TTL_SECONDS", "30"))
+
+
+class ManifestCache:
+    """LRU of immutable manifests plus a short-lived course -> current version map."""
+
+    def __init__(self, max_entries: int, current_ttl_seconds: float):
+        self.max_entries = max_entries
+        self.current_ttl_seconds = current_ttl_seconds
+        self._manifests: "OrderedDict[Tuple[str, int], LessonManifestModel]" = OrderedDict()
+        self._current: Dict[str, Tuple[int, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, course_id: str, version: int) -> Optional[LessonManifestModel]:
+        manifest = self._manifests.get((course_id, version))
+        if manifest is None:
+            self.misses += 1
+            return None
+        self._manifests.move_to_end((course_id, version))
+        self.hits += 1
+        return manifest
+
+    def current_version(self, course_id: str) -> Optional[int]:
+        entry = self._current.get(course_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def put(self, manifest: LessonManifestModel, current: bool = False):
+        key = (manifest.course_id, manifest.version)
+        self._manifests[key] = manifest
+        self._manifests.move_to_end(key)
+        while len(self._manifests) > self.max_entries:
+            self._manifests.popitem(last=False)
+        if current:
+            self._current[manifest.course_id] = (manifest.version, time.monotonic() + self.current_ttl_seconds)
+
+    def invalidate_current(self, course_id: str):
+        self._current.pop(course_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._manifests), "hits": self.hits, "misses": self.misses}
+
+
+manifest_cache = ManifestCache(MANIFEST_CACHE_MAX_ENTRIES, MANIFEST_CURRENT_TTL_SECONDS)
+
+
+async def get_manifest(course_id: str, version: int) -> Optional[LessonManifestModel]:
+    """Returns one specific manifest version, from memory when possible."""
+    manifest = manifest_cache.get(course_id, version)
+    if manifest is not None:
+        return manifest
+    doc = await lesson_manifests_collection.find_one({"course_id": course_id, "version": version})
+    if not doc:
+        return None
+    manifest = LessonManifestModel(**doc)
+    manifest_cache.put(manifest)
+    return manifest
+
+
+async def get_current_manifests(course_ids: List[str]) -> Dict[str, Optional[LessonManifestModel]]:
+    """Returns the newest manifest of each course (None if none was published yet), in one query for all cache misses."""
+    found: Dict[str, LessonManifestModel] = {}
+    missing = []
+    for course_id in course_ids:
+        version = manifest_cache.current_version(course_id)
+        manifest = manifest_cache.get(course_id, version) if version is not None else None
+        if manifest is not None:
+            found[course_id] = manifest
+        else:
+            missing.append(course_id)
+    if missing:
+        pipeline = [
+            {"$match": {"course_id": {"$in": missing}}},
+            {"$sort": {"course_id": 1, "version": -1}},
+            {"$group": {"_id": "$course_id", "doc": {"$first": "$$ROOT"}}},
+        ]
+        async for group in lesson_manifests_collection.aggregate(pipeline):
+            manifest = LessonManifestModel(**group["doc"])
+            manifest_cache.put(manifest, current=True)
+            found[manifest.course_id] = manifest
+    return {course_id: found.get(course_id) for course_id in course_ids}
+
+
+async def get_current_manifest(course_id: str) -> Optional[LessonManifestModel]:
+    """Returns the newest manifest of a course, or None if none was published yet."""
+    return (await get_current_manifests([course_id]))[course_id]
+
+
+def _same_lessons(manifest: Optional[LessonManifestModel], lessons: LessonData) -> bool:
+    return manifest is not None and manifest.lesson_ids == lessons[0] and manifest.lesson_duration == lessons[1]
+
+
+async def _publish(course_id: str, lessons: LessonData, current: Optional[LessonManifestModel]) -> LessonManifestModel:
+    for _ in range(3):
+        if _same_lessons(current, lessons):
+            return current
+
+        lesson_ids, lesson_durations, course_duration = lessons
+        manifest = LessonManifestModel(
+            course_id=course_id,
+            version=(current.version + 1) if current else 1,
+            lesson_ids=lesson_ids,
+            lesson_duration=lesson_durations,
+            course_duration=course_duration,
+            created_at=datetime.now(timezone.utc),
+        )
+        try:
+            # The unique (course_id, version) index makes this insert conditional on `current`
+            # still being the latest stored version
+            result = await lesson_manifests_collection.insert_one(manifest.model_dump(by_alias=True, exclude_none=True))
+        except DuplicateKeyError:
+            # Another worker published first. Our lesson list may be older than theirs, so
+            # re-read both before comparing again
+            manifest_cache.invalidate_current(course_id)
+            lessons = (await load_lessons_by_course([course_id]))[0]
+            lesson_cache.put(course_id, lessons)
+            current = await get_current_manifest(course_id)
+            continue
+        manifest.id = str(result.inserted_id)
+        manifest_cache.put(manifest, current=True)
+        logger.info(f"publish_manifest: Course {course_id} is now at manifest version {manifest.version} ({len(lesson_ids)} lessons)")
+        return manifest
+
+    raise Exception(f"Could not publish a lesson manifest for course {course_id}: too many concurrent publishers.")
+
+
+async def publish_manifests(course_ids: List[str]) -> Dict[str, LessonManifestModel]:
+    """
+    Reads the video lessons of all given courses straight from MongoDB (one
+    aggregation, never the per-worker lesson cache, which may be stale) and makes
+    them the current manifests. A new version is only inserted when the lesson
+    list differs from the latest stored version, so calling this repeatedly does
+    not create new versions and a stale caller can never roll a course back.
+    """
+    course_ids = list(dict.fromkeys(course_ids))
+    if not course_ids:
+        return {}
+    lessons = await load_lessons_by_course(course_ids)
+    for course_id, course_lessons in zip(course_ids, lessons):
+        # Fresh from the database; let this worker's cache benefit too
+        lesson_cache.put(course_id, course_lessons)
+        manifest_cache.invalidate_current(course_id)
+    current = await get_current_manifests(course_ids)
+    manifests = await asyncio.gather(*[
+        _publish(course_id, course_lessons, current[course_id])
+        for course_id, course_lessons in zip(course_ids, lessons)
+    ])
+    return dict(zip(course_ids, manifests))
+
+
+async def publish_manifest(course_id: str) -> LessonManifestModel:
+    """Single-course form of publish_manifests."""
+    return (await publish_manifests([course_id]))[course_id]
+
+
+async def ensure_current_manifests(course_ids: List[str]) -> Dict[str, LessonManifestModel]:
+    """
+    Current manifests for enrollment. When the (possibly stale) cached lesson list
+    of a course matches its current manifest, that manifest is used as is;
+    otherwise the course is published from fresh database reads. The cache only
+    decides whether to look closer, it is never the source of a manifest.
+    """
+    course_ids = list(dict.fromkeys(course_ids))
+    cached_lessons = await lesson_cache.get_many(course_ids)
+    manifests = await get_current_manifests(course_ids)
+    changed = [
+        course_id for course_id, lessons in zip(course_ids, cached_lessons)
+        if not _same_lessons(manifests[course_id], lessons)
+    ]
+    if changed:
+        manifests.update(await publish_manifests(changed))
+    return manifests
+
+
+async def ensure_current_manifest(course_id: str) -> LessonManifestModel:
+    """Single-course form of ensure_current_manifests."""
+    return (await ensure_current_manifests([course_id]))[course_id]
+
+
+def only_appends(previous: Optional[LessonManifestModel], manifest: LessonManifestModel) -> bool:
+    """True if `manifest` is `previous` with lessons added at the end (and nothing else changed)."""
+    if previous is None or len(manifest.lesson_ids) <= len(previous.lesson_ids):
+        return False
+    n = len(previous.lesson_ids)
+    return manifest.lesson_ids[:n] == previous.lesson_ids and manifest.lesson_duration[:n] == previous.lesson_duration
+
+
+async def join_manifest(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fills `lesson_ids`, `lesson_duration` and `course_duration` of a v3 progress
+    document from its manifest, so it can be read like older documents. Other
+    documents are returned unchanged. Watch times of lessons no longer in the
+    manifest are ignored and the total is clamped to the course duration.
+    """
+    if doc.get("manifest_version") is None:
+        return doc
+    manifest = await get_manifest(doc["course_id"], doc["manifest_version"])
+    if manifest is None:
+        raise Exception(f"Lesson manifest {doc['manifest_version']} of course {doc['course_id']} not found.")
+    keyed = doc.get("lesson_watch_times") or {}
+    total = sum(float(keyed.get(lid, 0) or 0) for lid in manifest.lesson_ids)
+    return {
+        **doc,
+        "lesson_ids": manifest.lesson_ids,
+        "lesson_duration": manifest.lesson_duration,
+        "course_duration": manifest.course_duration,
+        "total_watch_time": min(total, manifest.course_duration) if manifest.course_duration else total,
+    }
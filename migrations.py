@@ -0,0 +1,177 @@
+# migrations.py
+"""
+One-off data migrations. Each migration is idempotent and safe to re-run.
+
+    python migrations.py users_created_at
+    python migrations.py progress_keyed_watch_times
+    python migrations.py progress_lesson_manifests
+    python migrations.py progress_unique_user_course
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from typing import Any, Dict, List
+
+import db
+from db import progress_collection, users_collection
+from indexes import INDEXES
+from manifests import publish_manifest
+from progress import PROGRESS_SCHEMA_VERSION, V1_FILTER, V2_FILTER, keyed_watch_times_from_array_expression
+
+logger = logging.getLogger('MutationsLogger')
+
+# Documents converted per update_many, and the pause between batches to keep load on the primary low
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))
+MIGRATION_BATCH_PAUSE_SECONDS = float(os.getenv("MIGRATION_BATCH_PAUSE_SECONDS", "0.05"))
+
+
+async def backfill_user_created_at() -> int:
+    """
+    Older user documents only carry `created_at` (or nothing at all). The users
+    listing pages on `createdAt`, so copy it over, falling back to `updatedAt`
+    and finally the ObjectId timestamp.
+    """
+    result = await users_collection.update_many(
+        {"createdAt": {"$exists": False}},
+        [{
+            "$set": {
+                "createdAt": {
+                    "$ifNull": [
+                        "$created_at",
+                        {"$ifNull": ["$updatedAt", {"$toDate": "$_id"}]}
+                    ]
+                }
+            }
+        }]
+    )
+    logger.info(f"backfill_user_created_at: Updated {result.modified_count} user(s)")
+    return result.modified_count
+
+
+async def _update_in_batches(name: str, query: Dict[str, Any], pipeline: List[Dict[str, Any]]) -> int:
+    """
+    Applies a pipeline update to every document matching `query`, streaming `_id`s
+    in batches so no single write runs for long. The query is re-checked on write,
+    so documents converted concurrently are skipped.
+    """
+    converted = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        ids = [
+            doc["_id"]
+            async for doc in progress_collection.find(batch_query, projection={"_id": 1}).sort("_id", 1).limit(MIGRATION_BATCH_SIZE)
+        ]
+        if not ids:
+            break
+        last_id = ids[-1]
+
+        result = await progress_collection.update_many({**query, "_id": {"$in": ids}}, pipeline)
+        converted += result.modified_count
+        logger.info(f"{name}: Converted {converted} document(s) so far")
+        if MIGRATION_BATCH_PAUSE_SECONDS > 0:
+            await asyncio.sleep(MIGRATION_BATCH_PAUSE_SECONDS)
+    return converted
+
+
+async def migrate_progress_keyed_watch_times() -> int:
+    """
+    Converts v1 courseprogress documents (parallel `watch_times` array) to the v2
+    layout with `lesson_watch_times` keyed by lesson id. Each batch is converted
+    server-side with a pipeline update, so a heartbeat landing mid-migration is
+    never overwritten with stale values.
+    """
+    return await _update_in_batches(
+        "migrate_progress_keyed_watch_times",
+        V1_FILTER,
+        [
+            {
+                "$set": {
+                    "lesson_watch_times": keyed_watch_times_from_array_expression(),
+                    "schema_version": 2,
+                }
+            },
+            {"$unset": "watch_times"},
+        ],
+    )
+
+
+async def migrate_progress_lesson_manifests() -> int:
+    """
+    Converts v1/v2 courseprogress documents to v3: publishes the current lesson
+    manifest of each course, points the documents at it and drops their private
+    copies of `lesson_ids`, `lesson_duration` and `course_duration`.
+    """
+    legacy = {"$or": [V1_FILTER, V2_FILTER]}
+    converted = 0
+    for course_id in await progress_collection.distinct("course_id", legacy):
+        manifest = await publish_manifest(course_id)
+        converted += await _update_in_batches(
+            f"migrate_progress_lesson_manifests[{course_id}]",
+            {"course_id": course_id, **legacy},
+            [
+                {
+                    "$set": {
+                        "lesson_watch_times": {"$ifNull": ["$lesson_watch_times", keyed_watch_times_from_array_expression()]},
+                        "schema_version": PROGRESS_SCHEMA_VERSION,
+                        "manifest_version": manifest.version,
+                        "manifest_hash": manifest.content_hash,
+                    }
+                },
+                {"$unset": ["watch_times", "lesson_ids", "lesson_duration", "course_duration"]},
+            ],
+        )
+    return converted
+
+
+async def progress_unique_user_course() -> int:
+    """
+    Prepares courseprogress for the unique (user_id, course_id) index: removes
+    duplicate enrollments (keeping the document with the most watch time),
+    replaces the old non-unique index and creates the unique one.
+    """
+    removed = 0
+    pipeline = [
+        {"$sort": {"total_watch_time": -1, "_id": 1}},
+        {"$group": {"_id": {"user_id": "$user_id", "course_id": "$course_id"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    async for group in progress_collection.aggregate(pipeline, allowDiskUse=True):
+        result = await progress_collection.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    logger.info(f"progress_unique_user_course: Removed {removed} duplicate progress document(s)")
+
+    if "user_id_course_id" in await progress_collection.index_information():
+        await progress_collection.drop_index("user_id_course_id")
+    unique_index = next(m for m in INDEXES["courseprogress"] if m.document["name"] == "user_id_course_id_unique")
+    await progress_collection.create_indexes([unique_index])
+    return removed
+
+
+MIGRATIONS = {
+    "users_created_at": backfill_user_created_at,
+    "progress_keyed_watch_times": migrate_progress_keyed_watch_times,
+    "progress_lesson_manifests": migrate_progress_lesson_manifests,
+    "progress_unique_user_course": progress_unique_user_course,
+}
+
+
+async def _main(names) -> int:
+    for name in names:
+        count = await MIGRATIONS[name]()
+        print(f"{name}: {count} document(s) updated")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run one-off data migrations.")
+    parser.add_argument("migrations", nargs="+", choices=sorted(MIGRATIONS))
+    parsed = parser.parse_args()
+    try:
+        sys.exit(asyncio.run(_main(parsed.migrations)))
+    finally:
+        db.close()
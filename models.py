@@ -1,6 +1,8 @@
-from pydantic import BaseModel, Field, EmailStr,field_validator
+import hashlib
+import json
+from pydantic import BaseModel, Field, EmailStr,field_validator, model_validator
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 from bson import ObjectId
 
 # --- Database Models (Pydantic) ---
@@ -29,7 +31,7 @@ class UserModel(BaseModel):
     is_active: bool = Field(default=True, alias="isActive")
     is_deleted: bool = Field(default=False, alias="isDeleted")
     deleted_at: Optional[datetime] = Field(default=None, alias="deleted_at")
-    created_at: datetime = Field(default_factory=datetime.utcnow, alias="created_at")
+    created_at: datetime = Field(default_factory=datetime.utcnow, alias="createdAt")
 
     class Config:
         populate_by_name = True
@@ -71,6 +73,9 @@ class PackageModel(BaseModel):
     thumbnail_url: Optional[str] = Field(alias="thumbnailUrl", default=None)
     banner_url: Optional[str] = Field(alias="bannerUrl", default=None)
     theme_url: Optional[str] = Field(alias="themeUrl", default=None)
+    # {size: {format: url}} generated at upload time (see images.py)
+    banner_renditions: Optional[Dict[str, Dict[str, str]]] = Field(alias="bannerRenditions", default=None)
+    theme_renditions: Optional[Dict[str, Dict[str, str]]] = Field(alias="themeRenditions", default=None)
     is_active: bool = Field(default=True, alias="isActive")
     is_deleted: bool = Field(default=False, alias="isDeleted")
     created_at: datetime = Field(default_factory=datetime.utcnow, alias="createdAt")
@@ -164,6 +169,27 @@ class CourseProgressModel(BaseModel):
     total_watch_time: float
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    # --- Schema v2: watch times keyed by lesson id (see progress.py) ---
+    schema_version: Optional[int] = None
+    lesson_watch_times: Optional[Dict[str, float]] = None
+    # --- Schema v3: lesson data lives in the shared lesson manifest (see manifests.py) ---
+    manifest_version: Optional[int] = None
+    # LessonManifestModel.content_hash of the lesson list the document was last built from
+    manifest_hash: Optional[str] = None
+
+    @model_validator(mode='before')
+    @classmethod
+    def expand_keyed_watch_times(cls, data):
+        """Accepts v2/v3 documents by deriving the `watch_times` list from `lesson_watch_times`."""
+        if isinstance(data, dict) and data.get("lesson_watch_times") is not None and "watch_times" not in data:
+            keyed = data["lesson_watch_times"]
+            data = {
+                **data,
+                "watch_times": [
+                    {"lesson_id": lid, "watch_time": keyed.get(lid, 0.0)} for lid in data.get("lesson_ids", [])
+                ],
+            }
+        return data
 
     # --- ⭐️ ADD THIS VALIDATOR ⭐️ ---
     @field_validator('id', mode='before')
@@ -177,4 +203,33 @@ class CourseProgressModel(BaseModel):
     class Config:
         # This tells Pydantic to allow the 'id' field to be
         # populated by the '_id' alias when loading from a dict.
-        populate_by_name = True
\ No newline at end of file
+        populate_by_name = True
+
+class LessonManifestModel(BaseModel):
+    """
+    One immutable version of a course's video lesson list. Progress documents
+    (schema v3) reference it by (course_id, version) instead of copying it.
+    """
+    id: Optional[str] = Field(alias="_id", default=None)
+    course_id: str
+    version: int
+    lesson_ids: List[str]
+    lesson_duration: List[float]
+    course_duration: float
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+    @property
+    def content_hash(self) -> str:
+        """Hash of the lesson list; progress documents store it as `manifest_hash` to tell whether they are current."""
+        payload = json.dumps([self.lesson_ids, [float(d) for d in self.lesson_duration]], separators=(",", ":"))
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    @field_validator('id', mode='before')
+    @classmethod
+    def convert_objectid_to_str(cls, v):
+        if isinstance(v, ObjectId):
+            return str(v)
+        return v
+
+    class Config:
+        populate_by_name = True
@@ -1,18 +1,19 @@
-import bcrypt
 import strawberry
 import base64
 import uuid
 import os
-from PIL import Image
-from typing import List, Optional, Union,Dict,Any,Set,Tuple
+from typing import List, Optional, Union,Dict,Any,Tuple
 from datetime import datetime, timedelta
 from bson import ObjectId
-from pymongo.errors import PyMongoError
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
 from pydantic import ValidationError
 from strawberry.file_uploads import Upload
 from dotenv import load_dotenv
 import jwt
+import json
 import re
+import asyncio
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from collections import Counter
@@ -33,6 +34,8 @@ logger.addHandler(handler)
 
 load_dotenv()
 JWT_SECRET = os.getenv("JWT_SECRET")
+# Most distinct user ids a single enroll_cohort call accepts
+COHORT_ENROLLMENT_MAX_USERS = int(os.getenv("COHORT_ENROLLMENT_MAX_USERS", "10000"))
 
 # Import the database connection and Pydantic models
 from db import (
@@ -43,7 +46,6 @@ from db import (
     courses_collection,
     purchased_collection,
     courseprice_collection,
-    courselession_table,
     progress_collection
    
 )
@@ -59,12 +61,66 @@ from models import (
     CourseWatchModel
 )
 
+from hashing import hash_password, check_password
+from loaders import get_loaders
+from upload_cache import upload_base64_cache
+from images import ImageRejected, Renditions, image_processor, release_upload, rendition_url
+from jobs import enroll_cohort_job, get_job, job_runner, refresh_course_progress_job
+from analytics import compute_purchase_analytics, read_purchase_rollups, record_purchase_change
+from progress import (
+    PROGRESS_SCHEMA_VERSION,
+    V3_FILTER,
+    keyed_watch_time_update_pipeline,
+    progress_document,
+    progress_upsert_request,
+    watch_time_guard_filter,
+    watch_time_update_pipeline,
+    watch_time_update_requests,
+)
+from watch_buffer import WATCH_TIME_BUFFER_ENABLED, watch_time_buffer
+from manifests import ensure_current_manifest, ensure_current_manifests, get_current_manifest, join_manifest
+
 # ----------------- AUTHENTICATION CODE (COMMENTED FOR DEVELOPMENT) -----------------
-from authenticate import AuthenticatedUser
+from authenticate import AuthenticatedUser, revoke_user_tokens
+from user_queries import (
+    ACTIVE_USERS_FILTER,
+    DELETED_USERS_FILTER,
+    USERS_LIST_SORT,
+    and_filter,
+    encode_cursor,
+    keyset_after_filter,
+    users_list_filters,
+)
 # -----------------------------------------------------------------------------------
 
 # --- GraphQL Types ---
 
+@strawberry.type
+class CohortEnrollmentResult:
+    """
+    Outcome of enroll_cohort for one user.
+    """
+    user_id: str
+    success: bool
+    message: Optional[str] = None
+    course_count: int = 0
+
+@strawberry.type
+class CohortEnrollmentResponse:
+    """
+    Response from the enroll_cohort mutation. The enrollment itself runs as a
+    background job; poll jobStatus(jobId) for its progress and outcome.
+    `results` lists the users rejected before the job started (e.g. unknown ids),
+    `queued_count` the users handed to the job.
+    """
+    success: bool
+    message: str
+    enrolled_count: int
+    failed_count: int
+    results: List[CohortEnrollmentResult]
+    queued_count: int = 0
+    job_id: Optional[str] = None
+
 @strawberry.type
 class RefreshProgressResponse:
     """
@@ -73,6 +129,27 @@ class RefreshProgressResponse:
     success: bool
     message: str
     updated_count: int
+    # Background job doing the refresh; poll jobStatus(jobId) for progress
+    job_id: Optional[str] = None
+
+@strawberry.type
+class JobStatusType:
+    """
+    Progress of a background job started by a mutation (see jobs.py).
+    status is one of queued, running, completed or failed. updated_at is the
+    last heartbeat or progress report; jobs whose worker died are reported as failed.
+    """
+    id: str
+    type: str
+    status: str
+    total: Optional[int] = None
+    processed: int = 0
+    modified: int = 0
+    message: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
 
 @strawberry.type
 class LessonPercentageType:
@@ -157,10 +234,15 @@ class PackageDetailsType:
     id: str = strawberry.field(name="_id")
     title: str
     description: Optional[str] = None
-    banner_url: Optional[str] = strawberry.field(name="bannerUrl")
-    theme_url: Optional[str] = strawberry.field(name="themeUrl")
-    banner_base64: Optional[str] = None
-    theme_base64: Optional[str] = None
+    # Original upload URLs plus their renditions ({size: {format: url}}); see bannerUrl / themeUrl
+    banner_url_value: strawberry.Private[Optional[str]] = None
+    theme_url_value: strawberry.Private[Optional[str]] = None
+    banner_renditions: strawberry.Private[Optional[Dict[str, Dict[str, str]]]] = None
+    theme_renditions: strawberry.Private[Optional[Dict[str, Dict[str, str]]]] = None
+    # Already-encoded images (e.g. right after an upload). When None, bannerBase64 /
+    # themeBase64 are read from bannerUrl / themeUrl, and only if the client selects them.
+    banner_base64_value: strawberry.Private[Optional[str]] = None
+    theme_base64_value: strawberry.Private[Optional[str]] = None
     is_active: bool = strawberry.field(name="isActive")
     is_deleted: bool = strawberry.field(name="isDeleted")
     is_draft: bool = strawberry.field(name="isDraft")
@@ -183,6 +265,31 @@ class PackageDetailsType:
     faqs: Optional[List['FaqType']] = None
 
     purchase_count: Optional[int] = 0   # ✅ NEW FIELD
+
+    @strawberry.field(name="bannerUrl")
+    def banner_url(self, size: Optional[str] = None, format: Optional[str] = None) -> Optional[str]:
+        """
+        Original banner, or a rendition: size e.g. thumb/card/full, format e.g. webp/jpeg.
+        Unknown sizes/formats are an error; a rendition this image lacks returns the original.
+        """
+        return rendition_url(self.banner_url_value, self.banner_renditions, size, format)
+
+    @strawberry.field(name="themeUrl")
+    def theme_url(self, size: Optional[str] = None, format: Optional[str] = None) -> Optional[str]:
+        """Original theme image, or a rendition (see bannerUrl)."""
+        return rendition_url(self.theme_url_value, self.theme_renditions, size, format)
+
+    @strawberry.field
+    async def banner_base64(self) -> Optional[str]:
+        if self.banner_base64_value is not None:
+            return self.banner_base64_value
+        return await upload_base64_cache.get(self.banner_url_value)
+
+    @strawberry.field
+    async def theme_base64(self) -> Optional[str]:
+        if self.theme_base64_value is not None:
+            return self.theme_base64_value
+        return await upload_base64_cache.get(self.theme_url_value)
     
 
     
@@ -318,6 +425,14 @@ class UserListResponse:
     ## new added
     deleted_count: int
     deleted_users: List[UserType]
+    # Keyset pagination: pass next_cursor back as `after` to fetch the next page
+    next_cursor: Optional[str] = None
+    has_more: bool = False
+    # Users matching the active / is_deleted filters, across all pages
+    matching_count: int = 0
+    # Same for deleted_users: pass deleted_next_cursor back as `deleted_after`
+    deleted_next_cursor: Optional[str] = None
+    deleted_has_more: bool = False
 
 @strawberry.type
 class StatusCountType:
@@ -342,6 +457,30 @@ class UpdateWatchTimeResponse:
     """
     success: bool
     message: Optional[str] = None
+    # Course progress after the update; not set when the update was only queued
+    total_progress_percent: Optional[float] = None
+
+@strawberry.type
+class LessonWatchTimeResult:
+    """
+    Outcome of a single item in an updateLessonWatchTimes batch.
+    """
+    user_id: str
+    course_id: str
+    lesson_id: str
+    success: bool
+    message: Optional[str] = None
+
+@strawberry.type
+class UpdateWatchTimesResponse:
+    """
+    The response from an updateLessonWatchTimes mutation. `results` is in the
+    same order as the submitted items.
+    """
+    success: bool
+    message: str
+    updated_count: int
+    results: List[LessonWatchTimeResult]
 
 # @strawberry.experimental.pydantic.type(model=CourseWatchModel, all_fields=True)
 # class CourseWatchType:
@@ -519,10 +658,12 @@ def _map_package_doc_to_type(doc: Dict[str, Any]) -> PackageDetailsType:
         id=str(doc.get("_id")),
         title=doc.get("title") or "",
         description=doc.get("description"),
-        banner_url=doc.get("bannerUrl"),
-        theme_url=doc.get("themeUrl"),
-        banner_base64=doc.get("banner_base64"),
-        theme_base64=doc.get("theme_base64"),
+        banner_url_value=doc.get("bannerUrl"),
+        theme_url_value=doc.get("themeUrl"),
+        banner_renditions=doc.get("bannerRenditions"),
+        theme_renditions=doc.get("themeRenditions"),
+        banner_base64_value=doc.get("banner_base64"),
+        theme_base64_value=doc.get("theme_base64"),
         is_active=bool(doc.get("isActive", True)),
         is_deleted=bool(doc.get("isDeleted", False)),
         is_draft=bool(doc.get("isDraft", False)),
@@ -561,85 +702,58 @@ async def get_course_details_by_ids(course_ids: List[str]) -> List[dict]:
 
 # --- Helper Functions for File Handling ---
 
-async def save_and_compress_file(upload: Upload, subfolder: str) -> str:
+async def save_and_compress_file(upload: Upload, subfolder: str) -> Tuple[str, Renditions]:
     """
-    Saves an uploaded file to a subfolder, compresses it, and returns its URL.
+    Saves an uploaded file to a subfolder, compresses it, and returns its URL
+    along with the URLs of its renditions ({size: {format: url}}).
+    Raises ImageRejected for files that are too large or not images.
     """
     logger.info(f"Entering save_and_compress_file with filename: {upload.filename}, subfolder: {subfolder}")
-    extension = upload.filename.split(".")[-1]
-    # print('extension:',extension)
-    filename = f"{uuid.uuid4()}.{extension}"
-    folder_path = os.path.join("uploads", subfolder)
-    os.makedirs(folder_path, exist_ok=True)
-    file_path = os.path.join(folder_path, filename)
-
-    content = await upload.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
-
-    image = Image.open(file_path)
-    image.save(file_path, optimize=True, quality=60)
-
-    result = f"/uploads/{subfolder}/{filename}"
-    # print('result:',result)
-    logger.info(f"save_and_compress_file: File saved successfully at {result}")
-    return result
-
-async def delete_previous_file(file_path: Optional[str]):
+    result, renditions = await image_processor.save_upload(upload, subfolder)
+    logger.info(f"save_and_compress_file: File saved successfully at {result} with renditions {list(renditions)}")
+    return result, renditions
+
+async def delete_previous_file(file_path: Optional[str], renditions: Optional[Renditions] = None):
     """
-    Deletes a file if the path exists and is not a default or null value.
+    Releases one reference to an uploaded file. Uploads are content-addressed and
+    shared between packages, so the file (and its renditions) is only deleted
+    when the last package stops using it.
     """
     logger.info(f"Entering delete_previous_file with file_path: {file_path}")
-    if file_path and os.path.exists(file_path):
-        os.remove(file_path)
+    if not file_path:
+        logger.info("delete_previous_file: No file deleted, path is None")
+        return
+    if await release_upload("/" + file_path.lstrip('/'), renditions):
         logger.info(f"delete_previous_file: File deleted at {file_path}")
     else:
-        logger.info(f"delete_previous_file: No file deleted, path {file_path} does not exist or is None")
+        logger.info(f"delete_previous_file: File at {file_path} kept, it is still referenced or does not exist")
+
+async def delete_stored_image(url: Optional[str], renditions: Optional[Renditions] = None):
+    """Releases an uploaded image together with its renditions."""
+    if url:
+        await delete_previous_file(url.lstrip('/'), renditions)
 
 
-async def fetch_video_lessons_data(course_id: str) -> Tuple[List[str], List[float], float]:
+# Fields _validate_watch_time needs, for v1/v2 documents directly and for v3 via join_manifest
+_WATCH_TIME_VALIDATION_PROJECTION = {"course_id": 1, "lesson_ids": 1, "lesson_duration": 1, "manifest_version": 1}
+
+def _validate_watch_time(doc: Dict[str, Any], lesson_id: str, new_watch_time: float) -> Optional[str]:
     """
-    Fetches lesson IDs and durations for all 'video' lessons in a course.
+    Checks a watch time against the lesson duration stored on a progress document.
+    Returns an error message, or None when the update is allowed.
     """
+    lesson_ids = doc.get("lesson_ids", [])
+    lesson_durations = doc.get("lesson_duration", [])
     try:
-        # We need to convert the string ID back to an ObjectId for the query
-        course_oid = ObjectId(course_id) 
-    except:
-        # Handle case where course_id is not a valid ObjectId format
-        print(f"Invalid course_id format: {course_id}")
-        return [], [], 0.0
-
-    try:
-        pipeline = [
-            {"$match": {
-                "courseId": course_oid, 
-                "lessonType": "video"
-            }},
-            {"$project": {
-                "_id": 1, 
-                "duration": 1  # Ensure this field exists and is numeric
-            }}
-        ]
-        
-        lesson_ids = []
-        lesson_durations = []
-        total_duration = 0.0
-
-        async for doc in courselession_table.aggregate(pipeline):
-            lesson_id = str(doc['_id']) 
-            # Safely convert duration to float, default to 0 if missing/invalid
-            duration = float(doc.get('duration', 0) or 0) 
-            
-            lesson_ids.append(lesson_id)
-            lesson_durations.append(duration)
-            total_duration += duration
-            
-        return lesson_ids, lesson_durations, total_duration
-
-    except Exception as e:
-        # Better to use a proper logger here!
-        print(f"Error fetching lessons for course {course_id}: {e}")
-        return [], [], 0.0
+        lesson_index = lesson_ids.index(lesson_id)
+    except ValueError:
+        return f"Lesson ID {lesson_id} not found in lesson_ids array."
+    if lesson_index >= len(lesson_durations):
+        return "Data mismatch: lesson_ids and lesson_duration arrays have different lengths."
+    max_duration = lesson_durations[lesson_index]
+    if new_watch_time > max_duration:
+        return f"VALIDATION FAILED: New watch time ({new_watch_time}) exceeds lesson duration ({max_duration})."
+    return None
     
 def parse_period_to_expiry_date(period_str: Optional[str]) -> Optional[datetime]:
     """
@@ -681,6 +795,65 @@ def parse_period_to_expiry_date(period_str: Optional[str]) -> Optional[datetime]
     
     return None
 
+def _package_expiry_date(package_doc: Dict[str, Any], expiry: Optional[str]) -> Optional[datetime]:
+    """
+    Expiry for a package enrollment: the caller's `expiry` string if given,
+    otherwise the period of the package's first price option.
+    """
+    package_expiry_date: Optional[datetime] = None
+    
+    if expiry:
+        # 1. Use user-provided expiry if it exists
+        # Changed to logger.info
+        logger.info(f"User provided an expiry for the package: '{expiry}'")
+        package_expiry_date = parse_period_to_expiry_date(expiry)
+        if not package_expiry_date:
+            # Changed to logger.warning
+            logger.warning(f"Could not parse user-provided expiry string '{expiry}'. Expiry will be null.")
+    
+    else:
+        # 2. Fallback to package document if no expiry was passed
+        # Changed to logger.info
+        logger.info("No expiry provided by user. Checking package document...")
+        try:
+            period_str = (package_doc.get("price_details", [{}])[0]).get("period")
+            if period_str:
+                package_expiry_date = parse_period_to_expiry_date(period_str)
+                # Changed to logger.info
+                logger.info(f"Package expiry set from DB: {package_expiry_date} (from '{period_str}')")
+            else:
+                # Changed to logger.info
+                logger.info("No period found in package document. Expiry will be null.")
+        except Exception as e:
+            # Changed to logger.warning
+            logger.warning(f"Error parsing package expiry from DB: {e}. Expiry will be null.")
+    return package_expiry_date
+
+def _new_progress_model(
+    user_id: str,
+    course_id: str,
+    manifest,
+    expiry: Optional[datetime],
+    package_id: Optional[str],
+) -> CourseProgressModel:
+    """A fresh (v3) progress document for one user and course, with zero watch time."""
+    return CourseProgressModel(
+        user_id=user_id,
+        course_id=course_id,
+        lesson_ids=manifest.lesson_ids,
+        lesson_duration=manifest.lesson_duration,
+        course_duration=manifest.course_duration,
+        watch_times=[CourseWatchModel(lesson_id=lid, watch_time=0.0) for lid in manifest.lesson_ids],
+        total_watch_time=0.0,
+        expiry=expiry,
+        package_id=package_id,
+        schema_version=PROGRESS_SCHEMA_VERSION,
+        manifest_version=manifest.version,
+        manifest_hash=manifest.content_hash,
+        # Only watched lessons get a key (see progress.py)
+        lesson_watch_times={}
+    )
+
 def calculate_progress_percentage(watch_time: float, duration: float) -> float:
     """
     A reusable helper function to calculate progress.
@@ -700,21 +873,32 @@ class Query:
     async def all_users(
         self,
         active: Optional[bool] = None,          # None -> all; True -> only active; False -> only inactive (explicit)
-        is_deleted: Optional[bool] = None       # None -> both; True -> only deleted; False -> only non-deleted (for users list only)
+        is_deleted: Optional[bool] = None,      # None -> both; True -> only deleted; False -> only non-deleted (for users list only)
+        first: int = 50,                        # page size (capped at 500)
+        after: Optional[str] = None,            # next_cursor of the previous page
+        deleted_after: Optional[str] = None     # deleted_next_cursor of the previous page
     ) -> UserListResponse:
         """
         - Counts are computed over non-deleted users (total_count, active_count), plus:
-          deleted_count: number of deleted users.
-        - users list:
+          deleted_count: number of deleted users. The filters do NOT change them.
+        - matching_count: number of users matching `active` / `is_deleted` (all pages).
+        - users list (one page, keyset-paginated on createdAt desc, _id desc):
             * filtered by `active` as requested
                 - active=True  -> users with isActive truthy
                 - active=False -> users that EXPLICITLY have isActive present AND falsy
                 - active=None  -> ignore isActive for the list
-            * optional `is_deleted` filter for the list (does NOT change counts)
-        - deleted_users list: always returned (all deleted users), sorted by createdAt desc.
+            * optional `is_deleted` filter for the list
+            * pass `next_cursor` back as `after` to get the next page
+        - deleted_users list: one page (`first`) of deleted users, sorted by createdAt desc;
+          pass `deleted_next_cursor` back as `deleted_after` to get the next page.
+        All filtering and sorting happens in MongoDB, so cost stays flat as users grow.
         """
-        logger.info("Entering all_users query")
+        logger.info(
+            f"Entering all_users query with active={active}, is_deleted={is_deleted}, first={first}, "
+            f"after={after}, deleted_after={deleted_after}"
+        )
         try:
+            page_size = max(1, min(first or 50, 500))
             base_projection = {
                 "_id": 1,
                 "name": 1,
@@ -729,29 +913,16 @@ class Query:
                 "createdAt": 1, "created_at": 1, "updatedAt": 1,
             }
 
-            # Pull ALL users once (both deleted and non-deleted), so we can form all views consistently.
-            cursor = users_collection.find({}, projection=base_projection)
-
             def norm_bool(v) -> bool:
                 if isinstance(v, bool): return v
                 if isinstance(v, (int, float)): return v == 1
                 if isinstance(v, str): return v.strip().lower() in {"true", "1", "yes", "y", "active"}
                 return False
 
-            def has_is_active_field(doc: Dict[str, Any]) -> bool:
-                # True only if the key exists in the document
-                return "isActive" in doc
-
             def pick_phone(u: dict) -> str:
                 return str(u.get("phone") or u.get("mobile") or u.get("contact") or u.get("phoneNumber") or "")
 
             def stringify_id(v) -> str:
-                try:
-                    from bson import ObjectId
-                    if isinstance(v, ObjectId):
-                        return str(v)
-                except Exception:
-                    pass
                 return "" if v is None else str(v)
 
             def safe_dt(*candidates) -> datetime:
@@ -773,57 +944,56 @@ class Query:
                     created_at=safe_dt(doc.get("createdAt"), doc.get("created_at"), doc.get("updatedAt")),
                 )
 
-            # Load & normalize all docs, and also keep flags for presence checks
-            all_docs: List[Dict[str, Any]] = []
-            async for u in cursor:
-                all_docs.append(u)
-
-            all_users_norm: List[UserType] = [to_user_type(d) for d in all_docs]
+            # --- Build the main 'users' filter per args (shared with the index explain check) ---
+            list_filters = users_list_filters(active, is_deleted)
+
+            # What matching_count counts: the whole filtered list, not just this page
+            count_query = and_filter(list(list_filters)) or None
+
+            if after:
+                list_filters.append(keyset_after_filter(after))
+
+            list_query = and_filter(list_filters)
+            deleted_query = and_filter([DELETED_USERS_FILTER, keyset_after_filter(deleted_after)]) if deleted_after else DELETED_USERS_FILTER
+
+            async def fetch_page(query: Dict[str, Any]) -> List[Dict[str, Any]]:
+                # Fetch one extra document to know whether another page exists
+                return await users_collection.find(query, projection=base_projection) \
+                    .sort(USERS_LIST_SORT).limit(page_size + 1).to_list(length=page_size + 1)
+
+            async def count_matching() -> Optional[int]:
+                # None without filters; the list then covers every user
+                return await users_collection.count_documents(count_query) if count_query else None
+
+            def split_page(docs: List[Dict[str, Any]]):
+                # -> (this page, cursor of the next page or None)
+                if len(docs) <= page_size:
+                    return docs, None
+                last = docs[page_size - 1]
+                return docs[:page_size], encode_cursor(last.get("createdAt"), last["_id"])
+
+            # --- Counts (index-backed, run concurrently with the page queries) ---
+            page_docs, deleted_docs, all_count, deleted_count, active_count, matching_count = await asyncio.gather(
+                fetch_page(list_query),
+                fetch_page(deleted_query),
+                users_collection.estimated_document_count(),
+                users_collection.count_documents(DELETED_USERS_FILTER),
+                users_collection.count_documents(ACTIVE_USERS_FILTER),
+                count_matching(),
+            )
+            total_count = max(all_count - deleted_count, 0)  # non-deleted
+            if matching_count is None:
+                matching_count = all_count
 
-            # Split deleted / non-deleted
-            non_deleted_docs = [d for d in all_docs if not norm_bool(d.get("isDeleted"))]
-            deleted_docs = [d for d in all_docs if norm_bool(d.get("isDeleted"))]
+            page_docs, next_cursor = split_page(page_docs)
+            deleted_docs, deleted_next_cursor = split_page(deleted_docs)
 
-            non_deleted_users = [to_user_type(d) for d in non_deleted_docs]
+            users_list = [to_user_type(d) for d in page_docs]
             deleted_users = [to_user_type(d) for d in deleted_docs]
 
-            # --- Counts ---
-            total_count = len(non_deleted_users)                              # non-deleted
-            active_count = sum(1 for d in non_deleted_docs if norm_bool(d.get("isActive")))  # non-deleted + active
-            deleted_count = len(deleted_users)                                # deleted users
-
-            # --- Build the main 'users' list per args ---
-            # Start from both sets, then apply is_deleted and active filters
-            if is_deleted is True:
-                candidate_docs = deleted_docs
-            elif is_deleted is False:
-                candidate_docs = non_deleted_docs
-            else:
-                candidate_docs = all_docs  # both
-
-            if active is True:
-                # users with isActive truthy (normalize truth)
-                candidate_docs = [d for d in candidate_docs if norm_bool(d.get("isActive"))]
-            elif active is False:
-                # ONLY those that explicitly HAVE the isActive field AND it is falsy
-                candidate_docs = [
-                    d for d in candidate_docs
-                    if has_is_active_field(d) and not norm_bool(d.get("isActive"))
-                ]
-            # else active is None -> no filter on isActive
-
-            users_list = [to_user_type(d) for d in candidate_docs]
-
-            # Sort lists by created_at desc
-            def sort_key(u: UserType):
-                return u.created_at if isinstance(u.created_at, datetime) else datetime(MINYEAR, 1, 1)
-
-            users_list.sort(key=sort_key, reverse=True)
-            deleted_users.sort(key=sort_key, reverse=True)
-
             logger.info(
-                "all_users: returned=%s | total(non-deleted)=%s | active(non-deleted)=%s | deleted=%s | filters: active=%s is_deleted=%s",
-                len(users_list), total_count, active_count, deleted_count, active, is_deleted
+                "all_users: returned=%s | total=%s | matching=%s | active(non-deleted)=%s | deleted=%s | filters: active=%s is_deleted=%s | has_more=%s",
+                len(users_list), total_count, matching_count, active_count, deleted_count, active, is_deleted, next_cursor is not None
             )
 
             return UserListResponse(
@@ -832,6 +1002,11 @@ class Query:
                 users=users_list,
                 deleted_count=deleted_count,
                 deleted_users=deleted_users,
+                next_cursor=next_cursor,
+                has_more=next_cursor is not None,
+                matching_count=matching_count,
+                deleted_next_cursor=deleted_next_cursor,
+                deleted_has_more=deleted_next_cursor is not None,
             )
 
         except Exception as e:
@@ -894,8 +1069,10 @@ class Query:
                     id=str(pkg["_id"]),
                     title=pkg["title"],
                     description=pkg.get("description"),
-                    banner_url=pkg.get("bannerUrl"),
-                    theme_url=pkg.get("themeUrl"),
+                    banner_url_value=pkg.get("bannerUrl"),
+                    theme_url_value=pkg.get("themeUrl"),
+                    banner_renditions=pkg.get("bannerRenditions"),
+                    theme_renditions=pkg.get("themeRenditions"),
                     is_active=pkg.get("isActive"),
                     is_deleted=pkg.get("isDeleted"),
                     created_at=pkg["createdAt"],
@@ -916,7 +1093,7 @@ class Query:
 
     @strawberry.field
     async def get_packages(
-        self, created_by: Optional[str] = None, package_id: Optional[str] = None
+        self, info: strawberry.Info, created_by: Optional[str] = None, package_id: Optional[str] = None
     ) -> List[PackageDetailsType]:
         """Retrieves a list of packages, optionally filtered by the creator or a specific package ID."""
         logger.info(f"Entering get_packages with created_by: {created_by}, package_id: {package_id}")
@@ -947,12 +1124,19 @@ class Query:
                 logger.info("get_packages: No packages found")
                 return []
 
+            # --- Fetch Course Details for all packages in one batched query ---
+            course_loader = get_loaders(info).course_by_id
+            courses_per_package = await asyncio.gather(*[
+                course_loader.load_many([str(cid) for cid in (pkg.get("course_ids") or [])])
+                for pkg in packages
+            ])
+
             result_packages = []
-            for pkg in packages:
+            for pkg, package_courses in zip(packages, courses_per_package):
                 # --- Fetch Course Details ---
                 course_details_list = []
                 if pkg.get("course_ids"):
-                    found_courses_data = await get_course_details_by_ids(pkg["course_ids"])
+                    found_courses_data = [course for course in package_courses if course]
                     course_details_list = [
                         CourseDetailsType(
                             id=str(course["_id"]),
@@ -973,30 +1157,6 @@ class Query:
                         for course in found_courses_data
                     ]
 
-                # --- Convert Banner to Base64 ---
-                banner_base64_data = None
-                if pkg.get("bannerUrl"):
-                    file_path = os.path.normpath(os.path.join(pkg["bannerUrl"].lstrip('/')))
-                    try:
-                        with open(file_path, "rb") as image_file:
-                            banner_base64_data = base64.b64encode(image_file.read()).decode('utf-8')
-                    except FileNotFoundError:
-                        logger.warning(f"get_packages: Banner file not found at {file_path}")
-                    except Exception as e:
-                        logger.error(f"get_packages: Error reading banner file: {str(e)}")
-
-                # --- Convert Theme to Base64 ---
-                theme_base64_data = None
-                if pkg.get("themeUrl"):
-                    file_path = os.path.normpath(os.path.join(pkg["themeUrl"].lstrip('/')))
-                    try:
-                        with open(file_path, "rb") as image_file:
-                            theme_base64_data = base64.b64encode(image_file.read()).decode('utf-8')
-                    except FileNotFoundError:
-                        logger.warning(f"get_packages: Theme file not found at {file_path}")
-                    except Exception as e:
-                        logger.error(f"get_packages: Error reading theme file: {str(e)}")
-
                 # --- Format FAQs ---
                 response_faqs = []
                 if pkg.get("faqs"):
@@ -1021,10 +1181,10 @@ class Query:
                     id=str(pkg["_id"]),
                     title=pkg.get("title", ""),
                     description=pkg.get("description"),
-                    banner_url=pkg.get("bannerUrl"),
-                    theme_url=pkg.get("themeUrl"),
-                    banner_base64=banner_base64_data,
-                    theme_base64=theme_base64_data,
+                    banner_url_value=pkg.get("bannerUrl"),
+                    theme_url_value=pkg.get("themeUrl"),
+                    banner_renditions=pkg.get("bannerRenditions"),
+                    theme_renditions=pkg.get("themeRenditions"),
                     is_active=pkg.get("isActive"),
                     is_deleted=pkg.get("isDeleted"),
                     is_draft=pkg.get("isDraft"),
@@ -1263,6 +1423,7 @@ class Query:
     @strawberry.field
     async def get_purchase_data(
         self,
+        info: strawberry.Info,
         filter: Optional[PurchaseFilterInput] = None
     ) -> Optional[AdminAnalysisOutput | UserPurchaseOutput | AllPurchaseOutput]:
 
@@ -1273,79 +1434,29 @@ class Query:
             if filter.start_date and filter.end_date:
                 query["created_at"] = {"$gte": filter.start_date, "$lte": filter.end_date}
 
-        # Pull all first, then organize consistently
-        purchases = await purchased_collection.find(query).to_list(None)
-
-        # ------ normalize/defensive defaults + sort purchases by created_at desc ------
-        def _safe_dt(x):
-            return x if isinstance(x, datetime) else datetime.min
-
-        for p in purchases:
-            p.setdefault("courses", [])
-            p.setdefault("package_id", None)
-            p.setdefault("created_at", None)
-
-            p["courses"] = sorted(
-                (p.get("courses") or []),
-                key=lambda c: str(c.get("course_id", ""))
-            )
-
-        purchases.sort(key=lambda x: _safe_dt(x.get("created_at")), reverse=True)
-
         # ---------- 1) Admin analytics ----------
         if filter and filter.admin_analysis:
-            total_users = len({p.get("user_id") for p in purchases})
-            total_purchases = len(purchases)
-            all_courses = [course for p in purchases for course in (p.get("courses") or [])]
-            total_courses = len(all_courses)
-
-            completed_courses = sum(
-                1 for c in all_courses
-                if float(c.get("course_view_percent", 0) or 0) >= 97.0
+            # Totals, certificate splits and rankings come from the incrementally maintained
+            # rollups when unfiltered, otherwise they are computed by MongoDB (see analytics.py)
+            stats = await read_purchase_rollups() if not query else None
+            if stats is None:
+                stats = await compute_purchase_analytics(query)
+            total_users = stats["total_users"]
+            total_purchases = stats["total_purchases"]
+            total_courses = stats["total_courses"]
+            completed_courses = stats["completed_courses"]
+            certificate_sent_true = stats["certificate_sent_true"]
+            certificate_sent_false = stats["certificate_sent_false"]
+            users_with_true = stats["users_with_true"]
+            users_with_false = stats["users_with_false"]
+
+            loaders = get_loaders(info)
+            certificate_sent_true_users_docs, certificate_sent_false_users_docs = await asyncio.gather(
+                loaders.user_by_id.load_many([uid for uid in users_with_true if uid]),
+                loaders.user_by_id.load_many([uid for uid in users_with_false if uid]),
             )
-
-            certificate_sent_true = sum(1 for c in all_courses if bool(c.get("certificate_sent")) is True)
-            certificate_sent_false = total_courses - certificate_sent_true
-
-            users_with_true: Set[str] = set()
-            users_with_false: Set[str] = set()
-            for p in purchases:
-                uid = str(p.get("user_id"))
-                cs = p.get("courses") or []
-                if any(bool(c.get("certificate_sent")) is True for c in cs):
-                    users_with_true.add(uid)
-                if any(not bool(c.get("certificate_sent", False)) for c in cs):
-                    users_with_false.add(uid)
-
-            def _coerce_list_to_ids(id_set: Set[str]) -> List[Any]:
-                return [_to_maybe_object_id(s) for s in id_set if s]
-
-            true_ids = _coerce_list_to_ids(users_with_true)
-            false_ids = _coerce_list_to_ids(users_with_false)
-
-            certificate_sent_true_users_docs = []
-            if true_ids:
-                certificate_sent_true_users_docs = await users_collection.find(
-                    {"_id": {"$in": true_ids}},
-                    projection={
-                        "_id": 1, "name": 1, "email": 1, "phone": 1, "mobile": 1,
-                        "contact": 1, "phoneNumber": 1, "usertype": 1,
-                        "usertype_id": 1, "userTypeId": 1, "user_type_id": 1,
-                        "isActive": 1, "isDeleted": 1, "createdAt": 1
-                    }
-                ).to_list(None)
-
-            certificate_sent_false_users_docs = []
-            if false_ids:
-                certificate_sent_false_users_docs = await users_collection.find(
-                    {"_id": {"$in": false_ids}},
-                    projection={
-                        "_id": 1, "name": 1, "email": 1, "phone": 1, "mobile": 1,
-                        "contact": 1, "phoneNumber": 1, "usertype": 1,
-                        "usertype_id": 1, "userTypeId": 1, "user_type_id": 1,
-                        "isActive": 1, "isDeleted": 1, "createdAt": 1
-                    }
-                ).to_list(None)
+            certificate_sent_true_users_docs = [d for d in certificate_sent_true_users_docs if d]
+            certificate_sent_false_users_docs = [d for d in certificate_sent_false_users_docs if d]
 
             true_users = [_map_user_doc_to_type(d) for d in certificate_sent_true_users_docs]
             false_users = [_map_user_doc_to_type(d) for d in certificate_sent_false_users_docs]
@@ -1356,24 +1467,8 @@ class Query:
             true_users.sort(key=_created_at_safe, reverse=True)
             false_users.sort(key=_created_at_safe, reverse=True)
 
-            # Counter logic
-            course_counter = Counter()
-            for c in all_courses:
-                cid = c.get("course_id")
-                if cid:
-                    course_counter[str(cid)] += 1
-
-            package_counter = Counter()
-            for p in purchases:
-                pid = p.get("package_id")
-                if pid:
-                    package_counter[str(pid)] += 1
-
-            def _sorted_counter_items(counter: Counter) -> List[Tuple[str, int]]:
-                return sorted(counter.items(), key=lambda t: (-t[1], t[0]))
-
-            sorted_courses = _sorted_counter_items(course_counter)
-            sorted_packages = _sorted_counter_items(package_counter)
+            sorted_courses: List[Tuple[str, int]] = stats["course_ranking"]
+            sorted_packages: List[Tuple[str, int]] = stats["package_ranking"]
 
             most_purchased_course = sorted_courses[0][0] if sorted_courses else None
             most_purchased_package = sorted_packages[0][0] if sorted_packages else None
@@ -1394,49 +1489,44 @@ class Query:
                 return doc
             # -----------------------------------------------------------
 
-            # Hydrate top single details
-            most_purchased_course_details: Optional[CourseDetailsType] = None
-            if most_purchased_course:
-                cdoc = await courses_collection.find_one({"_id": _to_maybe_object_id(most_purchased_course)})
-                if cdoc:
-                    # 🔥 Fix DB keys BEFORE mapping
-                    cdoc = normalize_course_doc(cdoc)
-                    most_purchased_course_details = _map_course_doc_to_type(cdoc)
-                    
-                    # 🔥 DOUBLE CHECK: Force attributes just in case mapper missed it
-                    most_purchased_course_details.createdBy = str(cdoc.get("createdBy") or cdoc.get("created_by") or "") if (cdoc.get("createdBy") or cdoc.get("created_by")) else None
-                    most_purchased_course_details.creationStage = cdoc.get("creationStage")
-                    most_purchased_course_details.publishStatus = cdoc.get("publishStatus")
+            # Hydrate every ranked course/package in one batched query each
+            # (the top ones are part of the ranking, so they come from the same batch)
+            course_docs, package_docs = await asyncio.gather(
+                loaders.course_by_id.load_many([cid for cid, _ in sorted_courses]),
+                loaders.package_by_id.load_many([pid for pid, _ in sorted_packages]),
+            )
+
+            def _to_course_type(cdoc: dict) -> CourseDetailsType:
+                # 🔥 Fix DB keys BEFORE mapping (copy, the loader caches the raw doc)
+                cdoc = normalize_course_doc(dict(cdoc))
+                ctype = _map_course_doc_to_type(cdoc)
+
+                # 🔥 DOUBLE CHECK: Force attributes
+                if cdoc.get("createdBy") or cdoc.get("created_by"):
+                    ctype.createdBy = str(cdoc.get("createdBy") or cdoc.get("created_by"))
 
+                ctype.creationStage = cdoc.get("creationStage")
+                ctype.publishStatus = cdoc.get("publishStatus")
+                return ctype
+
+            most_purchased_course_details: Optional[CourseDetailsType] = None
+            if most_purchased_course and course_docs and course_docs[0]:
+                most_purchased_course_details = _to_course_type(course_docs[0])
 
             most_purchased_package_details: Optional[PackageDetailsType] = None
-            if most_purchased_package:
-                pdoc = await packages_collection.find_one({"_id": _to_maybe_object_id(most_purchased_package)})
-                if pdoc:
-                    most_purchased_package_details = _map_package_doc_to_type(pdoc)
+            if most_purchased_package and package_docs and package_docs[0]:
+                most_purchased_package_details = _map_package_doc_to_type(package_docs[0])
 
             # Hydrate full sorted lists
             purchased_courses_details: List[CourseDetailsType] = []
-            for cid, count in sorted_courses:
-                cdoc = await courses_collection.find_one({"_id": _to_maybe_object_id(cid)})
+            for (cid, count), cdoc in zip(sorted_courses, course_docs):
                 if cdoc:
-                    # 🔥 Fix DB keys BEFORE mapping
-                    cdoc = normalize_course_doc(cdoc)
-                    ctype = _map_course_doc_to_type(cdoc)
-                    
-                    # 🔥 DOUBLE CHECK: Force attributes
-                    if cdoc.get("createdBy") or cdoc.get("created_by"):
-                         ctype.createdBy = str(cdoc.get("createdBy") or cdoc.get("created_by"))
-                    
-                    ctype.creationStage = cdoc.get("creationStage")
-                    ctype.publishStatus = cdoc.get("publishStatus")
-
+                    ctype = _to_course_type(cdoc)
                     setattr(ctype, "purchase_count", count)
                     purchased_courses_details.append(ctype)
 
             purchased_packages_details: List[PackageDetailsType] = []
-            for pid, count in sorted_packages:
-                pdoc = await packages_collection.find_one({"_id": _to_maybe_object_id(pid)})
+            for (pid, count), pdoc in zip(sorted_packages, package_docs):
                 if pdoc:
                     ptype = _map_package_doc_to_type(pdoc)
                     setattr(ptype, "purchase_count", count)
@@ -1459,6 +1549,25 @@ class Query:
                 all_purchased_packages=purchased_packages_details,
             )
 
+        # Pull all first, then organize consistently
+        purchases = await purchased_collection.find(query).to_list(None)
+
+        # ------ normalize/defensive defaults + sort purchases by created_at desc ------
+        def _safe_dt(x):
+            return x if isinstance(x, datetime) else datetime.min
+
+        for p in purchases:
+            p.setdefault("courses", [])
+            p.setdefault("package_id", None)
+            p.setdefault("created_at", None)
+
+            p["courses"] = sorted(
+                (p.get("courses") or []),
+                key=lambda c: str(c.get("course_id", ""))
+            )
+
+        purchases.sort(key=lambda x: _safe_dt(x.get("created_at")), reverse=True)
+
         # ---------- 2) User purchases ----------
         if filter and filter.user_id:
             user_purchases = [
@@ -1656,6 +1765,8 @@ class Query:
                 # visuals / extras
                 "bannerUrl": 1,
                 "themeUrl": 1,
+                "bannerRenditions": 1,
+                "themeRenditions": 1,
                 "banner_base64": 1,  # snake
                 "theme_base64": 1,
                 "bannerBase64": 1,   # camel variants
@@ -1851,10 +1962,12 @@ class Query:
                     deleted_by=doc.get("deletedBy"),
 
                     # visuals
-                    banner_url=clean_str(doc.get("bannerUrl") or ""),
-                    theme_url=clean_str(doc.get("themeUrl") or ""),
-                    banner_base64=clean_str(doc.get("banner_base64") or doc.get("bannerBase64") or ""),
-                    theme_base64=clean_str(doc.get("theme_base64") or doc.get("themeBase64") or ""),
+                    banner_url_value=clean_str(doc.get("bannerUrl") or ""),
+                    theme_url_value=clean_str(doc.get("themeUrl") or ""),
+                    banner_renditions=doc.get("bannerRenditions"),
+                    theme_renditions=doc.get("themeRenditions"),
+                    banner_base64_value=clean_str(doc.get("banner_base64") or doc.get("bannerBase64") or ""),
+                    theme_base64_value=clean_str(doc.get("theme_base64") or doc.get("themeBase64") or ""),
 
                     # business fields
                     price_details=map_prices(doc.get("price_details")),
@@ -1902,6 +2015,26 @@ class Query:
             logger.error(f"get_package_counts: MongoDB Error: {str(e)}")
             return PackageCountResponse(total_count=0, status_counts=[], packages=[])
 
+    @strawberry.field(name="jobStatus")
+    async def job_status(self, job_id: str) -> Optional[JobStatusType]:
+        """Status and progress counters of a background job, or null if it is unknown or expired."""
+        doc = await get_job(job_id)
+        if not doc:
+            return None
+        return JobStatusType(
+            id=doc["_id"],
+            type=doc.get("type", ""),
+            status=doc.get("status", ""),
+            total=doc.get("total"),
+            processed=doc.get("processed", 0),
+            modified=doc.get("modified", 0),
+            message=doc.get("message"),
+            created_at=doc.get("created_at"),
+            started_at=doc.get("started_at"),
+            updated_at=doc.get("updated_at"),
+            finished_at=doc.get("finished_at"),
+        )
+
     @strawberry.field
     async def get_course_progress(
         self, 
@@ -1925,8 +2058,8 @@ class Query:
         
         try:
             # --- ⭐️ THIS IS THE KEY ⭐️ ---
-            # 1. Load data from DB into the Pydantic model
-            progress_model = CourseProgressModel(**progress_doc)
+            # 1. Load data from DB into the Pydantic model (v3 docs get their lessons from the cached manifest)
+            progress_model = CourseProgressModel(**await join_manifest(progress_doc))
             
             # 2. Return the Pydantic model *directly*.
             # Strawberry will handle the conversion automatically.
@@ -1986,13 +2119,13 @@ class Mutation:
                 logger.info(f"signup: {result.message}")
                 return result
             
-            hashed_password = bcrypt.hashpw(input.password.encode('utf-8'), bcrypt.gensalt())
+            hashed_password = await hash_password(input.password)
             
             new_user_data = UserModel(
                 name=input.name,
                 email=input.email,
                 phone=input.phone,
-                password=hashed_password.decode('utf-8'),
+                password=hashed_password,
                 usertype_id=default_usertype["_id"],
                 is_active=True,
                 is_deleted=False
@@ -2059,7 +2192,7 @@ class Mutation:
                 logger.info(f"login: {result.message}")
                 return result
             
-            if not bcrypt.checkpw(password.encode('utf-8'), user_doc["password"].encode('utf-8')):
+            if not await check_password(password, user_doc["password"]):
                 result = UserResponse(status=401, message="Incorrect email or password.")
                 logger.info(f"login: {result.message}")
                 return result
@@ -2087,6 +2220,8 @@ class Mutation:
                 {"$set": {"token": token, "created_at": datetime.utcnow()}},
                 upsert=True
             )
+            # The previous token was just replaced, so stop trusting any cached copy of it
+            revoke_user_tokens(str(user_doc["_id"]))
             
             result = UserResponse(
                 status=200,
@@ -2100,7 +2235,7 @@ class Mutation:
                     usertype=usertype_doc["usertype"] if usertype_doc else None,
                     is_active=user_doc.get("is_active", True),
                     is_deleted=user_doc.get("is_deleted", False),
-                    created_at=user_doc["created_at"]
+                    created_at=user_doc.get("createdAt") or user_doc.get("created_at")
                 ),
                 token=token
             )
@@ -2134,11 +2269,10 @@ class Mutation:
         logger.info(f"Entering create_package with title: {title}, description: {description}, price_details: {price_details}, course_ids: {course_ids}, telegram_id: {telegram_id}, is_draft: {is_draft}, status: {status}")
         banner_url = None
         theme_url = None
-        banner_base64_data = None
-        theme_base64_data = None
-        
+        banner_renditions = None
+        theme_renditions = None
         try:
-            current_user: Optional[AuthenticatedUser] = info.context.get("current_user")
+            current_user: Optional[AuthenticatedUser] = await info.context.get_current_user()
             if not current_user:
                 result = PackageResponse(status=401, message="Authentication required: You must be logged in.")
                 logger.info(f"create_package: {result.message}")
@@ -2166,20 +2300,6 @@ class Mutation:
                     logger.info(f"create_package: {result.message}")
                     return result
             
-            # Enhanced: Conditional file processing
-            if banner_file:
-                banner_content = await banner_file.read()
-                theme_content = await theme_file.read()
-                banner_base64_data = base64.b64encode(banner_content).decode('utf-8')
-                theme_base64_data = base64.b64encode(theme_content).decode('utf-8')
-
-                # Await resetting the file pointer
-                await banner_file.seek(0)
-                await theme_file.seek(0)
-
-                banner_url = await save_and_compress_file(banner_file, "banners")
-                theme_url = await save_and_compress_file(theme_file, "themes")
-
             # Original logic for course_ids and telegram_id
             # if course_ids:
             if not is_draft_value and course_ids:
@@ -2190,6 +2310,13 @@ class Mutation:
                     logger.info(f"create_package: {result.message}")
                     return result
 
+            # Enhanced: Conditional file processing (after validation, so no early return leaks an upload)
+            # bannerBase64 / themeBase64 of the response are read back from the stored files if selected
+            if banner_file:
+                banner_url, banner_renditions = await save_and_compress_file(banner_file, "banners")
+            if theme_file:
+                theme_url, theme_renditions = await save_and_compress_file(theme_file, "themes")
+
             faqs_data = [FaqModel(question=faq.question, answer=faq.answer) for faq in faqs] if faqs else []
 
             # Enhanced: Prepare price data
@@ -2209,6 +2336,8 @@ class Mutation:
                 description=description,
                 banner_url=banner_url,
                 theme_url=theme_url,
+                banner_renditions=banner_renditions,
+                theme_renditions=theme_renditions,
                 created_by=created_by_id,
                 course_ids=course_ids if course_ids else [],
                 # Enhanced: Save the list of price details
@@ -2246,10 +2375,10 @@ class Mutation:
                     id=str(new_package_doc["_id"]),
                     title=new_package_doc.get("title"),
                     description=new_package_doc.get("description"),
-                    banner_url=new_package_doc.get("bannerUrl"),
-                    theme_url=new_package_doc.get("themeUrl"),
-                    banner_base64=banner_base64_data,
-                    theme_base64=theme_base64_data,
+                    banner_url_value=new_package_doc.get("bannerUrl"),
+                    theme_url_value=new_package_doc.get("themeUrl"),
+                    banner_renditions=new_package_doc.get("bannerRenditions"),
+                    theme_renditions=new_package_doc.get("themeRenditions"),
                     is_active=new_package_doc.get("isActive"),
                     is_deleted=new_package_doc.get("isDeleted"),
                     created_at=new_package_doc.get("createdAt"),
@@ -2270,18 +2399,18 @@ class Mutation:
             logger.info(f"create_package: Successfully created package with id {new_package_doc['_id']}")
             return result
 
+        except ImageRejected as e:
+            await delete_stored_image(banner_url, banner_renditions)
+            logger.info(f"create_package: Rejected upload: {str(e)}")
+            return PackageResponse(status=400, message=str(e))
         except (PyMongoError, ValidationError) as e:
-            if banner_url:
-                delete_previous_file(banner_url.lstrip('/'))
-            if theme_url:
-                delete_previous_file(theme_url.lstrip('/'))
+            await delete_stored_image(banner_url, banner_renditions)
+            await delete_stored_image(theme_url, theme_renditions)
             logger.error(f"create_package: Database or validation error: {str(e)}")
             return PackageResponse(status=500, message=f"A database or validation error occurred: {e}")
         except Exception as e:
-            if banner_url:
-                delete_previous_file(banner_url.lstrip('/'))
-            if theme_url:
-                delete_previous_file(theme_url.lstrip('/'))
+            await delete_stored_image(banner_url, banner_renditions)
+            await delete_stored_image(theme_url, theme_renditions)
             logger.error(f"create_package: Unexpected error: {str(e)}")
             return PackageResponse(status=500, message=f"An unexpected error occurred: {e}")
 
@@ -2302,10 +2431,13 @@ class Mutation:
         status: Optional[str] = None,
     ) -> PackageResponse:
         logger.info(f"Entering update_package with package_id: {package_id}, title: {title}, description: {description}, course_ids: {course_ids}, price_details: {price_details}, telegram_id: {telegram_id}, is_draft: {is_draft}, status: {status}")
-
+        # Uploads stored by this call, and the ones they replace
+        saved_images = []
+        replaced_images = []
+        updated = False
         try:
             # ----------------- AUTHENTICATION CHECK (COMMENTED FOR DEVELOPMENT) -----------------
-            current_user: Optional[AuthenticatedUser] = info.context.get("current_user")
+            current_user: Optional[AuthenticatedUser] = await info.context.get_current_user()
             if not current_user:
                 result = PackageResponse(status=401, message="Authentication required: You must be logged in.")
                 logger.info(f"update_package: {result.message}")
@@ -2330,21 +2462,20 @@ class Mutation:
 
             update_data = {}
 
-            # Handle banner file update
+            # Handle banner file update. New files are stored first; the old ones are only
+            # released once the package points at the new ones (see the finally below)
             if banner_file:
-                if existing_package_doc.get("bannerUrl"):
-                    await delete_previous_file(existing_package_doc["bannerUrl"].lstrip('/'))
-                
-                update_data["bannerUrl"] = await save_and_compress_file(banner_file, "banners")
+                update_data["bannerUrl"], update_data["bannerRenditions"] = await save_and_compress_file(banner_file, "banners")
+                saved_images.append((update_data["bannerUrl"], update_data["bannerRenditions"]))
+                replaced_images.append((existing_package_doc.get("bannerUrl"), existing_package_doc.get("bannerRenditions")))
             else:
                 update_data["bannerUrl"] = existing_package_doc.get("bannerUrl")
             
             # Handle theme file update
             if theme_file:
-                if existing_package_doc.get("themeUrl"):
-                    await delete_previous_file(existing_package_doc["themeUrl"].lstrip('/'))
-
-                update_data["themeUrl"] = await save_and_compress_file(theme_file, "themes")
+                update_data["themeUrl"], update_data["themeRenditions"] = await save_and_compress_file(theme_file, "themes")
+                saved_images.append((update_data["themeUrl"], update_data["themeRenditions"]))
+                replaced_images.append((existing_package_doc.get("themeUrl"), existing_package_doc.get("themeRenditions")))
             else:
                 update_data["themeUrl"] = existing_package_doc.get("themeUrl")
 
@@ -2404,6 +2535,7 @@ class Mutation:
             )
 
             if update_result.modified_count == 1:
+                updated = True
                 updated_package_doc = await packages_collection.find_one({"_id": ObjectId(package_id)})
                 
                 # Prepare the response data, handling the new fields
@@ -2425,8 +2557,10 @@ class Mutation:
                         id=str(updated_package_doc["_id"]),
                         title=updated_package_doc.get("title"),
                         description=updated_package_doc.get("description"),
-                        banner_url=updated_package_doc.get("bannerUrl"),
-                        theme_url=updated_package_doc.get("themeUrl"),
+                        banner_url_value=updated_package_doc.get("bannerUrl"),
+                        theme_url_value=updated_package_doc.get("themeUrl"),
+                        banner_renditions=updated_package_doc.get("bannerRenditions"),
+                        theme_renditions=updated_package_doc.get("themeRenditions"),
                         is_active=updated_package_doc.get("isActive"),
                         is_deleted=updated_package_doc.get("isDeleted"),
                         is_draft=updated_package_doc.get("isDraft"),
@@ -2450,12 +2584,20 @@ class Mutation:
                 logger.info(f"update_package: {result.message}")
                 return result
                 
+        except ImageRejected as e:
+            logger.info(f"update_package: Rejected upload: {str(e)}")
+            return PackageResponse(status=400, message=str(e))
         except (PyMongoError, ValueError, ValidationError) as e:
             logger.error(f"update_package: A database or validation error occurred: {str(e)}")
             return PackageResponse(status=500, message=f"A database or validation error occurred: {e}")
         except Exception as e:
             logger.error(f"update_package: Unexpected error: {str(e)}")
             return PackageResponse(status=500, message=f"An unexpected error occurred: {e}")
+        finally:
+            # Uploads are reference counted: drop the package's old files only once the update
+            # landed, otherwise drop the files this call stored (on every error path)
+            for url, renditions in (replaced_images if updated else saved_images):
+                await delete_stored_image(url, renditions)
 
     @strawberry.mutation
     async def delete_package(
@@ -2468,7 +2610,7 @@ class Mutation:
             # ----------------- AUTHENTICATION CHECK -----------------
             # For development, you can use the commented out code
             # deleted_by_id = "development_user"
-            current_user: Optional[AuthenticatedUser] = info.context.get("current_user")
+            current_user: Optional[AuthenticatedUser] = await info.context.get_current_user()
             if not current_user:
                 result = PackageResponse(status=401, message="Authentication required: You must be logged in.")
                 logger.info(f"delete_package: {result.message}")
@@ -2499,6 +2641,7 @@ class Mutation:
             )
 
             if update_result.modified_count == 1:
+                updated = True
                 updated_package_doc = await packages_collection.find_one({"_id": ObjectId(package_id)})
                 result = PackageResponse(
                     status=200,
@@ -2507,10 +2650,12 @@ class Mutation:
                         id=str(updated_package_doc["_id"]),
                         title=updated_package_doc.get("title"),
                         description=updated_package_doc.get("description"),
-                        banner_url=updated_package_doc.get("bannerUrl"),
-                        theme_url=updated_package_doc.get("themeUrl"),
-                        banner_base64=None,  # Not stored in DB, only used for upload
-                        theme_base64=None,   # Not stored in DB, only used for upload
+                        banner_url_value=updated_package_doc.get("bannerUrl"),
+                        theme_url_value=updated_package_doc.get("themeUrl"),
+                        banner_renditions=updated_package_doc.get("bannerRenditions"),
+                        theme_renditions=updated_package_doc.get("themeRenditions"),
+                        banner_base64_value=None,  # Read from bannerUrl if selected
+                        theme_base64_value=None,   # Read from themeUrl if selected
                         is_active=updated_package_doc.get("isActive", False),
                         is_deleted=updated_package_doc.get("isDeleted", True),
                         is_draft=updated_package_doc.get("isDraft", False),
@@ -2578,22 +2723,30 @@ class Mutation:
                 "user_id": user_id,
                 "package_id": package_id
             })
-            if existing:
+            while existing:
                 logger.info(f"Existing package found for user {user_id}, updating courses")
                 existing_courses = {c["course_id"]: c for c in existing["courses"]}
                 for course in courses_data:
                     existing_courses[course["course_id"]] = course
-                await purchased_collection.update_one(
-                    {"_id": existing["_id"]},
+                merged_courses = list(existing_courses.values())
+                # Only write over the courses we merged from; the returned before-image is the
+                # state this write replaced, so the analytics delta can't drift or double count
+                before = await purchased_collection.find_one_and_update(
+                    {"_id": existing["_id"], "courses": existing["courses"]},
                     {"$set": {
-                        "courses": list(existing_courses.values()),
+                        "courses": merged_courses,
                         "name": name,
                         "email": email,
                         "phone": phone,
                         "updated_at": datetime.utcnow()
-                    }}
+                    }},
+                    return_document=ReturnDocument.BEFORE,
                 )
-                return str(existing["_id"])
+                if before is not None:
+                    await record_purchase_change(before, {**before, "courses": merged_courses})
+                    return str(existing["_id"])
+                # Courses changed concurrently (or the purchase was deleted); merge again
+                existing = await purchased_collection.find_one({"_id": existing["_id"]})
 
             new_purchase = {
                 "user_id": user_id,
@@ -2607,29 +2760,38 @@ class Mutation:
             }
             result = await purchased_collection.insert_one(new_purchase)
             logger.info(f"New package purchase created with id={result.inserted_id}")
+            await record_purchase_change(None, new_purchase)
             return str(result.inserted_id)
 
         # Single course purchase
         inserted_ids = []
         for course in courses_data:
-            existing = await purchased_collection.find_one({
-                "user_id": user_id,
-                "package_id": None,
-                "courses": {"$elemMatch": {"course_id": course["course_id"]}}
-            })
+            # Update and before-image in one atomic step (see the package path above)
+            existing = await purchased_collection.find_one_and_update(
+                {
+                    "user_id": user_id,
+                    "package_id": None,
+                    "courses": {"$elemMatch": {"course_id": course["course_id"]}}
+                },
+                {"$set": {
+                    "courses.$.course_view_percent": course["course_view_percent"],
+                    "courses.$.certificate_sent": course["certificate_sent"],
+                    "name": name,
+                    "email": email,
+                    "phone": phone,
+                    "updated_at": datetime.utcnow()
+                }},
+                return_document=ReturnDocument.BEFORE,
+            )
             if existing:
-                logger.info(f"Updating existing course {course['course_id']} for user {user_id}")
-                await purchased_collection.update_one(
-                    {"_id": existing["_id"], "courses.course_id": course["course_id"]},
-                    {"$set": {
-                        "courses.$.course_view_percent": course["course_view_percent"],
-                        "courses.$.certificate_sent": course["certificate_sent"],
-                        "name": name,
-                        "email": email,
-                        "phone": phone,
-                        "updated_at": datetime.utcnow()
-                    }}
-                )
+                logger.info(f"Updated existing course {course['course_id']} for user {user_id}")
+                # The positional "$" update above only touches the first matching course
+                updated_courses = list(existing.get("courses") or [])
+                for i, c in enumerate(updated_courses):
+                    if isinstance(c, dict) and c.get("course_id") == course["course_id"]:
+                        updated_courses[i] = {**c, "course_view_percent": course["course_view_percent"], "certificate_sent": course["certificate_sent"]}
+                        break
+                await record_purchase_change(existing, {**existing, "courses": updated_courses})
                 inserted_ids.append(str(existing["_id"]))
             else:
                 new_purchase = {
@@ -2644,6 +2806,7 @@ class Mutation:
                 }
                 result = await purchased_collection.insert_one(new_purchase)
                 logger.info(f"New single course purchase created with id={result.inserted_id}")
+                await record_purchase_change(None, new_purchase)
                 inserted_ids.append(str(result.inserted_id))
 
         return ", ".join(inserted_ids)
@@ -2664,12 +2827,6 @@ class Mutation:
 
         logger.info(f"Updating course progress: purchase_id={purchase_id}, course_id={course_id}")
 
-        # Check if purchase exists
-        purchase = await purchased_collection.find_one({"_id": ObjectId(purchase_id)})
-        if not purchase:
-            logger.warning(f"Purchase with id={purchase_id} not found")
-            return f"Purchase with id={purchase_id} does not exist."
-
         # Prepare update data
         update_data = {
             "courses.$[elem].course_view_percent": view_percent,
@@ -2678,17 +2835,37 @@ class Mutation:
         if certificate_sent is not None:
             update_data["courses.$[elem].certificate_sent"] = certificate_sent
 
-        # Perform the update with array_filters
-        result = await purchased_collection.update_one(
+        # Perform the update with array_filters; the returned before-image is exactly the
+        # state this write replaced, so the analytics delta below can't double count
+        purchase = await purchased_collection.find_one_and_update(
             {"_id": ObjectId(purchase_id)},
             {"$set": update_data},
-            array_filters=[{"elem.course_id": course_id}]
+            array_filters=[{"elem.course_id": course_id}],
+            return_document=ReturnDocument.BEFORE,
         )
+        if not purchase:
+            logger.warning(f"Purchase with id={purchase_id} not found")
+            return f"Purchase with id={purchase_id} does not exist."
 
-        if result.modified_count == 0:
+        matching = [c for c in purchase.get("courses") or [] if isinstance(c, dict) and c.get("course_id") == course_id]
+        if not matching or all(
+            c.get("course_view_percent") == view_percent
+            and (certificate_sent is None or c.get("certificate_sent") == certificate_sent)
+            for c in matching
+        ):
             logger.info(f"No changes made for course {course_id} in purchase {purchase_id}")
             return "No course found or no changes made."
         
+        # Keep the admin analytics rollups in step (certificate / completion changes)
+        updated_courses = []
+        for c in purchase.get("courses") or []:
+            if isinstance(c, dict) and c.get("course_id") == course_id:
+                c = {**c, "course_view_percent": view_percent}
+                if certificate_sent is not None:
+                    c["certificate_sent"] = certificate_sent
+            updated_courses.append(c)
+        await record_purchase_change(purchase, {**purchase, "courses": updated_courses})
+
         logger.info(f"Course progress updated successfully for course {course_id} in purchase {purchase_id}")
         return "Course progress updated successfully."
     
@@ -2731,25 +2908,10 @@ class Mutation:
                     logger.warning(f"Could not parse expiry string '{expiry}'. Expiry will be null.")
 
             try:
-                lesson_ids, lesson_durations, course_duration = await fetch_video_lessons_data(course_id)
-                
-                initial_watch_times = [
-                    CourseWatchModel(lesson_id=lid, watch_time=0.0) for lid in lesson_ids
-                ]
-
-                new_progress = CourseProgressModel(
-                    user_id=user_id,
-                    course_id=course_id,
-                    lesson_ids=lesson_ids,
-                    lesson_duration=lesson_durations,
-                    course_duration=course_duration,
-                    watch_times=initial_watch_times,
-                    total_watch_time=0.0,
-                    expiry=course_expiry_date,
-                    package_id=None
-                )
+                manifest = await ensure_current_manifest(course_id)
+                new_progress = _new_progress_model(user_id, course_id, manifest, course_expiry_date, None)
                 
-                progress_docs_to_insert.append(new_progress.model_dump(by_alias=True, exclude_none=True))
+                progress_docs_to_insert.append(progress_document(new_progress))
                 new_progress_models.append(new_progress)
                 
             except Exception as e:
@@ -2771,59 +2933,23 @@ class Mutation:
             if not course_ids_in_package:
                 raise Exception(f"Package {package_id} contains no course_ids.")
                 
-            # --- NEW EXPIRY LOGIC ---
-            package_expiry_date: Optional[datetime] = None
-            
-            if expiry:
-                # 1. Use user-provided expiry if it exists
-                # Changed to logger.info
-                logger.info(f"User provided an expiry for the package: '{expiry}'")
-                package_expiry_date = parse_period_to_expiry_date(expiry)
-                if not package_expiry_date:
-                    # Changed to logger.warning
-                    logger.warning(f"Could not parse user-provided expiry string '{expiry}'. Expiry will be null.")
-            
-            else:
-                # 2. Fallback to package document if no expiry was passed
-                # Changed to logger.info
-                logger.info("No expiry provided by user. Checking package document...")
-                try:
-                    period_str = (package_doc.get("price_details", [{}])[0]).get("period")
-                    if period_str:
-                        package_expiry_date = parse_period_to_expiry_date(period_str)
-                        # Changed to logger.info
-                        logger.info(f"Package expiry set from DB: {package_expiry_date} (from '{period_str}')")
-                    else:
-                        # Changed to logger.info
-                        logger.info("No period found in package document. Expiry will be null.")
-                except Exception as e:
-                    # Changed to logger.warning
-                    logger.warning(f"Error parsing package expiry from DB: {e}. Expiry will be null.")
-            # --- END NEW EXPIRY LOGIC ---
+            package_expiry_date = _package_expiry_date(package_doc, expiry)
                 
+            # --- Lessons for every course of the package in one aggregation ---
+            try:
+                package_manifests = await ensure_current_manifests([str(cid) for cid in course_ids_in_package])
+            except Exception as e:
+                logger.error(f"Bulk lesson fetch for package {package_id} failed: {e}. Falling back to per-course fetches.")
+                package_manifests = {}
+
             # --- ROBUST LOOP FIX ---
             for cid in course_ids_in_package:
                 try:
                     # Changed to logger.info
                     logger.info(f"Processing course {cid} in package...")
-                    lesson_ids, lesson_durations, course_duration = await fetch_video_lessons_data(cid)
-                    
-                    initial_watch_times = [
-                        CourseWatchModel(lesson_id=lid, watch_time=0.0) for lid in lesson_ids
-                    ]
-
-                    new_progress = CourseProgressModel(
-                        user_id=user_id,
-                        course_id=cid, 
-                        lesson_ids=lesson_ids,
-                        lesson_duration=lesson_durations,
-                        course_duration=course_duration,
-                        watch_times=initial_watch_times,
-                        total_watch_time=0.0,
-                        expiry=package_expiry_date,
-                        package_id=package_id      
-                    )
-                    progress_docs_to_insert.append(new_progress.model_dump(by_alias=True, exclude_none=True))
+                    manifest = package_manifests.get(str(cid)) or await ensure_current_manifest(cid)
+                    new_progress = _new_progress_model(user_id, cid, manifest, package_expiry_date, package_id)
+                    progress_docs_to_insert.append(progress_document(new_progress))
                     new_progress_models.append(new_progress)
                     # Changed to logger.info
                     logger.info(f"Added course {cid} to be initialized.")
@@ -2842,22 +2968,135 @@ class Mutation:
             return []
 
         try:
-            result = await progress_collection.insert_many(progress_docs_to_insert)
-            
-            inserted_ids = result.inserted_ids
-            for model, new_id in zip(new_progress_models, inserted_ids):
-                model.id = str(new_id) 
+            # Upserts keyed on (user_id, course_id): retries and double submits never create
+            # duplicates, and re-enrolling keeps the watch times already recorded.
+            try:
+                result = await progress_collection.bulk_write(
+                    [progress_upsert_request(doc) for doc in progress_docs_to_insert],
+                    ordered=False,
+                )
+                logger.info(f"Progress upserted: {result.upserted_count} created, {result.matched_count} already existed.")
+            except BulkWriteError as e:
+                # A concurrent enrollment may win the race for the unique index; its document is just as good
+                other_errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if other_errors:
+                    raise
+                logger.info(f"Progress upsert raced with a concurrent enrollment for {len(e.details['writeErrors'])} course(s).")
+
+            # Return what is stored, including existing watch times
+            course_ids = [doc["course_id"] for doc in progress_docs_to_insert]
+            stored = {}
+            async for doc in progress_collection.find({"user_id": user_id, "course_id": {"$in": course_ids}}):
+                stored[doc["course_id"]] = CourseProgressModel(**await join_manifest(doc))
+            saved_models = [stored.get(model.course_id, model) for model in new_progress_models]
                 
             # Changed to logger.info
-            logger.info(f"{len(inserted_ids)} progress document(s) saved.")
+            logger.info(f"{len(saved_models)} progress document(s) saved.")
 
-            return [CourseProgressType.from_pydantic(model) for model in new_progress_models]
+            return [CourseProgressType.from_pydantic(model) for model in saved_models]
 
         except Exception as e:
             # Changed to logger.error
             logger.error(f"Error saving progress to MongoDB: {e}")
             raise Exception(f"Database insertion failed: {e}")
     
+    @strawberry.mutation
+    async def enroll_cohort(
+        self,
+        info: strawberry.Info,
+        user_ids: List[str],
+        course_id: Optional[str] = None,
+        package_id: Optional[str] = None,
+        expiry: Optional[str] = None
+    ) -> CohortEnrollmentResponse:
+        """
+        Bulk form of initialize_course_progress for onboarding a batch of users.
+        Provide EITHER course_id OR package_id, and at most COHORT_ENROLLMENT_MAX_USERS
+        user ids. The package, expiry and lesson data are resolved and the users
+        checked here; the progress documents are then upserted by a background job
+        (see jobs.enroll_cohort_job), so re-running the same cohort is safe. Poll
+        `jobStatus` with the returned job_id for progress.
+        """
+        def failure(message: str) -> CohortEnrollmentResponse:
+            logger.info(f"enroll_cohort: {message}")
+            return CohortEnrollmentResponse(
+                success=False, message=message, enrolled_count=0, failed_count=len(user_ids), results=[]
+            )
+
+        current_user: Optional[AuthenticatedUser] = await info.context.get_current_user()
+        if not current_user:
+            return failure("Authentication required: You must be logged in.")
+
+        if (course_id and package_id) or (not course_id and not package_id):
+            return failure("Error: You must provide either 'course_id' OR 'package_id', but not both.")
+
+        user_ids = list(dict.fromkeys(user_ids))
+        if len(user_ids) > COHORT_ENROLLMENT_MAX_USERS:
+            return failure(
+                f"Too many users: {len(user_ids)} given, at most {COHORT_ENROLLMENT_MAX_USERS} per call. "
+                "Split the cohort into several calls."
+            )
+        logger.info(f"enroll_cohort: Enrolling {len(user_ids)} user(s) in {'course ' + course_id if course_id else 'package ' + package_id}")
+
+        try:
+            # --- 1. Resolve courses, expiry and lesson manifests once for the whole cohort ---
+            if course_id:
+                course_ids = [course_id]
+                expiry_date = parse_period_to_expiry_date(expiry) if expiry else None
+            else:
+                if not ObjectId.is_valid(package_id):
+                    return failure(f"Invalid package_id: {package_id}")
+                package_doc = await packages_collection.find_one({"_id": ObjectId(package_id)})
+                if not package_doc:
+                    return failure(f"Package with id={package_id} not found.")
+                course_ids = [str(cid) for cid in package_doc.get("course_ids", [])]
+                if not course_ids:
+                    return failure(f"Package {package_id} contains no course_ids.")
+                expiry_date = _package_expiry_date(package_doc, expiry)
+            manifests = await ensure_current_manifests(course_ids)
+
+            # --- 2. Per-user validation (one query) ---
+            existing_users = set()
+            user_oids = [ObjectId(uid) for uid in user_ids if ObjectId.is_valid(uid)]
+            if user_oids:
+                async for doc in users_collection.find({"_id": {"$in": user_oids}}, projection={"_id": 1}):
+                    existing_users.add(str(doc["_id"]))
+            rejected = [
+                CohortEnrollmentResult(user_id=uid, success=False, message=f"User with id={uid} not found.")
+                for uid in user_ids if uid not in existing_users
+            ]
+            enrollable = [uid for uid in user_ids if uid in existing_users]
+            if not enrollable:
+                return CohortEnrollmentResponse(
+                    success=False, message="None of the given users exist.", enrolled_count=0,
+                    failed_count=len(rejected), results=rejected,
+                )
+
+            # --- 3. One progress document per course; the job adds the user ids ---
+            templates = [
+                progress_document(_new_progress_model("", cid, manifests[cid], expiry_date, package_id))
+                for cid in course_ids
+            ]
+            job_id = await job_runner.submit("enroll_cohort", enroll_cohort_job, user_ids=enrollable, templates=templates)
+        except Exception as e:
+            logger.error(f"enroll_cohort: Could not start enrollment: {e}")
+            return failure(f"Could not start enrollment: {e}")
+
+        message = (
+            f"Enrolling {len(enrollable)} user(s) in {len(course_ids)} course(s) as job {job_id}"
+            + (f"; {len(rejected)} user(s) not found." if rejected else ".")
+        )
+        logger.info(f"enroll_cohort: {message}")
+        return CohortEnrollmentResponse(
+            success=not rejected,
+            message=message,
+            enrolled_count=0,
+            failed_count=len(rejected),
+            results=rejected,
+            queued_count=len(enrollable),
+            job_id=job_id,
+        )
+
     # --- Enhanced Update Function ---
 
     @strawberry.mutation
@@ -2871,138 +3110,189 @@ class Mutation:
         lesson_id_str = data.lesson_id
         new_watch_time = data.new_watch_time_seconds
 
-        # --- Find Document & Validate Lesson Duration ---
-        doc = await progress_collection.find_one({
-            "user_id": user_id_str,
-            "course_id": course_id_str
-        })
-        
-        if not doc:
-            message = f"No document found for user_id/course_id: {user_id_str}, {course_id_str}"
-            # Changed to logger.warning
-            logger.warning(message)
-            return UpdateWatchTimeResponse(success=False, message=message)
-            
-        # Changed to logger.info
-        logger.info("User/Course document found.")
-
-        # --- LESSON DURATION VALIDATION ---
-        try:
-            lesson_ids = doc.get("lesson_ids", [])
-            lesson_durations = doc.get("lesson_duration", [])
-
-            try:
-                lesson_index = lesson_ids.index(lesson_id_str)
-            except ValueError:
-                message = f"Lesson ID {lesson_id_str} not found in lesson_ids array."
-                # Changed to logger.warning
-                logger.warning(message)
-                return UpdateWatchTimeResponse(success=False, message=message)
-
-            if lesson_index >= len(lesson_durations):
-                message = "Data mismatch: lesson_ids and lesson_duration arrays have different lengths."
-                # Changed to logger.error
-                logger.error(message)
-                return UpdateWatchTimeResponse(success=False, message=message)
-                
-            max_duration = lesson_durations[lesson_index]
-
-            # This is the validation you asked for:
-            if new_watch_time > max_duration:
-                message = f"VALIDATION FAILED: New watch time ({new_watch_time}) exceeds lesson duration ({max_duration})."
-                # Changed to logger.warning
+        # --- Buffered heartbeat: validated here, coalesced in memory and flushed by watch_buffer ---
+        if WATCH_TIME_BUFFER_ENABLED:
+            doc = await progress_collection.find_one(
+                {"user_id": user_id_str, "course_id": course_id_str},
+                projection=_WATCH_TIME_VALIDATION_PROJECTION,
+            )
+            if not doc:
+                message = f"No document found for user_id/course_id: {user_id_str}, {course_id_str}"
                 logger.warning(message)
                 return UpdateWatchTimeResponse(success=False, message=message)
-            
-            # Changed to logger.info
-            logger.info(f"Lesson validation passed: New time {new_watch_time} <= max duration {max_duration}.")
+            error = _validate_watch_time(await join_manifest(doc), lesson_id_str, new_watch_time)
+            if error:
+                logger.warning(error)
+                return UpdateWatchTimeResponse(success=False, message=error)
+            watch_time_buffer.add(user_id_str, course_id_str, lesson_id_str, new_watch_time)
+            return UpdateWatchTimeResponse(success=True, message="Update queued")
+
+        # --- v3 documents: validate against the cached lesson manifest, then write once ---
+        try:
+            manifest = await get_current_manifest(course_id_str)
+            if manifest is not None and lesson_id_str in manifest.lesson_ids:
+                max_duration = manifest.lesson_duration[manifest.lesson_ids.index(lesson_id_str)]
+                if new_watch_time > max_duration:
+                    message = f"VALIDATION FAILED: New watch time ({new_watch_time}) exceeds lesson duration ({max_duration})."
+                    logger.warning(message)
+                    return UpdateWatchTimeResponse(success=False, message=message)
+                updated = await progress_collection.find_one_and_update(
+                    {"user_id": user_id_str, "course_id": course_id_str, **V3_FILTER},
+                    keyed_watch_time_update_pipeline(lesson_id_str, new_watch_time),
+                    projection={"total_watch_time": 1},
+                    return_document=ReturnDocument.AFTER,
+                )
+                if updated:
+                    total_progress_percent = calculate_progress_percentage(
+                        updated.get("total_watch_time", 0) or 0,
+                        manifest.course_duration,
+                    )
+                    logger.info(f"Watch time updated for lesson {lesson_id_str}; course progress {total_progress_percent}%")
+                    return UpdateWatchTimeResponse(
+                        success=True,
+                        message="Update successful",
+                        total_progress_percent=total_progress_percent,
+                    )
+        except Exception as e:
+            message = f"Error updating watch time: {e}"
+            logger.error(message)
+            return UpdateWatchTimeResponse(success=False, message=str(e))
 
+        # --- Guarded update: the filter enforces the lesson duration, so one round trip validates and writes ---
+        # v2 (keyed) documents are tried first; v1 documents not yet migrated fall through to the array pipeline.
+        try:
+            updated = None
+            for schema_version, pipeline in (
+                (2, keyed_watch_time_update_pipeline(lesson_id_str, new_watch_time)),
+                (1, watch_time_update_pipeline(lesson_id_str, new_watch_time)),
+            ):
+                updated = await progress_collection.find_one_and_update(
+                    watch_time_guard_filter(user_id_str, course_id_str, lesson_id_str, new_watch_time, schema_version),
+                    pipeline,
+                    projection={"total_watch_time": 1, "course_duration": 1},
+                    return_document=ReturnDocument.AFTER,
+                )
+                if updated:
+                    break
         except Exception as e:
-            message = f"Error during validation: {e}"
+            message = f"Error updating watch time: {e}"
             # Changed to logger.error
             logger.error(message)
             return UpdateWatchTimeResponse(success=False, message=str(e))
-        # --- END LESSON VALIDATION ---
-
-        # --- Pipeline ---
-        pipeline = [
-            # Stage 1: Update the specific lesson's watch time
-            {
-                "$set": {
-                    "watch_times": {
-                        "$map": {
-                            "input": {"$ifNull": ["$watch_times", []]},
-                            "as": "lesson",
-                            "in": {
-                                "$mergeObjects": [
-                                    "$$lesson",
-                                    {
-                                        "$cond": {
-                                            "if": {"$eq": ["$$lesson.lesson_id", lesson_id_str]},
-                                            "then": {
-                                                "watch_time": {
-                                                    "$max": [
-                                                        new_watch_time,
-                                                        {"$ifNull": ["$$lesson.watch_time", 0]}
-                                                    ]
-                                                }
-                                            },
-                                            "else": {}
-                                        }
-                                    }
-                                ]
-                            }
-                        }
-                    }
-                }
-            },
-            # Stage 2: Recalculate and CLAMP the top-level 'total_watch_time'
-            {
-                "$set": {
-                    "total_watch_time": {
-                        "$min": [
-                            {
-                                "$sum": {
-                                    "$map": {
-                                        "input": "$watch_times",
-                                        "as": "lesson",
-                                        "in": {"$ifNull": ["$$lesson.watch_time", 0]}
-                                    }
-                                }
-                            },
-                            {"$ifNull": ["$course_duration", 100000000]}
-                        ]
-                    }
-                }
-            }
+
+        if updated:
+            total_progress_percent = calculate_progress_percentage(
+                updated.get("total_watch_time", 0) or 0,
+                updated.get("course_duration", 0) or 0,
+            )
+            logger.info(f"Watch time updated for lesson {lesson_id_str}; course progress {total_progress_percent}%")
+            return UpdateWatchTimeResponse(
+                success=True,
+                message="Update successful",
+                total_progress_percent=total_progress_percent,
+            )
+
+        # --- Guard rejected the update: read the document once to explain why ---
+        doc = await progress_collection.find_one(
+            {"user_id": user_id_str, "course_id": course_id_str},
+            projection=_WATCH_TIME_VALIDATION_PROJECTION,
+        )
+        if not doc:
+            message = f"No document found for user_id/course_id: {user_id_str}, {course_id_str}"
+        else:
+            message = (
+                _validate_watch_time(await join_manifest(doc), lesson_id_str, new_watch_time)
+                or "Update failed: Document changed during update operation."
+            )
+        # Changed to logger.warning
+        logger.warning(message)
+        return UpdateWatchTimeResponse(success=False, message=message)
+
+    @strawberry.mutation
+    async def update_lesson_watch_times(self, items: List[LessonWatchTimeInput]) -> UpdateWatchTimesResponse:
+        """
+        Batch version of update_lesson_watch_time for players syncing after being offline.
+        Reads each referenced progress document once and applies every valid item with a
+        single unordered bulk_write.
+        """
+        logger.info(f"update_lesson_watch_times: Received {len(items)} item(s)")
+        results = [
+            LessonWatchTimeResult(user_id=item.user_id, course_id=item.course_id, lesson_id=item.lesson_id, success=False)
+            for item in items
         ]
+        if not items:
+            return UpdateWatchTimesResponse(success=True, message="No items to update", updated_count=0, results=results)
 
-        # --- Run update ---
+        # --- One read for all referenced (user, course) documents ---
+        doc_keys = {(item.user_id, item.course_id) for item in items}
+        docs: Dict[Tuple[str, str], Dict[str, Any]] = {}
         try:
-            result = await progress_collection.update_one(
-                {
-                    "user_id": user_id_str,
-                    "course_id": course_id_str
-                },
-                pipeline,
+            cursor = progress_collection.find(
+                {"$or": [{"user_id": user_id, "course_id": course_id} for user_id, course_id in doc_keys]},
+                projection={"user_id": 1, **_WATCH_TIME_VALIDATION_PROJECTION},
             )
-            
-            # Changed to logger.info
-            logger.info(f"Update result: Matched={result.matched_count}, Modified={result.modified_count}")
-            
-            if result.matched_count == 1:
-                return UpdateWatchTimeResponse(success=True, message="Update successful")
-            else:
-                message = "Update failed: Document not found during update operation."
-                # Changed to logger.warning
-                logger.warning(message)
-                return UpdateWatchTimeResponse(success=False, message=message)
-                
+            async for doc in cursor:
+                docs[(doc["user_id"], doc["course_id"])] = await join_manifest(doc)
         except Exception as e:
-            message = f"Error updating watch time: {e}"
-            # Changed to logger.error
+            message = f"Error loading progress documents: {e}"
             logger.error(message)
-            return UpdateWatchTimeResponse(success=False, message=str(e))
+            for result in results:
+                result.message = message
+            return UpdateWatchTimesResponse(success=False, message=message, updated_count=0, results=results)
+
+        # --- Validate, keeping only the highest watch time per lesson ---
+        accepted: Dict[Tuple[str, str, str], Tuple[float, List[int]]] = {}
+        for index, item in enumerate(items):
+            doc = docs.get((item.user_id, item.course_id))
+            if not doc:
+                results[index].message = f"No document found for user_id/course_id: {item.user_id}, {item.course_id}"
+                continue
+            error = _validate_watch_time(doc, item.lesson_id, item.new_watch_time_seconds)
+            if error:
+                results[index].message = error
+                continue
+            key = (item.user_id, item.course_id, item.lesson_id)
+            watch_time, indexes = accepted.get(key, (item.new_watch_time_seconds, []))
+            accepted[key] = (max(watch_time, item.new_watch_time_seconds), indexes + [index])
+
+        if accepted and WATCH_TIME_BUFFER_ENABLED:
+            for (user_id, course_id, lesson_id), (watch_time, indexes) in accepted.items():
+                watch_time_buffer.add(user_id, course_id, lesson_id, watch_time)
+                for index in indexes:
+                    results[index].success = True
+                    results[index].message = "Update queued"
+        elif accepted:
+            keys = list(accepted.keys())
+            requests = [
+                request
+                for user_id, course_id, lesson_id in keys
+                for request in watch_time_update_requests(user_id, course_id, lesson_id, accepted[(user_id, course_id, lesson_id)][0])
+            ]
+            # Each key yields one request per schema version, see watch_time_update_requests
+            requests_per_key = len(requests) // len(keys)
+            failed: Dict[int, str] = {}
+            try:
+                await progress_collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details.get("writeErrors", []):
+                    failed[write_error["index"] // requests_per_key] = write_error.get("errmsg", "Write failed")
+            except Exception as e:
+                logger.error(f"update_lesson_watch_times: bulk_write failed: {e}")
+                failed = {position: str(e) for position in range(len(keys))}
+
+            for position, key in enumerate(keys):
+                for index in accepted[key][1]:
+                    results[index].success = position not in failed
+                    results[index].message = failed.get(position, "Update successful")
+
+        updated_count = sum(1 for result in results if result.success)
+        logger.info(f"update_lesson_watch_times: {updated_count}/{len(items)} item(s) applied")
+        return UpdateWatchTimesResponse(
+            success=updated_count == len(items),
+            message=f"{updated_count} of {len(items)} item(s) updated",
+            updated_count=updated_count,
+            results=results,
+        )
 
     @strawberry.mutation
     async def refresh_course_progress(
@@ -3015,96 +3305,27 @@ class Mutation:
         This fetches the latest lesson list for the course and updates all
         user progress records to match. It preserves existing watch times
         and adds new lessons with 0 watch time.
+
+        The work runs as a background job (see jobs.py); poll `jobStatus`
+        with the returned job_id for progress.
         """
         # Changed to logger.info
         logger.info(f"Refreshing progress for all users on Course {course_id}")
 
-        # --- 1. Fetch new lesson data ---
         try:
-            new_lesson_ids, new_lesson_durations, new_course_duration = \
-                await fetch_video_lessons_data(course_id)
+            job_id = await job_runner.submit("refresh_course_progress", refresh_course_progress_job, course_id=course_id)
         except Exception as e:
-            message = f"Failed to fetch video data for course {course_id}: {e}"
+            message = f"Could not start refresh job for course {course_id}: {e}"
             # Changed to logger.error
             logger.error(message)
             return RefreshProgressResponse(success=False, message=message, updated_count=0)
 
-        # --- 2. Build the Update Pipeline ---
-        # This pipeline will run for *every* document that matches.
-        pipeline = [
-            # --- Stage 1: Update simple fields and rebuild watch_times ---
-            {
-                "$set": {
-                    "lesson_ids": new_lesson_ids,
-                    "lesson_duration": new_lesson_durations,
-                    "course_duration": new_course_duration,
-                    "updated_at": datetime.now(timezone.utc),
-                    
-                    # Rebuild the watch_times array
-                    "watch_times": {
-                        "$map": {
-                            "input": new_lesson_ids, # Iterate over the NEW lesson list
-                            "as": "new_lesson_id",
-                            "in": {
-                                "lesson_id": "$$new_lesson_id",
-                                "watch_time": {
-                                    # Find the matching lesson in the OLD $watch_times array
-                                    "$let": {
-                                        "vars": {
-                                            "old_lesson": {
-                                                "$arrayElemAt": [
-                                                    {
-                                                        "$filter": {
-                                                            "input": "$watch_times", # The doc's old array
-                                                            "as": "wt",
-                                                            "cond": {"$eq": ["$$wt.lesson_id", "$$new_lesson_id"]}
-                                                        }
-                                                    }, 0
-                                                ]
-                                            }
-                                        },
-                                        # Use the old watch time, or default to 0.0
-                                        "in": {"$ifNull": ["$$old_lesson.watch_time", 0.0]} 
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            },
-            # --- Stage 2: Recalculate total_watch_time ---
-            # This runs after 'watch_times' is set by Stage 1
-            {
-                "$set": {
-                    "total_watch_time": {
-                        # Sum up all the 'watch_time' fields in the new array
-                        "$sum": "$watch_times.watch_time" 
-                    }
-                }
-            }
-        ]
-
-        # --- 3. Run update_many ---
-        try:
-            result = await progress_collection.update_many(
-                {"course_id": course_id}, # Filter: find all docs for this course
-                pipeline                  # Pipeline: apply all the changes
-            )
-            
-            message = f"Successfully refreshed progress for {result.modified_count} users."
-            # Changed to logger.info
-            logger.info(message)
-            return RefreshProgressResponse(
-                success=True, 
-                message=message, 
-                updated_count=result.modified_count
-            )
-
-        except Exception as e:
-            message = f"Database error during refresh: {e}"
-            # Changed to logger.error
-            logger.error(message)
-            return RefreshProgressResponse(success=False, message=message, updated_count=0)
+        return RefreshProgressResponse(
+            success=True,
+            message=f"Refresh of course {course_id} started as job {job_id}.",
+            updated_count=0,
+            job_id=job_id,
+        )
 
 
 # Create the schema
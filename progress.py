@@ -0,0 +1,331 @@
+# progress.py
+"""
+Update pipelines for courseprogress documents, shared by the GraphQL mutations
+and the background writers (watch-time buffer, jobs).
+
+Three document layouts coexist while the migrations roll out:
+
+- v1 (no `schema_version`): `watch_times` is an array of {lesson_id, watch_time}
+  parallel to `lesson_ids`, so every heartbeat `$map`s the whole array.
+- v2 (`schema_version: 2`): `lesson_watch_times` is a subdocument keyed by
+  lesson id, so a heartbeat touches exactly one path and adjusts
+  `total_watch_time` by the delta. Only watched lessons have a key; a missing
+  key reads as 0.
+- v3 (`schema_version: 3`): like v2, but the lesson list is not copied into the
+  document; `manifest_version` points at the shared lesson manifest of the
+  course (see manifests.py).
+
+Writers send one filter per layout; readers normalize through
+manifests.join_manifest and CourseProgressModel.
+"""
+from pymongo import UpdateOne
+from typing import Any, Dict, List, Optional
+
+PROGRESS_SCHEMA_VERSION = 3
+
+V1_FILTER = {"schema_version": {"$exists": False}}
+V2_FILTER = {"schema_version": 2}
+V3_FILTER = {"schema_version": 3}
+
+
+def _watch_time_path(lesson_id: str) -> str:
+    # Lesson ids are ObjectId hex strings; anything else could escape the subdocument
+    if not lesson_id or "." in lesson_id or lesson_id.startswith("$"):
+        raise ValueError(f"Invalid lesson id: {lesson_id!r}")
+    return f"lesson_watch_times.{lesson_id}"
+
+
+def watch_time_guard_filter(
+    user_id: str, course_id: str, lesson_id: str, new_watch_time: float, schema_version: int = 2
+) -> Dict[str, Any]:
+    """
+    Matches the user's v1/v2 progress document only if it tracks `lesson_id` and
+    the lesson's stored duration is at least `new_watch_time`. Used as the update
+    filter so validation and write happen in a single round trip. (v3 documents
+    carry no durations; they are validated against the cached manifest instead.)
+    """
+    return {
+        "user_id": user_id,
+        "course_id": course_id,
+        **(V2_FILTER if schema_version == 2 else V1_FILTER),
+        "lesson_ids": lesson_id,
+        "$expr": {
+            "$lte": [
+                new_watch_time,
+                {"$arrayElemAt": ["$lesson_duration", {"$indexOfArray": ["$lesson_ids", lesson_id]}]}
+            ]
+        },
+    }
+
+
+def keyed_watch_time_update_pipeline(lesson_id: str, new_watch_time: float) -> List[Dict[str, Any]]:
+    """
+    v2/v3 layout: raises `lesson_watch_times.<lesson_id>` to `new_watch_time` and adds
+    the increase to total_watch_time (clamped to course_duration). Only that one
+    path is read and written, so the cost does not depend on how many lessons the
+    course has.
+    """
+    path = _watch_time_path(lesson_id)
+    current = {"$ifNull": [f"${path}", 0]}
+    return [
+        # Stage 1: Add the increase to the total while the old lesson value is still in place
+        {
+            "$set": {
+                "total_watch_time": {
+                    "$min": [
+                        {
+                            "$add": [
+                                {"$ifNull": ["$total_watch_time", 0]},
+                                {"$max": [0, {"$subtract": [new_watch_time, current]}]}
+                            ]
+                        },
+                        {"$ifNull": ["$course_duration", 100000000]}
+                    ]
+                }
+            }
+        },
+        # Stage 2: Raise the lesson's own watch time
+        {"$set": {path: {"$max": [new_watch_time, current]}}}
+    ]
+
+
+def watch_time_update_pipeline(lesson_id: str, new_watch_time: float) -> List[Dict[str, Any]]:
+    """
+    v1 layout: raises one lesson's watch time to `new_watch_time` (never lowers it)
+    and recalculates the clamped total_watch_time.
+    """
+    return [
+        # Stage 1: Update the specific lesson's watch time
+        {
+            "$set": {
+                "watch_times": {
+                    "$map": {
+                        "input": {"$ifNull": ["$watch_times", []]},
+                        "as": "lesson",
+                        "in": {
+                            "$mergeObjects": [
+                                "$$lesson",
+                                {
+                                    "$cond": {
+                                        "if": {"$eq": ["$$lesson.lesson_id", lesson_id]},
+                                        "then": {
+                                            "watch_time": {
+                                                "$max": [
+                                                    new_watch_time,
+                                                    {"$ifNull": ["$$lesson.watch_time", 0]}
+                                                ]
+                                            }
+                                        },
+                                        "else": {}
+                                    }
+                                }
+                            ]
+                        }
+                    }
+                }
+            }
+        },
+        # Stage 2: Recalculate and CLAMP the top-level 'total_watch_time'
+        {
+            "$set": {
+                "total_watch_time": {
+                    "$min": [
+                        {
+                            "$sum": {
+                                "$map": {
+                                    "input": "$watch_times",
+                                    "as": "lesson",
+                                    "in": {"$ifNull": ["$$lesson.watch_time", 0]}
+                                }
+                            }
+                        },
+                        {"$ifNull": ["$course_duration", 100000000]}
+                    ]
+                }
+            }
+        }
+    ]
+
+
+def watch_time_update_requests(user_id: str, course_id: str, lesson_id: str, new_watch_time: float) -> List[UpdateOne]:
+    """
+    Bulk-write requests raising one lesson's watch time. One request per layout;
+    the version filters guarantee at most one of them matches.
+    """
+    key = {"user_id": user_id, "course_id": course_id}
+    return [
+        UpdateOne({**key, **V3_FILTER}, keyed_watch_time_update_pipeline(lesson_id, new_watch_time)),
+        UpdateOne({**key, **V2_FILTER}, keyed_watch_time_update_pipeline(lesson_id, new_watch_time)),
+        UpdateOne({**key, **V1_FILTER}, watch_time_update_pipeline(lesson_id, new_watch_time)),
+    ]
+
+
+def keyed_watch_times_from_array_expression() -> Dict[str, Any]:
+    """
+    Aggregation expression building the v2 `lesson_watch_times` subdocument from a
+    v1 `watch_times` array. Lessons without watch time get no key (a missing key reads as 0).
+    """
+    return {
+        "$arrayToObject": {
+            "$map": {
+                "input": {
+                    "$filter": {
+                        "input": {"$ifNull": ["$watch_times", []]},
+                        "as": "wt",
+                        "cond": {"$gt": [{"$ifNull": ["$$wt.watch_time", 0]}, 0]}
+                    }
+                },
+                "as": "wt",
+                "in": {"k": "$$wt.lesson_id", "v": "$$wt.watch_time"}
+            }
+        }
+    }
+
+
+def refresh_keyed_watch_times_pipeline(
+    lesson_ids: List[str], lesson_durations: List[float], course_duration: float, updated_at,
+    manifest_hash: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    v2 counterpart of the refresh_course_progress pipeline: installs the new lesson
+    list and keeps the watch time of every lesson that is still part of the course.
+    """
+    return [
+        {
+            "$set": {
+                "lesson_ids": lesson_ids,
+                "lesson_duration": lesson_durations,
+                "course_duration": course_duration,
+                "manifest_hash": manifest_hash,
+                "updated_at": updated_at,
+                "lesson_watch_times": _pruned_watch_times_expression(lesson_ids),
+            }
+        },
+        {"$set": {"total_watch_time": _keyed_total_expression()}}
+    ]
+
+
+def refresh_manifest_watch_times_pipeline(
+    manifest, updated_at, removed_lesson_ids: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    v3 refresh: points the document at `manifest`, drops watch times of lessons
+    that left the course and recomputes the clamped total. The lesson list itself
+    is not written; it stays in the manifest.
+
+    `removed_lesson_ids` are the lessons of the document's own manifest that are
+    not in `manifest`; only their keys are unset. Without it (the document's
+    manifest is unknown) the map is rebuilt with the lessons of `manifest`.
+    """
+    if removed_lesson_ids is None:
+        prune = [{"$set": {"lesson_watch_times": _pruned_watch_times_expression(manifest.lesson_ids)}}]
+    elif removed_lesson_ids:
+        prune = [{"$unset": [_watch_time_path(lid) for lid in removed_lesson_ids]}]
+    else:
+        prune = []
+    return [
+        *prune,
+        {
+            "$set": {
+                "manifest_version": manifest.version,
+                "manifest_hash": manifest.content_hash,
+                "updated_at": updated_at,
+                "total_watch_time": {"$min": [_keyed_total_expression(), manifest.course_duration]},
+            }
+        },
+    ]
+
+
+def append_lessons_update(manifest, schema_version: int, updated_at) -> Dict[str, Any]:
+    """
+    Refresh for a v2/v3 document built from the previous manifest when the new one
+    only appended lessons: a plain `$set` of the lesson data, no pipeline. Watch
+    times and the total stay valid; the new lessons have no key yet and read as 0.
+    """
+    if schema_version == 2:
+        fields = {
+            "lesson_ids": manifest.lesson_ids,
+            "lesson_duration": manifest.lesson_duration,
+            "course_duration": manifest.course_duration,
+        }
+    else:
+        fields = {"manifest_version": manifest.version}
+    return {"$set": {**fields, "manifest_hash": manifest.content_hash, "updated_at": updated_at}}
+
+
+def _pruned_watch_times_expression(lesson_ids: List[str]) -> Dict[str, Any]:
+    # Keeps the non-zero watch times of `lesson_ids`; every other key is dropped
+    return {
+        "$arrayToObject": {
+            "$filter": {
+                "input": {"$objectToArray": {"$ifNull": ["$lesson_watch_times", {}]}},
+                "as": "wt",
+                "cond": {"$and": [{"$in": ["$$wt.k", lesson_ids]}, {"$gt": ["$$wt.v", 0]}]}
+            }
+        }
+    }
+
+
+def _keyed_total_expression() -> Dict[str, Any]:
+    return {
+        "$sum": {
+            "$map": {
+                "input": {"$objectToArray": "$lesson_watch_times"},
+                "as": "wt",
+                "in": "$$wt.v"
+            }
+        }
+    }
+
+
+def progress_document(model) -> Dict[str, Any]:
+    """
+    Serializes a CourseProgressModel for insertion. v2+ documents don't store the
+    `watch_times` array and v3 documents don't store the manifest's lesson data.
+    """
+    document = model.model_dump(by_alias=True, exclude_none=True)
+    if document.get("schema_version", 1) >= 2:
+        document.pop("watch_times", None)
+    if document.get("schema_version", 1) >= 3:
+        for field in ("lesson_ids", "lesson_duration", "course_duration"):
+            document.pop(field, None)
+    return document
+
+
+# Fields a repeated enrollment may change on an existing progress document;
+# everything else (watch times, manifest version, timestamps) is only set on insert.
+_REENROLL_FIELDS = ("expiry", "package_id")
+
+
+def progress_upsert_request(document: Dict[str, Any]) -> UpdateOne:
+    """
+    Idempotent enrollment write for a document built by progress_document():
+    creates the (user_id, course_id) progress document if it is missing, otherwise
+    keeps its watch times and only refreshes expiry/package_id.
+    """
+    key = {"user_id": document["user_id"], "course_id": document["course_id"]}
+    on_insert = {
+        field: value for field, value in document.items()
+        if field not in key and field not in _REENROLL_FIELDS and field not in ("_id", "updated_at")
+    }
+    changes = {field: document[field] for field in (*_REENROLL_FIELDS, "updated_at") if field in document}
+    update: Dict[str, Any] = {"$setOnInsert": on_insert}
+    if changes:
+        update["$set"] = changes
+    return UpdateOne(key, update, upsert=True)
+
+
+def refresh_array_watch_times_pipeline(
+    lesson_ids: List[str], lesson_durations: List[float], course_duration: float, updated_at,
+    manifest_hash: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    v1 refresh. Rather than rebuilding the `watch_times` array with a `$filter`
+    per lesson (O(lessons²) per document), the document is first converted to the
+    v2 keyed layout and then refreshed like any v2 document.
+    """
+    return [
+        {"$set": {"lesson_watch_times": keyed_watch_times_from_array_expression(), "schema_version": 2}},
+        {"$unset": "watch_times"},
+        *refresh_keyed_watch_times_pipeline(lesson_ids, lesson_durations, course_duration, updated_at, manifest_hash),
+    ]
@@ -0,0 +1,81 @@
+# static_files.py
+"""
+Serves the `uploads/` tree (package banners and themes) at /uploads.
+
+Starlette's FileResponse already answers Range requests, sends ETag and
+Last-Modified, and uses the ASGI pathsend extension (zero-copy) when the server
+offers it. On top of that, uploads get a long-lived `immutable` Cache-Control:
+upload filenames are content hashes (UUIDs for older uploads), so a URL's
+content never changes.
+
+Only the image types the upload pipeline writes are served, always with an
+explicit image Content-Type and `X-Content-Type-Options: nosniff`; any other
+name (including `*.part` temp files) is a 404, so nothing under uploads/ can be
+rendered as HTML or script on the API origin.
+
+Behind nginx, set UPLOADS_ACCEL_REDIRECT_PREFIX to an `internal` location
+aliasing the uploads folder; the app then only answers with X-Accel-Redirect
+and nginx streams the file with sendfile.
+"""
+import os
+from dotenv import load_dotenv
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+load_dotenv()
+
+UPLOADS_CACHE_MAX_AGE_SECONDS = int(os.getenv("UPLOADS_CACHE_MAX_AGE_SECONDS", str(365 * 24 * 3600)))
+# e.g. "/_protected_uploads/"; empty serves files from the app itself
+UPLOADS_ACCEL_REDIRECT_PREFIX = os.getenv("UPLOADS_ACCEL_REDIRECT_PREFIX", "")
+
+# Extensions images.py writes (".jpeg" for uploads stored before names were derived from the format)
+UPLOAD_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".avif": "image/avif",
+}
+
+
+def _media_type(path: str):
+    return UPLOAD_MEDIA_TYPES.get(os.path.splitext(path)[1].lower())
+
+
+class UploadFiles(StaticFiles):
+    """StaticFiles for images only, with immutable caching, nosniff and optional nginx X-Accel-Redirect."""
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if _media_type(path) is None:
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        media_type = _media_type(str(full_path))
+        if media_type is None:
+            raise HTTPException(status_code=404)
+        headers = {
+            "cache-control": f"public, max-age={UPLOADS_CACHE_MAX_AGE_SECONDS}, immutable",
+            "x-content-type-options": "nosniff",
+        }
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, headers=headers, media_type=media_type
+        )
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        if UPLOADS_ACCEL_REDIRECT_PREFIX:
+            relative = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+            headers["x-accel-redirect"] = UPLOADS_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative
+            headers["etag"] = response.headers["etag"]
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        return response
@@ -0,0 +1,163 @@
+# bench_graphql_context.py
+"""
+Per-request latency of the lazy GraphQLContext (main.get_context) against an
+eager context that verifies the token before every request, as get_context did
+before. Requests go through the real GraphQLRouter and schema:
+
+- anonymous `{ __typename }` and `allCourses` (no Authorization header)
+- the same public queries sent with a valid token (a logged-in user browsing)
+- authenticated `createPackage` (draft), which needs the user either way
+
+    python tests/bench_graphql_context.py [--requests 300] [--no-token-cache] [--mongo]
+
+By default the database is an in-memory mongomock one (mongomock-motor, see
+requirements-dev.txt), so the numbers show the CPU cost of auth. With --mongo
+the configured MongoDB is used; the draft packages created are deleted again.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import jwt
+from bson import ObjectId
+from fastapi import FastAPI, Request
+from strawberry.fastapi import GraphQLRouter
+
+import authenticate
+import db
+from main import GraphQLContext, get_context
+from mutationss import schema
+
+_BENCHMARK_TITLE_PREFIX = "context-benchmark-"
+
+
+async def eager_get_context(request: Request) -> GraphQLContext:
+    """The pre-lazy behaviour: every request verifies its token before any resolver runs."""
+    context = GraphQLContext()
+    context.request = request
+    await context.get_current_user()
+    return context
+
+
+def _app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(GraphQLRouter(schema, context_getter=get_context), prefix="/lazy")
+    app.include_router(GraphQLRouter(schema, context_getter=eager_get_context), prefix="/eager")
+    return app
+
+
+async def _login() -> str:
+    """Creates a user with a stored login token, the way Mutation.login does, and returns the token."""
+    user_id = ObjectId()
+    await db.users_collection.insert_one({"_id": user_id, "name": "Benchmark", "email": "benchmark@example.com"})
+    payload = {
+        "id": str(user_id),
+        "name": "Benchmark",
+        "email": "benchmark@example.com",
+        "exp": datetime.now(timezone.utc) + timedelta(hours=1),
+        "jti": str(uuid.uuid4()),
+    }
+    token = jwt.encode(payload, authenticate.JWT_SECRET, algorithm="HS256")
+    await db.logins_collection.insert_one({"user_id": user_id, "token": token, "created_at": datetime.utcnow()})
+    return token
+
+
+def _percentile(values, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def _time(client: httpx.AsyncClient, path: str, query, headers, requests: int):
+    latencies = []
+    for _ in range(requests):
+        body = {"query": query() if callable(query) else query}
+        started = time.perf_counter()
+        response = await client.post(path, json=body, headers=headers)
+        latencies.append(time.perf_counter() - started)
+        data = response.json()
+        if response.status_code != 200 or data.get("errors"):
+            raise RuntimeError(f"{path}: {response.status_code} {data}")
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+    }
+
+
+async def benchmark(requests: int):
+    token = await _login()
+    auth = {"Authorization": f"Bearer {token}"}
+    run_id = uuid.uuid4().hex[:8]
+    package_numbers = itertools.count()
+
+    def create_package() -> str:
+        # Titles must be unique per package
+        return (
+            'mutation { createPackage(isDraft: true, title: "%s%s-%d") { status message } }'
+            % (_BENCHMARK_TITLE_PREFIX, run_id, next(package_numbers))
+        )
+
+    scenarios = [
+        ("{ __typename } anonymous", "{ __typename }", {}),
+        ("allCourses anonymous", "{ allCourses { totalCount } }", {}),
+        ("{ __typename } with token", "{ __typename }", auth),
+        ("allCourses with token", "{ allCourses { totalCount } }", auth),
+        ("createPackage with token", create_package, auth),
+    ]
+    transport = httpx.ASGITransport(app=_app())
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for name, query, headers in scenarios:
+            # Warm up both paths before timing
+            for path in ("/lazy", "/eager"):
+                await _time(client, path, query, headers, 3)
+            runs = {"/lazy": [], "/eager": []}
+            # Interleaved, best of two per context, so drift (GC, growing collections) affects both alike
+            for path in ("/lazy", "/eager", "/lazy", "/eager"):
+                runs[path].append(await _time(client, path, query, headers, requests))
+            results.append((name, {path: min(timed, key=lambda r: r["p50_ms"]) for path, timed in runs.items()}))
+    await db.packages_collection.delete_many({"title": {"$regex": f"^{_BENCHMARK_TITLE_PREFIX}{run_id}"}})
+    return results
+
+
+async def _main(args: argparse.Namespace) -> int:
+    if args.no_token_cache:
+        authenticate.token_cache.ttl_seconds = 0
+    if args.mongo:
+        await db.connect()
+    else:
+        import mongomock_motor
+        db.client = mongomock_motor.AsyncMongoMockClient()
+        db._database = db.client["context_benchmark"]
+    if not authenticate.JWT_SECRET:
+        authenticate.JWT_SECRET = uuid.uuid4().hex
+    try:
+        results = await benchmark(args.requests)
+    finally:
+        if args.mongo:
+            await db.users_collection.delete_many({"email": "benchmark@example.com"})
+            db.close()
+    print(f"requests per scenario: {args.requests} | token cache: {'off' if args.no_token_cache else 'on'}"
+          f" | database: {'configured MongoDB' if args.mongo else 'in-memory'}")
+    print(f"{'scenario':<28} {'lazy p50':>9} {'eager p50':>10} {'lazy p95':>9} {'eager p95':>10}")
+    for name, rows in results:
+        lazy, eager = rows["/lazy"], rows["/eager"]
+        print(f"{name:<28} {lazy['p50_ms']:>7.2f}ms {eager['p50_ms']:>8.2f}ms {lazy['p95_ms']:>7.2f}ms {eager['p95_ms']:>8.2f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the lazy GraphQL context against an eager one.")
+    parser.add_argument("--requests", type=int, default=300, help="timed requests per scenario and context")
+    parser.add_argument("--no-token-cache", action="store_true", help="verify the token against MongoDB on every request")
+    parser.add_argument("--mongo", action="store_true", help="use the configured MongoDB instead of an in-memory one")
+    sys.exit(asyncio.run(_main(parser.parse_args())))
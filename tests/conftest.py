@@ -0,0 +1,47 @@
+# conftest.py
+"""
+Shared fixtures. Tests run against an in-memory mongomock database, so no MongoDB
+server is needed: `pip install -r requirements-dev.txt`, then `python -m pytest tests`
+from the repository root.
+"""
+import inspect
+import os
+import sys
+
+import mongomock_motor
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+
+def _accept_newer_bulk_arguments(monkeypatch):
+    """
+    pymongo 4.9+ passes arguments (e.g. `sort`) to bulk_write builders that
+    mongomock 4.3 does not know; drop them so bulk_write works in tests.
+    """
+    import mongomock.collection
+
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ("add_insert", "add_update", "add_replace", "add_delete"):
+        original = getattr(builder, name)
+        known = set(inspect.signature(original).parameters)
+
+        def add(self, *args, _original=original, _known=known, **kwargs):
+            return _original(self, *args, **{k: v for k, v in kwargs.items() if k in _known})
+
+        monkeypatch.setattr(builder, name, add)
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    """Points db's lazy collections at a fresh in-memory database for one test."""
+    _accept_newer_bulk_arguments(monkeypatch)
+    saved = db.client, db._database
+    db.client = mongomock_motor.AsyncMongoMockClient()
+    db._database = db.client["test"]
+    try:
+        yield db._database
+    finally:
+        db.client, db._database = saved
@@ -0,0 +1,125 @@
+# test_analytics.py
+"""Parity of the admin analytics pipelines (analytics.py) with the old in-Python computation."""
+import asyncio
+import random
+
+import analytics
+
+
+def _purchases(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    view_percents = [0, 12.5, 96.99, 97, 97.0, 100, 150.0, None]
+    purchases = []
+    for i in range(count):
+        courses = []
+        for _ in range(rng.randint(0, 4)):
+            course = {"course_id": rng.choice(["c1", "c2", "c3", "c4", ""])}
+            if rng.random() < 0.9:
+                course["course_view_percent"] = rng.choice(view_percents)
+            if rng.random() < 0.8:
+                course["certificate_sent"] = rng.random() < 0.4
+            courses.append(course)
+        purchase = {"user_id": f"u{rng.randint(1, count // 3 + 1)}", "courses": courses}
+        if rng.random() < 0.8:
+            purchase["package_id"] = rng.choice(["p1", "p2", None, ""])
+        if rng.random() < 0.05:
+            del purchase["courses"]
+        purchases.append(purchase)
+    return purchases
+
+
+def _normalized(stats):
+    return {
+        key: sorted(value) if key.startswith("users_with") else value
+        for key, value in stats.items()
+    }
+
+
+def test_pipeline_matches_python(mock_db):
+    purchases = _purchases(300)
+
+    async def run():
+        await analytics.purchased_collection.insert_many([dict(p) for p in purchases])
+        return await analytics.compute_purchase_analytics({})
+
+    stats = asyncio.run(run())
+    assert _normalized(stats) == _analytics_reference(purchases)
+
+
+def test_pipeline_matches_python_with_filter(mock_db):
+    purchases = _purchases(200, seed=11)
+    query = {"package_id": "p1"}
+
+    async def run():
+        await analytics.purchased_collection.insert_many([dict(p) for p in purchases])
+        return await analytics.compute_purchase_analytics(query)
+
+    stats = asyncio.run(run())
+    assert _normalized(stats) == _analytics_reference([p for p in purchases if p.get("package_id") == "p1"])
+
+
+def test_view_percent_counts_only_numbers(mock_db):
+    purchases = [{"user_id": "u1", "courses": [
+        {"course_id": "c1", "course_view_percent": 97},
+        {"course_id": "c2", "course_view_percent": 99.5},
+        {"course_id": "c3", "course_view_percent": None},
+        {"course_id": "c4"},
+        {"course_id": "c5", "course_view_percent": 96.9},
+        {"course_id": "c6", "course_view_percent": "98"},
+    ]}]
+
+    async def run():
+        await analytics.purchased_collection.insert_many([dict(p) for p in purchases])
+        return await analytics.compute_purchase_analytics({})
+
+    assert asyncio.run(run())["completed_courses"] == 2
+    # The old computation coerced numeric strings; this is the one intended difference
+    assert analytics._python_purchase_analytics(purchases)["completed_courses"] == 3
+
+
+def _analytics_reference(purchases):
+    return _normalized(analytics._python_purchase_analytics(purchases))
+
+
+def test_reconcile_rebuilds_rollups(mock_db):
+    purchases = _purchases(120, seed=3)
+
+    async def run():
+        await analytics.purchased_collection.insert_many([dict(p) for p in purchases])
+        # Drift: a user without purchases and a wrong total
+        await analytics.analytics_rollups_collection.insert_many([
+            {"_id": "user:gone", "kind": "user", "user_id": "gone", "purchases": 2, "cert_true": 0, "cert_false": 1},
+            {"_id": analytics.PURCHASE_ROLLUP_ID, "total_purchases": 5, "writes": 4},
+        ])
+        report = await analytics.reconcile_purchase_rollups()
+        return report, await analytics.read_purchase_rollups(), await analytics.compute_purchase_analytics({})
+
+    report, rollups, computed = asyncio.run(run())
+    assert report["applied"] and report["conflicts"] == 0
+    assert report["drift"]["total_purchases"] == (5, 120)
+    assert _normalized(rollups) == _normalized(computed)
+
+
+def test_reconcile_does_not_overwrite_concurrent_writes(mock_db, monkeypatch):
+    purchases = _purchases(60, seed=5)
+    fresh_rollups = analytics._fresh_rollups
+
+    async def fresh_rollups_with_concurrent_purchase():
+        result = await fresh_rollups()
+        # A purchase written while the reconcile scans
+        purchase = {"user_id": "late", "courses": [{"course_id": "c1", "certificate_sent": True}]}
+        await analytics.purchased_collection.insert_one(dict(purchase))
+        await analytics.record_purchase_change(None, purchase)
+        return result
+
+    async def run():
+        await analytics.purchased_collection.insert_many([dict(p) for p in purchases])
+        await analytics.reconcile_purchase_rollups()
+        monkeypatch.setattr(analytics, "_fresh_rollups", fresh_rollups_with_concurrent_purchase)
+        report = await analytics.reconcile_purchase_rollups()
+        return report, await analytics.read_purchase_rollups(), await analytics.compute_purchase_analytics({})
+
+    report, rollups, computed = asyncio.run(run())
+    assert not report["applied"] and report["conflicts"] > 0
+    # The concurrent $inc was kept, so the rollups still match the purchases
+    assert _normalized(rollups) == _normalized(computed)
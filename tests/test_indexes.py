@@ -0,0 +1,42 @@
+# test_indexes.py
+"""
+Explain check of the resolver queries (indexes.py) against a real MongoDB:
+mongomock has no query planner. Runs only when MONGO_TEST_URI is set, e.g.
+
+    MONGO_TEST_URI=mongodb://localhost:27017 python -m pytest tests/test_indexes.py
+
+It works in a scratch database that is dropped afterwards.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+import db
+import indexes
+
+MONGO_TEST_URI = os.getenv("MONGO_TEST_URI")
+
+pytestmark = pytest.mark.skipif(not MONGO_TEST_URI, reason="MONGO_TEST_URI is not set")
+
+
+def test_resolver_queries_use_indexes_without_in_memory_sort():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    async def run():
+        saved = db.client, db._database
+        name = f"indexes_test_{uuid.uuid4().hex[:8]}"
+        db.client = AsyncIOMotorClient(MONGO_TEST_URI)
+        db._database = db.client[name]
+        try:
+            created = await indexes.ensure_indexes()
+            return created, await indexes.explain_resolver_queries()
+        finally:
+            await db.client.drop_database(name)
+            db.client.close()
+            db.client, db._database = saved
+
+    created, rejected = asyncio.run(run())
+    assert set(created) == set(indexes.INDEXES)
+    assert rejected == []
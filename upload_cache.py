@@ -0,0 +1,122 @@
+# upload_cache.py
+"""
+In-process cache of base64-encoded upload files (package banners and themes).
+
+`bannerBase64` / `themeBase64` are only resolved when a client selects them.
+Files are read and encoded in a worker thread so the event loop never blocks on
+disk, and the encoded string is kept in an LRU keyed by (path, mtime, size).
+Re-uploading or replacing a file changes its key, so stale entries simply age
+out. The cache is bounded by UPLOAD_BASE64_CACHE_MAX_BYTES of encoded data.
+"""
+import asyncio
+import base64
+import logging
+import os
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import Any, Dict, Optional, Tuple
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+UPLOADS_DIR = "uploads"
+UPLOAD_BASE64_CACHE_MAX_BYTES = int(os.getenv("UPLOAD_BASE64_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_Key = Tuple[str, int, int]
+
+
+def upload_path(url: Optional[str]) -> Optional[str]:
+    """Maps a `/uploads/...` URL to its file path, or None if it points outside the uploads folder."""
+    if not url:
+        return None
+    path = os.path.normpath(url.lstrip('/'))
+    if path != UPLOADS_DIR and not path.startswith(UPLOADS_DIR + os.sep):
+        return None
+    return path
+
+
+def _stat_key(path: str) -> _Key:
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _read_base64(path: str) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+class Base64FileCache:
+    """LRU of base64-encoded files with a byte budget."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[_Key, str]" = OrderedDict()
+        self._loading: Dict[_Key, "asyncio.Future[str]"] = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, key: _Key, encoded: str):
+        # A single file larger than a quarter of the budget would evict everything else
+        if len(encoded) > self.max_bytes // 4:
+            return
+        self._entries[key] = encoded
+        self.size_bytes += len(encoded)
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted)
+
+    async def _load(self, key: _Key) -> str:
+        encoded = await asyncio.to_thread(_read_base64, key[0])
+        self._put(key, encoded)
+        return encoded
+
+    async def get(self, url: Optional[str]) -> Optional[str]:
+        """Base64 of the file behind an upload URL, or None if there is none."""
+        path = upload_path(url)
+        if path is None:
+            return None
+        try:
+            key = await asyncio.to_thread(_stat_key, path)
+        except FileNotFoundError:
+            logger.warning(f"Base64FileCache: File not found at {path}")
+            return None
+        except Exception as e:
+            logger.error(f"Base64FileCache: Error reading {path}: {e}")
+            return None
+
+        encoded = self._entries.get(key)
+        if encoded is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return encoded
+        self.misses += 1
+
+        # The same banner is often shared by many packages of one listing; read it once
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(key))
+            self._loading[key] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        try:
+            return await asyncio.shield(loading)
+        except Exception as e:
+            logger.error(f"Base64FileCache: Error reading {path}: {e}")
+            return None
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+upload_base64_cache = Base64FileCache(UPLOAD_BASE64_CACHE_MAX_BYTES)
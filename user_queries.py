@@ -0,0 +1,85 @@
+# user_queries.py
+"""
+Filters and sort order of the allUsers queries, shared by the resolver and the
+index explain check (indexes.py), so the check explains exactly what the
+resolver sends.
+
+isActive / isDeleted are loosely typed (bools, 0/1 and strings depending on the
+writer); TRUTHY_FLAG_VALUES lists what the resolvers have historically treated
+as "true".
+
+The list is keyset-paginated on (createdAt desc, _id desc); cursors are opaque
+base64 strings of that position.
+"""
+import base64
+import json
+from bson import ObjectId
+from datetime import datetime
+from pymongo import DESCENDING
+from typing import Any, Dict, List, Optional, Tuple
+
+TRUTHY_FLAG_VALUES = [True, 1, "true", "True", "TRUE", "1", "yes", "Yes", "YES", "y", "Y", "active", "Active"]
+
+USERS_LIST_SORT = [("createdAt", DESCENDING), ("_id", DESCENDING)]
+
+DELETED_USERS_FILTER = {"isDeleted": {"$in": TRUTHY_FLAG_VALUES}}
+NON_DELETED_USERS_FILTER = {"isDeleted": {"$nin": TRUTHY_FLAG_VALUES}}
+# active_count: active users among the non-deleted ones
+ACTIVE_USERS_FILTER = {"isActive": {"$in": TRUTHY_FLAG_VALUES}, **NON_DELETED_USERS_FILTER}
+
+
+def users_list_filters(active: Optional[bool], is_deleted: Optional[bool]) -> List[Dict[str, Any]]:
+    """
+    Filters of the allUsers list for its `active` / `is_deleted` arguments:
+
+    - is_deleted: None -> both, True -> only deleted, False -> only non-deleted
+    - active: None -> ignore isActive, True -> isActive truthy,
+      False -> users that EXPLICITLY have isActive present AND falsy
+    """
+    filters: List[Dict[str, Any]] = []
+    if is_deleted is True:
+        filters.append(DELETED_USERS_FILTER)
+    elif is_deleted is False:
+        filters.append(NON_DELETED_USERS_FILTER)
+
+    if active is True:
+        filters.append({"isActive": {"$in": TRUTHY_FLAG_VALUES}})
+    elif active is False:
+        filters.append({"isActive": {"$exists": True, "$nin": TRUTHY_FLAG_VALUES}})
+    return filters
+
+
+def and_filter(filters: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"$and": filters} if filters else {}
+
+
+def _to_maybe_object_id(s: str):
+    try:
+        return ObjectId(s)
+    except Exception:
+        return s
+
+
+def encode_cursor(created_at: Optional[datetime], doc_id: Any) -> str:
+    """Encodes a (createdAt, _id) keyset position as an opaque cursor string."""
+    raw = json.dumps({"c": created_at.isoformat() if isinstance(created_at, datetime) else None, "i": str(doc_id)})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], Any]:
+    raw = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8"))
+    created_at = datetime.fromisoformat(raw["c"]) if raw.get("c") else None
+    return created_at, _to_maybe_object_id(raw["i"])
+
+
+def keyset_after_filter(cursor: str) -> Dict[str, Any]:
+    """Filter for documents strictly after `cursor` in (createdAt desc, _id desc) order."""
+    created_at, doc_id = decode_cursor(cursor)
+    if created_at is None:
+        # Documents without createdAt sort last in descending order
+        return {"createdAt": None, "_id": {"$lt": doc_id}}
+    return {"$or": [
+        {"createdAt": {"$lt": created_at}},
+        {"createdAt": created_at, "_id": {"$lt": doc_id}},
+        {"createdAt": None},
+    ]}
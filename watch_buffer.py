@@ -0,0 +1,186 @@
+# watch_buffer.py
+"""
+Optional write-coalescing buffer for update_lesson_watch_time heartbeats.
+
+Players report watch time every few seconds. With the buffer enabled the
+mutation only records the latest (max) watch time per (user, course, lesson)
+in memory; a background task writes everything accumulated since the last
+flush as one unordered bulk_write. Watch times only ever go up ($max), so
+retrying a failed flush or flushing the same key twice is harmless.
+
+A failed flush puts its entries back in front of anything buffered since.
+Entries the server rejects individually (writeErrors) are dropped and logged
+rather than retried, since retrying them would fail the same way forever.
+On shutdown the running flush is allowed to finish before the final one.
+"""
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError
+from typing import Any, Dict, Optional, Tuple
+
+from db import progress_collection
+from progress import watch_time_update_requests
+
+load_dotenv()
+
+logger = logging.getLogger('MutationsLogger')
+
+WATCH_TIME_BUFFER_ENABLED = os.getenv("WATCH_TIME_BUFFER_ENABLED", "false").lower() in {"true", "1", "yes"}
+# How often the buffer is written to MongoDB
+WATCH_TIME_FLUSH_INTERVAL_SECONDS = float(os.getenv("WATCH_TIME_FLUSH_INTERVAL_SECONDS", "5"))
+# Upper bound on how long a single heartbeat may sit in memory before a flush is forced
+WATCH_TIME_MAX_STALENESS_SECONDS = float(os.getenv("WATCH_TIME_MAX_STALENESS_SECONDS", "15"))
+# Force a flush once this many distinct lessons are pending
+WATCH_TIME_MAX_PENDING = int(os.getenv("WATCH_TIME_MAX_PENDING", "5000"))
+
+BufferKey = Tuple[str, str, str]
+
+
+class WatchTimeBuffer:
+    def __init__(self, flush_interval: float, max_staleness: float, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+        # (user_id, course_id, lesson_id) -> (max watch time, monotonic time first buffered)
+        self._pending: Dict[BufferKey, Tuple[float, float]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._stats = {
+            "received": 0,
+            "flushes": 0,
+            "written": 0,
+            "errors": 0,
+            "dropped": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+        }
+
+    def add(self, user_id: str, course_id: str, lesson_id: str, watch_time: float):
+        key = (user_id, course_id, lesson_id)
+        now = time.monotonic()
+        current = self._pending.get(key)
+        if current is None:
+            self._pending[key] = (watch_time, now)
+        elif watch_time > current[0]:
+            self._pending[key] = (watch_time, current[1])
+        self._stats["received"] += 1
+
+        if len(self._pending) >= self.max_pending or now - self._oldest() >= self.max_staleness:
+            self._wakeup.set()
+
+    def _oldest(self) -> float:
+        # Dicts keep insertion order, so the first entry is the oldest one
+        for _, first_seen in self._pending.values():
+            return first_seen
+        return time.monotonic()
+
+    def _merge_back(self, entries: Dict[BufferKey, Tuple[float, float]]):
+        # The failed entries were buffered before anything added since, so they go first to keep _oldest() right
+        merged = dict(entries)
+        for key, (watch_time, first_seen) in self._pending.items():
+            current = merged.get(key)
+            if current is None:
+                merged[key] = (watch_time, first_seen)
+            else:
+                merged[key] = (max(watch_time, current[0]), min(first_seen, current[1]))
+        self._pending = merged
+
+    async def flush(self) -> int:
+        """Writes all pending watch times in one unordered bulk_write. Returns the number of watch times written."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            entries, self._pending = self._pending, {}
+            keys = list(entries.keys())
+            requests = [
+                request
+                for user_id, course_id, lesson_id in keys
+                for request in watch_time_update_requests(user_id, course_id, lesson_id, entries[(user_id, course_id, lesson_id)][0])
+            ]
+            # Each key yields one request per schema version, see watch_time_update_requests
+            requests_per_key = len(requests) // len(keys)
+            started = time.perf_counter()
+            rejected: Dict[BufferKey, str] = {}
+            try:
+                await progress_collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # The other writes went through; the rejected ones would be rejected again on every retry
+                for write_error in e.details.get("writeErrors", []):
+                    rejected[keys[write_error["index"] // requests_per_key]] = write_error.get("errmsg", "Write failed")
+                if not rejected:
+                    # Only a write concern error: nothing is known to be lost, so retry the whole batch
+                    self._merge_back(entries)
+                    self._stats["errors"] += 1
+                    logger.error(f"WatchTimeBuffer: Flush of {len(entries)} watch time(s) failed, will retry: {e}")
+                    return 0
+            except BaseException as e:
+                # Put everything back, also when cancelled mid-write; $max makes re-applying written entries a no-op
+                self._merge_back(entries)
+                if not isinstance(e, Exception):
+                    raise
+                self._stats["errors"] += 1
+                logger.error(f"WatchTimeBuffer: Flush of {len(entries)} watch time(s) failed, will retry: {e}")
+                return 0
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            for (user_id, course_id, lesson_id), errmsg in rejected.items():
+                logger.error(
+                    f"WatchTimeBuffer: Dropped watch time {entries[(user_id, course_id, lesson_id)][0]} of user {user_id}, "
+                    f"course {course_id}, lesson {lesson_id}: {errmsg}"
+                )
+            written = len(entries) - len(rejected)
+            self._stats["flushes"] += 1
+            self._stats["written"] += written
+            self._stats["dropped"] += len(rejected)
+            self._stats["last_flush_ms"] = round(elapsed_ms, 2)
+            self._stats["max_flush_ms"] = round(max(self._stats["max_flush_ms"], elapsed_ms), 2)
+            logger.info(f"WatchTimeBuffer: Flushed {written} watch time(s) in {elapsed_ms:.1f} ms")
+            return written
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                break
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops the background task and writes whatever is still pending. A flush
+        that is already running is awaited, not cancelled, so its batch is not lost.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        pending = len(self._pending)
+        return {
+            **self._stats,
+            "enabled": WATCH_TIME_BUFFER_ENABLED,
+            "queue_depth": pending,
+            "oldest_pending_seconds": round(time.monotonic() - self._oldest(), 2) if pending else 0.0,
+        }
+
+
+watch_time_buffer = WatchTimeBuffer(
+    WATCH_TIME_FLUSH_INTERVAL_SECONDS,
+    WATCH_TIME_MAX_STALENESS_SECONDS,
+    WATCH_TIME_MAX_PENDING,
+)